@@ -12,9 +12,21 @@ class TTSRequest(BaseModel):
     input: str = Field(..., description="The text to generate audio for", min_length=1, max_length=4096)
     voice: str = Field(..., description="Voice ID or preset voice name")
     model: str = Field(default="cosyvoice-v1", description="Model to use for generation")
-    response_format: Literal["wav", "pcm", "mp3"] = Field(default="wav", description="Audio format")
+    response_format: Literal["wav", "pcm", "mp3", "opus", "flac"] = Field(default="wav", description="Audio format")
     speed: float = Field(default=1.0, ge=0.5, le=2.0, description="Speed of generated audio")
+    seed: Optional[int] = Field(default=None, description="Random seed for reproducible generation (enables segment cache reuse)")
+    stream: bool = Field(default=False, description="Stream WAV output chunk by chunk instead of returning a complete file")
+    sample_rate: Optional[int] = Field(default=None, ge=8000, le=48000, description="Output sample rate for pcm / streamed wav (default: model rate)")
+    codec: Literal["linear16", "mulaw", "alaw"] = Field(default="linear16", description="Sample encoding for pcm / streamed wav (G.711 mulaw/alaw for telephony)")
+    profile: bool = Field(default=False, description="Capture a torch.profiler trace of this request (never shared with identical requests)")
     
+class StreamSessionConfig(BaseModel):
+    """Per-connection settings for the incremental text WebSocket (/v1/audio/speech/stream)"""
+    voice: str = Field(..., description="Voice ID")
+    speed: float = Field(default=1.0, ge=0.5, le=2.0, description="Speed of generated audio")
+    sample_rate: Optional[int] = Field(default=None, ge=8000, le=48000, description="Output sample rate (default: model rate)")
+    codec: Literal["linear16", "mulaw", "alaw"] = Field(default="linear16", description="Sample encoding of binary audio frames")
+
 class SimpleTTSRequest(BaseModel):
     """Simplified TTS request"""
     text: str = Field(..., min_length=1)
@@ -5,27 +5,40 @@ FastAPI Server with OpenAI-compatible TTS API
 import os
 import sys
 import io
+import asyncio
+import threading
+import queue
+import time
+import uuid
+import json
+import hashlib
+from collections import OrderedDict
 import wave
 import struct
 import torch
-import torchaudio
 import numpy as np
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Response
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 import tempfile
 import logging
 from datetime import datetime
 from typing import Optional
+from functools import partial
 
 # Add project root to path
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/third_party/Matcha-TTS'.format(ROOT_DIR))
 
-from cosyvoice.cli.cosyvoice import CosyVoice as CosyVoiceAutoModel
+from cosyvoice.cli.cosyvoice import AutoModel as CosyVoiceAutoModel
+from cosyvoice.cli.model import CosyVoice2Model
 from cosyvoice.utils.file_utils import load_wav
 from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils import metrics
+from cosyvoice.utils.memory import memory_stats
+from cosyvoice.utils.thread_plan import thread_plan
+from cosyvoice.utils.frontend_utils import contains_chinese
 from voice_manager import (
     save_custom_voice, load_custom_voices, delete_custom_voice,
     get_voice_by_id, get_voice_list_for_dropdown, get_voice_audio_path
@@ -33,9 +46,11 @@ from voice_manager import (
 from api_models import (
     TTSRequest, SimpleTTSRequest, VoiceCreateResponse, VoiceInfo,
     VoiceListResponse, VoiceDeleteResponse, ModelInfo, ModelListResponse,
-    HealthResponse, ErrorResponse
+    HealthResponse, ErrorResponse, StreamSessionConfig
 )
-from cache_manager import get_embedding_cache
+from cache_manager import get_embedding_cache, get_segment_cache, get_prompt_cache
+from request_coalescer import RequestCoalescer, FlightCancelled
+from audio_encoders import StreamingEncoder, STREAMING_FORMATS, ENCODER_SETTINGS, TelephonyConverter, WAV_CODEC_FORMATS, numpy_to_pcm_bytes
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -46,6 +61,31 @@ cosyvoice_model = None
 asr_model = None
 model_config = {}
 embedding_cache = None
+segment_cache = None
+prompt_cache = None
+# Synthesis is cancelled once it runs longer than REQUEST_TIMEOUT seconds (0 disables the deadline)
+REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "300"))
+# How often a non-streaming request checks whether its client is still connected
+DISCONNECT_POLL_INTERVAL = 0.5
+request_coalescer = RequestCoalescer(deadline=REQUEST_TIMEOUT if REQUEST_TIMEOUT > 0 else None)
+# Per-request timing breakdowns kept for lookup after streaming responses, and where profiler traces are written
+TIMINGS_HISTORY = int(os.getenv("TIMINGS_HISTORY", "1000"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Requests whose estimated peak memory exceeds this are rejected before synthesis (0 disables)
+MAX_REQUEST_MEMORY_MB = float(os.getenv("MAX_REQUEST_MEMORY_MB", "0"))
+request_timings: "OrderedDict[str, metrics.RequestTimings]" = OrderedDict()
+# Representative synthesis shapes (<short|long>-<offline|stream>) run through every stage before /ready reports
+# true, so the first real requests do not pay kernel selection, session warm-up and cache creation (empty disables)
+WARMUP_SHAPES = [shape.strip() for shape in os.getenv("WARMUP_SHAPES", "short-offline,short-stream,long-offline,long-stream").split(",") if shape.strip()]
+WARMUP_ROUNDS = int(os.getenv("WARMUP_ROUNDS", "1"))
+WARMUP_TEXTS = {
+    "short": "你好，欢迎使用语音合成服务。",
+    "long": "收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。"
+            "CosyVoice is undergoing a comprehensive upgrade, providing more accurate, stable, faster, and better voice generation. "
+            "今天是2024年3月15日，气温18度，我们下午3点在会议室见面，讨论第2季度的计划。",
+}
+WARMUP_PROMPT = (os.path.join(ROOT_DIR, "zero_shot_prompt.wav"), "希望你以后能够做的比我还好呦。")
+warmup_state = {"status": "pending", "seconds": None, "shapes": {}, "error": None}
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -61,7 +101,28 @@ async def lifespan(app: FastAPI):
     logger.info(f"📂 Loading model: {model_dir}")
     
     try:
-        cosyvoice_model = CosyVoiceAutoModel(model_dir=model_dir, load_trt=False, fp16=False)
+        # QUANTIZE=int8|int4 quantizes the LLM and flow estimator for CPU-only hosts
+        model_kwargs = {"quantize": os.getenv("QUANTIZE")} if os.getenv("QUANTIZE") else {}
+        # DTYPE=bf16 runs the LLM and flow estimator under CPU bf16 autocast (AMX / AVX512-BF16 hosts)
+        if os.getenv("DTYPE"):
+            model_kwargs["dtype"] = os.getenv("DTYPE")
+        # LOAD_ONNX=1 runs the flow estimator in onnxruntime on CPU, export it first with cosyvoice/bin/export_onnx.py
+        if os.getenv("LOAD_ONNX", "0").lower() in ("1", "true"):
+            model_kwargs["load_onnx"] = True
+        # LOAD_ONNX_HIFT=1 runs the HiFT vocoder body in onnxruntime on CPU, export it with cosyvoice/bin/export_hift_onnx.py
+        if os.getenv("LOAD_ONNX_HIFT", "0").lower() in ("1", "true"):
+            model_kwargs["load_onnx_hift"] = True
+        # LOAD_ONNX_LLM=1 decodes speech tokens with the onnxruntime Qwen2 graphs of cosyvoice/bin/export_llm_onnx.py
+        if os.getenv("LOAD_ONNX_LLM", "0").lower() in ("1", "true"):
+            model_kwargs["load_onnx_llm"] = True
+        # TOKEN2WAV_WORKERS=N runs flow + HiFT in N processes fed through shared memory, this process keeps the frontend and LLM
+        if int(os.getenv("TOKEN2WAV_WORKERS", "0")) > 0:
+            model_kwargs["token2wav_workers"] = int(os.getenv("TOKEN2WAV_WORKERS"))
+            model_kwargs["token2wav_cores"] = os.getenv("TOKEN2WAV_CORES") or None
+        # THREAD_PLAN=auto|<json>|<json file> pins frontend / llm / flow / hift to cores with their own thread counts
+        thread_plan.configure(os.getenv("THREAD_PLAN") or None,
+                              concurrency=int(os.getenv("THREAD_PLAN_CONCURRENCY", "1")))
+        cosyvoice_model = CosyVoiceAutoModel(model_dir=model_dir, load_trt=False, fp16=False, **model_kwargs)
         model_config['sample_rate'] = cosyvoice_model.sample_rate
         model_config['model_dir'] = model_dir
         logger.info(f"✅ Model loaded successfully (SR: {model_config['sample_rate']}Hz)")
@@ -81,7 +142,7 @@ async def lifespan(app: FastAPI):
                 log_level='ERROR',
                 device="cuda:0" if torch.cuda.is_available() else "cpu"
             )
-    logger.info(f"✅ ASR model loaded successfully")
+            logger.info(f"✅ ASR model loaded successfully")
     except Exception as e:
         logger.warning(f"⚠️  ASR model not available: {e}")
         asr_model = None
@@ -99,8 +160,22 @@ async def lifespan(app: FastAPI):
     except Exception as e:
         logger.warning(f"⚠️  Cache preload failed: {e}")
     
+    # Initialize sentence-level segment cache
+    global segment_cache
+    segment_cache = get_segment_cache()
+    logger.info(f"💾 Segment cache enabled ({segment_cache.max_bytes // (1024 * 1024)} MB)")
+    
+    # Initialize prompt feature cache, segments and repeated requests of a voice skip prompt extraction
+    global prompt_cache
+    prompt_cache = get_prompt_cache()
+    cosyvoice_model.frontend.prompt_cache = prompt_cache
+    logger.info(f"💾 Prompt cache enabled ({prompt_cache.max_entries} voices)")
+    
+    # Warm up in the background: /health answers right away, /ready once every shape has run
+    threading.Thread(target=run_warmup, name="warmup", daemon=True).start()
+    
     logger.info("=" * 60)
-    logger.info("✅ API Server ready")
+    logger.info("✅ API Server started, warming up before reporting ready")
     logger.info("🌐 Listening on port 81889")
     logger.info("=" * 60)
     
@@ -127,6 +202,58 @@ app.add_middleware(
 
 # ===== Helper Functions =====
 
+def run_warmup():
+    """Run the configured synthesis shapes through every stage, then mark the server ready"""
+    start_time = time.time()
+    warmup_state["status"] = "running"
+    prompt_audio, prompt_text = WARMUP_PROMPT
+    shapes = []
+    for shape in WARMUP_SHAPES:
+        length, _, mode = shape.partition("-")
+        if length in WARMUP_TEXTS and mode in ("offline", "stream"):
+            shapes.append((shape, WARMUP_TEXTS[length], mode == "stream"))
+        else:
+            logger.warning(f"⚠️  Ignoring unknown warm-up shape '{shape}', expected <short|long>-<offline|stream>")
+    if not os.path.exists(prompt_audio):
+        # Fall back to any custom voice, the prompt only has to exercise the frontend
+        voices = load_custom_voices()
+        if voices:
+            voice_data = get_voice_by_id(next(iter(voices)))
+            prompt_audio, prompt_text = voice_data["audio"], voice_data["text"]
+        else:
+            shapes = []
+            logger.warning(f"⚠️  No warm-up prompt ({prompt_audio}) and no custom voice, skipping warm-up")
+    # Same prompt text as real requests (CosyVoice3: system prompt in front)
+    prompt_text = cosyvoice_model.zero_shot_prompt_text(prompt_text)
+    try:
+        for _ in range(WARMUP_ROUNDS):
+            for shape, text, stream in shapes:
+                shape_start = time.time()
+                # No segment cache: a cache hit in the second round would skip the model
+                for _ in cosyvoice_model.inference_zero_shot(text, prompt_text, prompt_audio, stream=stream, seed=0):
+                    pass
+                warmup_state["shapes"][shape] = round(time.time() - shape_start, 3)
+                logger.info(f"🔥 Warm-up {shape}: {warmup_state['shapes'][shape]:.2f}s")
+        for response_format in STREAMING_FORMATS:
+            try:
+                encoder = StreamingEncoder(response_format, model_config["sample_rate"])
+                encoder.encode(torch.zeros(1, model_config["sample_rate"] // 10))
+                encoder.close()
+            except Exception as e:
+                logger.warning(f"⚠️  Warm-up of {response_format} encoder failed: {e}")
+    except Exception as e:
+        # A model that cannot synthesize must not receive traffic, /ready stays false
+        warmup_state["status"] = "failed"
+        warmup_state["error"] = str(e)
+        logger.error(f"❌ Warm-up failed: {e}")
+        return
+    finally:
+        warmup_state["seconds"] = round(time.time() - start_time, 3)
+    warmup_state["status"] = "done"
+    logger.info("=" * 60)
+    logger.info(f"✅ API Server ready (warm-up {warmup_state['seconds']:.2f}s)")
+    logger.info("=" * 60)
+
 def transcribe_audio(audio_path: str) -> str:
     """Transcribe audio using ASR model"""
     if asr_model is None:
@@ -166,31 +293,208 @@ def numpy_to_wav_bytes(audio_np: np.ndarray, sample_rate: int) -> bytes:
     buffer.seek(0)
     return buffer.getvalue()
 
-def numpy_to_pcm_bytes(audio_np: np.ndarray) -> bytes:
-    """Convert numpy array to raw PCM bytes (for streaming)"""
-    if audio_np.ndim == 2:
-        audio_np = audio_np.squeeze()
+def streaming_wav_header(sample_rate: int, channels: int = 1, bits_per_sample: int = 16, audio_format: int = 1) -> bytes:
+    """
+    Build a RIFF/WAVE header for a stream of unknown length
     
-    audio_np = np.clip(audio_np, -1.0, 1.0)
-    audio_int16 = (audio_np * 32767).astype(np.int16)
-    return audio_int16.tobytes()
+    RIFF and data sizes are set to 0xFFFFFFFF, which players treat as "read until EOF".
+    audio_format: 1 = PCM, 6 = A-law, 7 = mu-law
+    """
+    byte_rate = sample_rate * channels * bits_per_sample // 8
+    block_align = channels * bits_per_sample // 8
+    return (
+        b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, audio_format, channels, sample_rate, byte_rate, block_align, bits_per_sample)
+        + b"data" + struct.pack("<I", 0xFFFFFFFF)
+    )
+
+def synthesize_pcm_chunks(text: str, prompt_text: str, prompt_audio: str, speed: float = 1.0,
+                          seed: Optional[int] = None, sample_rate: Optional[int] = None, codec: str = "linear16",
+                          cancel_event: Optional[threading.Event] = None):
+    """Run streaming synthesis (blocking) and yield raw PCM / G.711 bytes per model chunk"""
+    # Resampler state lives for the whole stream so chunk seams stay clean
+    converter = TelephonyConverter(model_config['sample_rate'], sample_rate, codec)
+    for chunk in cosyvoice_model.inference_zero_shot(
+        text, prompt_text, prompt_audio, stream=True, speed=speed,
+        segment_cache=segment_cache, seed=seed, cancel_event=cancel_event
+    ):
+        yield converter.convert(chunk['tts_speech'])
+    tail = converter.flush()
+    if tail:
+        yield tail
+
+def synthesize_wav(text: str, prompt_text: str, prompt_audio: str, speed: float = 1.0,
+                   seed: Optional[int] = None, cancel_event: Optional[threading.Event] = None):
+    """Run non-streaming synthesis (blocking) and yield one complete WAV file"""
+    speech_list = []
+    for chunk in cosyvoice_model.inference_zero_shot(
+        text, prompt_text, prompt_audio, stream=False, speed=speed,
+        segment_cache=segment_cache, seed=seed, cancel_event=cancel_event
+    ):
+        speech_list.append(chunk['tts_speech'])
+    
+    # Partial audio of a cancelled synthesis is never encoded
+    if (cancel_event is not None and cancel_event.is_set()) or len(speech_list) == 0:
+        return
+    
+    audio_np = torch.concat(speech_list, dim=1).numpy().flatten()
+    yield numpy_to_wav_bytes(audio_np, model_config['sample_rate'])
 
-async def stream_pcm_generator(text: str, voice_id: str, speed: float = 1.0):
+def synthesize_encoded_chunks(response_format: str, text: str, prompt_text: str, prompt_audio: str, speed: float = 1.0,
+                              seed: Optional[int] = None, cancel_event: Optional[threading.Event] = None):
+    """Run streaming synthesis (blocking) and yield compressed bytes as soon as the encoder emits them"""
+    # One encoder per stream, so codec state carries over chunk boundaries
+    encoder = StreamingEncoder(response_format, model_config['sample_rate'])
+    try:
+        for chunk in cosyvoice_model.inference_zero_shot(
+            text, prompt_text, prompt_audio, stream=True, speed=speed,
+            segment_cache=segment_cache, seed=seed, cancel_event=cancel_event
+        ):
+            data = encoder.encode(chunk['tts_speech'])
+            if data:
+                yield data
+    finally:
+        tail = encoder.close()
+    if tail:
+        yield tail
+
+def run_profiled(producer, trace_path: str, cancel_event: threading.Event):
+    """Run a synthesis producer under torch.profiler and export a Chrome trace when it ends"""
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    # NOTE the profiler is process wide: other requests running at the same time show up in the trace too
+    profiler = torch.profiler.profile(activities=activities, record_shapes=True)
+    profiler.start()
+    try:
+        yield from producer(cancel_event)
+    finally:
+        profiler.stop()
+        profiler.export_chrome_trace(trace_path)
+        logger.info(f"📈 Profiler trace written to {trace_path}")
+
+class RequestTrace:
+    """Request id, timing breakdown lookup and optional profiling of one /v1/audio/speech request"""
+    
+    def __init__(self, profile: bool = False):
+        self.request_id = uuid.uuid4().hex[:16]
+        self.profile = profile
+        self.timings: Optional[metrics.RequestTimings] = None
+    
+    @property
+    def trace_path(self) -> str:
+        return os.path.join(PROFILE_DIR, f"{self.request_id}.json")
+    
+    def wrap(self, key, producer):
+        """Profiled requests get their own flight, so the trace only covers this request's synthesis"""
+        if not self.profile:
+            return key, producer
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        return key + (self.request_id,), partial(run_profiled, producer, self.trace_path)
+    
+    def on_join(self, flight):
+        # Coalesced requests share the timings of the flight they joined
+        self.timings = flight.timings
+        request_timings[self.request_id] = flight.timings
+        while len(request_timings) > TIMINGS_HISTORY:
+            request_timings.popitem(last=False)
+    
+    def headers(self) -> dict:
+        headers = {"X-Request-Id": self.request_id, "X-Timings-Url": f"/v1/requests/{self.request_id}/timings"}
+        if self.profile:
+            headers["X-Profile-Url"] = f"/v1/requests/{self.request_id}/profile"
+        return headers
+
+def coalesce_key(voice_id: str, text: str, speed: float, response_format: str, seed: Optional[int],
+                 sample_rate: Optional[int] = None, codec: str = "linear16"):
+    """Requests with the same key share one in-flight synthesis"""
+    return (voice_id, text, float(speed), response_format, seed, sample_rate, codec)
+
+async def stream_pcm_generator(text: str, voice_id: str, speed: float = 1.0, seed: Optional[int] = None,
+                               sample_rate: Optional[int] = None, codec: str = "linear16", trace: Optional[RequestTrace] = None):
     """Generate PCM audio stream chunk by chunk"""
     voice_data = get_voice_by_id(voice_id)
     if not voice_data:
         raise HTTPException(status_code=404, detail=f"Voice '{voice_id}' not found")
     
-    prompt_text = voice_data['text']
+    prompt_text = cosyvoice_model.zero_shot_prompt_text(voice_data['text'])
     prompt_audio = voice_data['audio']
     
-    # Stream generation
-    for chunk in cosyvoice_model.inference_zero_shot(
-        text, prompt_text, prompt_audio, stream=True, speed=speed
-    ):
-        pcm_data = numpy_to_pcm_bytes(chunk['tts_speech'].numpy())
+    # Stream generation (identical in-flight requests share one synthesis, late joiners get a replay).
+    # If the client disconnects, Starlette closes this generator and the coalescer cancels the synthesis
+    # once no subscriber is left.
+    trace = trace or RequestTrace()
+    key, producer = trace.wrap(
+        coalesce_key(voice_id, text, speed, "pcm", seed, sample_rate, codec),
+        partial(synthesize_pcm_chunks, text, prompt_text, prompt_audio, speed, seed, sample_rate, codec)
+    )
+    async for pcm_data in request_coalescer.subscribe(key, producer, trace.on_join):
         yield pcm_data
 
+async def stream_encoded_generator(text: str, voice_id: str, response_format: str, speed: float = 1.0, seed: Optional[int] = None,
+                                   trace: Optional[RequestTrace] = None):
+    """Generate a compressed audio stream (opus/flac/mp3) chunk by chunk"""
+    voice_data = get_voice_by_id(voice_id)
+    if not voice_data:
+        raise HTTPException(status_code=404, detail=f"Voice '{voice_id}' not found")
+    
+    trace = trace or RequestTrace()
+    key, producer = trace.wrap(
+        coalesce_key(voice_id, text, speed, response_format, seed),
+        partial(synthesize_encoded_chunks, response_format, text, cosyvoice_model.zero_shot_prompt_text(voice_data['text']), voice_data['audio'], speed, seed)
+    )
+    async for data in request_coalescer.subscribe(key, producer, trace.on_join):
+        yield data
+
+async def track_stream(stream, response_format: str, request_start: float, header: bytes = b""):
+    """
+    Wrap a streaming response body: record TTFB of the first audio chunk and the final request status
+    
+    header (e.g. the WAV header) is sent first and does not count as audio for TTFB.
+    """
+    status = "200"
+    first_chunk = True
+    try:
+        if header:
+            yield header
+        async for data in stream:
+            if first_chunk:
+                metrics.TTFB_SECONDS.labels(format=response_format).observe(time.perf_counter() - request_start)
+                first_chunk = False
+            yield data
+    except FlightCancelled as e:
+        # Headers are already sent, so the stream simply ends early
+        status = "504"
+        logger.warning(f"⚠️ {response_format} stream truncated: {e}")
+    except (asyncio.CancelledError, GeneratorExit):
+        status = "499"
+        raise
+    except HTTPException as e:
+        status = str(e.status_code)
+        raise
+    except Exception:
+        status = "500"
+        raise
+    finally:
+        metrics.REQUESTS.labels(status=status, format=response_format).inc()
+
+async def await_unless_disconnected(http_request: Request, awaitable):
+    """Await a result, giving up as soon as the HTTP client disconnects"""
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if await http_request.is_disconnected():
+                logger.info("🔌 Client disconnected, cancelling synthesis")
+                # Closing the subscription lets the coalescer cancel the synthesis if nobody else waits for it
+                task.cancel()
+                raise HTTPException(status_code=499, detail="Client closed request")
+    finally:
+        if not task.done():
+            task.cancel()
+
 # ===== API Endpoints =====
 
 @app.get("/", include_in_schema=False)
@@ -216,6 +520,12 @@ async def health_check():
         timestamp=datetime.now().isoformat()
     )
 
+@app.get("/ready")
+async def readiness_check():
+    """Readiness probe: 200 once the model is loaded and warm-up finished, 503 before"""
+    ready = cosyvoice_model is not None and warmup_state["status"] == "done"
+    return JSONResponse(status_code=200 if ready else 503, content={"ready": ready, "warmup": warmup_state})
+
 @app.get("/v1/models", response_model=ModelListResponse)
 async def list_models():
     """List available models (OpenAI-compatible)"""
@@ -230,6 +540,68 @@ async def list_models():
         ]
     )
 
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """Prometheus metrics"""
+    if not metrics.prometheus_available:
+        raise HTTPException(status_code=501, detail="prometheus_client is not installed")
+    from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+    
+    # Cache sizes are sampled at scrape time
+    if embedding_cache is not None:
+        metrics.CACHE_SIZE.labels(cache="embedding", unit="entries").set(len(embedding_cache.memory_cache))
+    if segment_cache is not None:
+        segment_stats = segment_cache.get_stats()
+        metrics.CACHE_SIZE.labels(cache="segment", unit="entries").set(segment_stats["segments"])
+        metrics.CACHE_SIZE.labels(cache="segment", unit="bytes").set(segment_stats["bytes"])
+    if prompt_cache is not None:
+        prompt_stats = prompt_cache.get_stats()
+        metrics.CACHE_SIZE.labels(cache="prompt", unit="entries").set(prompt_stats["prompts"])
+        metrics.CACHE_SIZE.labels(cache="prompt", unit="bytes").set(prompt_stats["bytes"])
+    metrics.CACHE_SIZE.labels(cache="coalescer", unit="entries").set(len(request_coalescer.flights))
+    # Memory is sampled at scrape time as well
+    memory = memory_stats.snapshot()
+    for kind in ("rss", "peak_rss", "allocator"):
+        if memory[kind] is not None:
+            metrics.MEMORY_BYTES.labels(kind=kind).set(memory[kind])
+    for kind, value in memory["reserved"].items():
+        metrics.MEMORY_BYTES.labels(kind=kind).set(value)
+    if cosyvoice_model is not None:
+        metrics.SESSION_BYTES.set(sum(session["total"] for session in cosyvoice_model.model.sessions_memory().values()))
+    return PlainTextResponse(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/v1/memory")
+async def get_memory():
+    """Process memory, per-stage peaks and bytes held by each live synthesis session"""
+    memory = memory_stats.snapshot()
+    sessions = cosyvoice_model.model.sessions_memory() if cosyvoice_model is not None else {}
+    caches = {}
+    if segment_cache is not None:
+        caches["segment"] = segment_cache.get_stats()["bytes"]
+    if prompt_cache is not None:
+        caches["prompt"] = prompt_cache.get_stats()["bytes"]
+    return {
+        **memory,
+        "sessions": sessions,
+        "sessions_total": sum(session["total"] for session in sessions.values()),
+        "caches": caches,
+        "max_request_memory_mb": MAX_REQUEST_MEMORY_MB or None
+    }
+
+def check_request_memory(text: str, prompt_text: str, prompt_audio: str):
+    """Reject requests whose estimated peak memory exceeds MAX_REQUEST_MEMORY_MB"""
+    if MAX_REQUEST_MEMORY_MB <= 0:
+        return
+    import torchaudio
+    info = torchaudio.info(prompt_audio)
+    estimate = cosyvoice_model.estimate_memory(text, prompt_text, info.num_frames / info.sample_rate)
+    if estimate > MAX_REQUEST_MEMORY_MB * 2 ** 20:
+        logger.warning(f"🧠 Rejected request: estimated {estimate / 2 ** 20:.0f}MB exceeds {MAX_REQUEST_MEMORY_MB:.0f}MB ({len(text)} chars)")
+        raise HTTPException(
+            status_code=413,
+            detail=f"Input too large: estimated {estimate / 2 ** 20:.0f}MB exceeds the per-request limit of {MAX_REQUEST_MEMORY_MB:.0f}MB"
+        )
+
 @app.get("/v1/cache/stats")
 async def get_cache_stats():
     """Get embedding cache statistics"""
@@ -239,6 +611,9 @@ async def get_cache_stats():
     stats = embedding_cache.get_stats()
     return {
         "cache_stats": stats,
+        "segment_cache_stats": segment_cache.get_stats() if segment_cache else None,
+        "prompt_cache_stats": prompt_cache.get_stats() if prompt_cache else None,
+        "coalescer_stats": request_coalescer.get_stats(),
         "status": "ok"
     }
 
@@ -292,7 +667,7 @@ async def create_voice(
             audio_path = voice_data['audio']
             # Extract embedding by doing a dummy inference
             for chunk in cosyvoice_model.inference_zero_shot(
-                "预热", text, audio_path, stream=False
+                "预热", cosyvoice_model.zero_shot_prompt_text(text), audio_path, stream=False
             ):
                 # The embedding is computed internally
                 pass
@@ -336,6 +711,12 @@ async def delete_voice(voice_id: str):
     # Delete embedding cache first
     if embedding_cache:
         embedding_cache.delete_cache(voice_id)
+    voice_data = get_voice_by_id(voice_id)
+    if voice_data:
+        if segment_cache:
+            segment_cache.invalidate(voice_data['audio'])
+        if prompt_cache:
+            prompt_cache.invalidate(voice_data['audio'])
     
     # Delete voice
     result = delete_custom_voice(voice_id)
@@ -349,72 +730,284 @@ async def delete_voice(voice_id: str):
         voice_id=voice_id
     )
 
+def log_request_shape(request: TTSRequest):
+    """Log the anonymized shape of a speech request (no text, hashed voice), replayable with load_test.py"""
+    shape = {
+        "ts": round(time.time(), 3),
+        "voice": hashlib.sha256(request.voice.encode()).hexdigest()[:12],
+        "text_len": len(request.input),
+        "lang": "zh" if contains_chinese(request.input) else "en",
+        "format": request.response_format,
+        "stream": request.stream,
+        "speed": request.speed,
+        "seeded": request.seed is not None,
+        "sample_rate": request.sample_rate,
+        "codec": request.codec
+    }
+    logger.info(f"request_shape {json.dumps(shape, separators=(',', ':'))}")
+
 @app.post("/v1/audio/speech")
-async def create_speech(request: TTSRequest):
+async def create_speech(request: TTSRequest, http_request: Request):
     """
     Generate speech from text (OpenAI-compatible)
     
     Supports response formats:
-    - wav: Complete WAV file
+    - wav: Complete WAV file (streamed chunk by chunk when stream=true)
     - pcm: Raw PCM stream (lowest latency)
-    - mp3: MP3 file (requires ffmpeg)
+    - mp3 / opus (Ogg) / flac: Compressed stream, encoded incrementally per chunk (requires ffmpeg)
     """
+    request_start = time.perf_counter()
+    log_request_shape(request)
+    try:
+        response = await build_speech_response(request, http_request, request_start)
+    except HTTPException as e:
+        metrics.REQUESTS.labels(status=str(e.status_code), format=request.response_format).inc()
+        raise
+    # Streaming responses record TTFB and status when the stream ends (see track_stream)
+    if not isinstance(response, StreamingResponse):
+        metrics.TTFB_SECONDS.labels(format=request.response_format).observe(time.perf_counter() - request_start)
+        metrics.REQUESTS.labels(status="200", format=request.response_format).inc()
+    return response
+
+async def build_speech_response(request: TTSRequest, http_request: Request, request_start: float):
+    """Synthesize the request and build the (streaming) response"""
     if cosyvoice_model is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
     voice_id = request.voice
     text = request.input
     speed = request.speed
+    seed = request.seed
     response_format = request.response_format
+    sample_rate = request.sample_rate
+    codec = request.codec
+    
+    # Telephony output (resampling / G.711) is only available on raw sample streams
+    if (sample_rate is not None or codec != "linear16") and not (
+        response_format == "pcm" or (response_format == "wav" and request.stream)
+    ):
+        raise HTTPException(status_code=400, detail="sample_rate and codec require response_format 'pcm' or 'wav' with stream=true")
     
     # Get voice data
     voice_data = get_voice_by_id(voice_id)
     if not voice_data:
         raise HTTPException(status_code=404, detail=f"Voice '{voice_id}' not found")
     
-    prompt_text = voice_data['text']
+    prompt_text = cosyvoice_model.zero_shot_prompt_text(voice_data['text'])
     prompt_audio = voice_data['audio']
+    check_request_memory(text, prompt_text, prompt_audio)
+    trace = RequestTrace(profile=request.profile)
     
     try:
         if response_format == "pcm":
             # Stream PCM chunks
             return StreamingResponse(
-                stream_pcm_generator(text, voice_id, speed),
-                media_type="audio/pcm",
+                track_stream(stream_pcm_generator(text, voice_id, speed, seed, sample_rate, codec, trace), response_format, request_start),
+                media_type={"mulaw": "audio/basic", "alaw": "audio/x-alaw-basic"}.get(codec, "audio/pcm"),
                 headers={
-                    "X-Sample-Rate": str(model_config['sample_rate']),
+                    "X-Sample-Rate": str(sample_rate or model_config['sample_rate']),
                     "X-Channels": "1",
-                    "X-Bit-Depth": "16"
+                    "X-Bit-Depth": str(WAV_CODEC_FORMATS[codec][1]),
+                    "X-Codec": codec,
+                    **trace.headers()
                 }
             )
         
+        elif response_format == "wav" and request.stream:
+            # Stream WAV: header is sent right away, audio follows as it is generated.
+            # The payload is plain PCM, so the synthesis is shared with identical pcm requests
+            audio_format, bits_per_sample = WAV_CODEC_FORMATS[codec]
+            header = streaming_wav_header(sample_rate or model_config['sample_rate'], bits_per_sample=bits_per_sample, audio_format=audio_format)
+            return StreamingResponse(
+                track_stream(stream_pcm_generator(text, voice_id, speed, seed, sample_rate, codec, trace), response_format, request_start, header),
+                media_type="audio/wav",
+                headers={"Content-Disposition": "attachment; filename=speech.wav", **trace.headers()}
+            )
+        
         elif response_format == "wav":
-            # Generate complete audio
-            speech_list = []
-            for chunk in cosyvoice_model.inference_zero_shot(
-                text, prompt_text, prompt_audio, stream=False, speed=speed
-            ):
-                speech_list.append(chunk['tts_speech'])
-            
-            audio_np = torch.concat(speech_list, dim=1).numpy().flatten()
-            wav_bytes = numpy_to_wav_bytes(audio_np, model_config['sample_rate'])
+            # Generate complete audio (shared with identical in-flight requests)
+            key, producer = trace.wrap(
+                coalesce_key(voice_id, text, speed, "wav", seed),
+                partial(synthesize_wav, text, prompt_text, prompt_audio, speed, seed)
+            )
+            wav_bytes = b"".join(await await_unless_disconnected(
+                http_request, request_coalescer.collect(key, producer, trace.on_join)
+            ))
             
             return Response(
                 content=wav_bytes,
                 media_type="audio/wav",
-                headers={"Content-Disposition": "attachment; filename=speech.wav"}
+                headers={
+                    "Content-Disposition": "attachment; filename=speech.wav",
+                    "Server-Timing": trace.timings.server_timing(),
+                    **trace.headers()
+                }
+            )
+        
+        elif response_format in STREAMING_FORMATS:
+            return StreamingResponse(
+                track_stream(stream_encoded_generator(text, voice_id, response_format, speed, seed, trace), response_format, request_start),
+                media_type=ENCODER_SETTINGS[response_format]["media_type"],
+                headers={
+                    "Content-Disposition": f"attachment; filename=speech.{'ogg' if response_format == 'opus' else response_format}",
+                    **trace.headers()
+                }
             )
         
-        else:  # mp3 or other formats
+        else:
             raise HTTPException(
                 status_code=400,
-                detail=f"Format '{response_format}' not supported yet. Use 'wav' or 'pcm'."
+                detail=f"Format '{response_format}' not supported. Use 'wav', 'pcm', 'mp3', 'opus' or 'flac'."
             )
     
+    except HTTPException:
+        raise
+    except FlightCancelled as e:
+        logger.warning(f"⚠️ Speech generation cancelled: {e}")
+        raise HTTPException(status_code=504, detail=f"Generation cancelled: {str(e)}")
     except Exception as e:
         logger.error(f"Speech generation failed: {e}")
         raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
 
+@app.get("/v1/requests/{request_id}/timings")
+async def get_request_timings(request_id: str):
+    """Timing breakdown of a recent request (side channel for streaming responses)"""
+    timings = request_timings.get(request_id)
+    if timings is None:
+        raise HTTPException(status_code=404, detail=f"No timings for request '{request_id}'")
+    return {"request_id": request_id, **timings.to_dict()}
+
+@app.get("/v1/requests/{request_id}/profile")
+async def get_request_profile(request_id: str):
+    """Download the torch.profiler Chrome trace of a request made with profile=true"""
+    trace_path = os.path.join(PROFILE_DIR, f"{os.path.basename(request_id)}.json")
+    if not os.path.exists(trace_path):
+        raise HTTPException(status_code=404, detail=f"No profiler trace for request '{request_id}' (yet)")
+    return FileResponse(trace_path, media_type="application/json", filename=f"{request_id}.trace.json")
+
+def iter_text_deltas(text_queue: queue.Queue):
+    """Blocking generator over text deltas pushed by the WebSocket receiver, ends at None"""
+    while True:
+        delta = text_queue.get()
+        if delta is None:
+            return
+        if delta:
+            yield delta
+
+async def run_streaming_utterance(websocket: WebSocket, config: StreamSessionConfig, voice_data: dict,
+                                  text_queue: queue.Queue, cancel_event: threading.Event):
+    """Synthesize one utterance from incrementally arriving text and send audio frames as they are ready"""
+    loop = asyncio.get_running_loop()
+    audio_queue: asyncio.Queue = asyncio.Queue()
+    
+    def produce():
+        try:
+            converter = TelephonyConverter(model_config['sample_rate'], config.sample_rate, config.codec)
+            # A generator as tts_text makes the model run inference_bistream: LLM decoding starts with the first delta
+            for chunk in cosyvoice_model.inference_zero_shot(
+                iter_text_deltas(text_queue), cosyvoice_model.zero_shot_prompt_text(voice_data['text']), voice_data['audio'],
+                stream=True, speed=config.speed, cancel_event=cancel_event
+            ):
+                loop.call_soon_threadsafe(audio_queue.put_nowait, converter.convert(chunk['tts_speech']))
+            loop.call_soon_threadsafe(audio_queue.put_nowait, converter.flush())
+        finally:
+            loop.call_soon_threadsafe(audio_queue.put_nowait, None)
+    
+    future = loop.run_in_executor(None, produce)
+    while True:
+        data = await audio_queue.get()
+        if data is None:
+            break
+        if data:
+            await websocket.send_bytes(data)
+    await future
+
+@app.websocket("/v1/audio/speech/stream")
+async def speech_stream_websocket(websocket: WebSocket):
+    """
+    Incremental text in, audio out
+    
+    Client messages (JSON):
+    - {"type": "config", "voice": "...", "speed": 1.0, "sample_rate": 8000, "codec": "mulaw"}  (first message)
+    - {"type": "text", "text": "..."}  text delta, synthesis starts with the first one
+    - {"type": "flush"}  finish the current utterance, answered with {"type": "flushed"} after its last audio frame
+    - {"type": "end"}    finish the current utterance and close, answered with {"type": "done"}
+    
+    Server messages: binary audio frames, plus JSON {"type": "ready" | "flushed" | "done" | "error"}
+    """
+    await websocket.accept()
+    if cosyvoice_model is None or not isinstance(cosyvoice_model.model, CosyVoice2Model):
+        await websocket.send_json({"type": "error", "message": "Streaming text input requires a loaded CosyVoice2/3 model"})
+        await websocket.close()
+        return
+    
+    utterance = None  # (task, text_queue) of the utterance currently being synthesized
+    cancel_event = threading.Event()
+    status = "200"
+    
+    async def finish_utterance():
+        nonlocal utterance
+        if utterance is not None:
+            task, text_queue = utterance
+            utterance = None
+            text_queue.put(None)
+            await task
+    
+    try:
+        message = await websocket.receive_json()
+        if message.get("type") != "config":
+            raise ValueError("First message must be a config message")
+        config = StreamSessionConfig(**{k: v for k, v in message.items() if k != "type"})
+        voice_data = get_voice_by_id(config.voice)
+        if not voice_data:
+            raise ValueError(f"Voice '{config.voice}' not found")
+        await websocket.send_json({
+            "type": "ready",
+            "sample_rate": config.sample_rate or model_config['sample_rate'],
+            "codec": config.codec
+        })
+        logger.info(f"🔗 Streaming text session started with voice '{config.voice}'")
+        
+        while True:
+            message = await websocket.receive_json()
+            message_type = message.get("type")
+            if message_type == "text":
+                if utterance is None:
+                    text_queue = queue.Queue()
+                    task = asyncio.create_task(run_streaming_utterance(websocket, config, voice_data, text_queue, cancel_event))
+                    utterance = (task, text_queue)
+                utterance[1].put(message.get("text", ""))
+            elif message_type == "flush":
+                await finish_utterance()
+                await websocket.send_json({"type": "flushed"})
+            elif message_type == "end":
+                await finish_utterance()
+                await websocket.send_json({"type": "done"})
+                await websocket.close()
+                break
+            else:
+                raise ValueError(f"Unknown message type: {message_type}")
+    
+    except WebSocketDisconnect:
+        status = "499"
+        logger.info("🔌 Streaming text client disconnected, cancelling synthesis")
+    except Exception as e:
+        status = "500"
+        logger.error(f"Streaming text session failed: {e}")
+        try:
+            await websocket.send_json({"type": "error", "message": str(e)})
+            await websocket.close()
+        except Exception:
+            pass
+    finally:
+        metrics.REQUESTS.labels(status=status, format="websocket").inc()
+        # Unblock the text generator and stop LLM / token2wav for whatever is still running
+        if utterance is not None:
+            cancel_event.set()
+            task, text_queue = utterance
+            text_queue.put(None)
+            task.cancel()
+
 # ===== Error Handlers =====
 
 @app.exception_handler(HTTPException)
@@ -0,0 +1,315 @@
+"""
+Streaming Audio Encoders
+把模型输出的音频 chunk 增量编码为 Opus(Ogg) / FLAC / MP3，编码器状态在整个流中复用；
+以及电话场景的流式重采样（8/16 kHz）和 G.711 μ-law / A-law 编码
+"""
+import time
+import math
+import logging
+from functools import lru_cache
+from typing import Dict, Any, List, Optional
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+# 每种压缩格式对应的 FFmpeg 容器、编码器与码率
+ENCODER_SETTINGS: Dict[str, Dict[str, Any]] = {
+    "opus": {
+        "container": "ogg",
+        "encoder": "libopus",
+        "bit_rate": 32000,
+        # 默认 1s 一个 Ogg page，缩短到 100ms 以降低首包延迟
+        "muxer_option": {"page_duration": "100000"},
+        "media_type": "audio/ogg"
+    },
+    "flac": {
+        "container": "flac",
+        "encoder": "flac",
+        "bit_rate": None,
+        "muxer_option": {},
+        "media_type": "audio/flac"
+    },
+    "mp3": {
+        "container": "mp3",
+        "encoder": "libmp3lame",
+        "bit_rate": 64000,
+        "muxer_option": {},
+        "media_type": "audio/mpeg"
+    }
+}
+
+STREAMING_FORMATS = tuple(ENCODER_SETTINGS.keys())
+
+
+class _ByteSink:
+    """StreamWriter 的输出目标，收集已编码字节，由调用方按需取走"""
+
+    def __init__(self):
+        self.parts: List[bytes] = []
+
+    def write(self, data) -> int:
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data, self.parts = b"".join(self.parts), []
+        return data
+
+
+class StreamingEncoder:
+    """
+    Incremental encoder for one output stream
+
+    用法：每个模型 chunk 调用 encode()，结束时调用 close()；两者都返回此刻可以发送的字节
+    （可能为空，编码器内部会缓存不足一帧的样本）。
+    """
+
+    def __init__(self, response_format: str, sample_rate: int):
+        if response_format not in ENCODER_SETTINGS:
+            raise ValueError(f"Unsupported streaming format: {response_format}")
+        # 延迟导入：需要系统安装 FFmpeg 动态库
+        from torchaudio.io import StreamWriter, CodecConfig
+
+        settings = ENCODER_SETTINGS[response_format]
+        self.response_format = response_format
+        self.sink = _ByteSink()
+        self.writer = StreamWriter(self.sink, format=settings["container"])
+        codec_config = CodecConfig(bit_rate=settings["bit_rate"]) if settings["bit_rate"] else None
+        self.writer.add_audio_stream(
+            sample_rate=sample_rate,
+            num_channels=1,
+            format="flt",
+            encoder=settings["encoder"],
+            codec_config=codec_config
+        )
+        # flush_packets: 每个 packet 写出后立刻刷新 IO 缓冲，避免编码结果滞留在 AVIO 缓冲中
+        self.writer.open(option={"flush_packets": "1", **settings["muxer_option"]})
+        self.closed = False
+
+    @property
+    def media_type(self) -> str:
+        return ENCODER_SETTINGS[self.response_format]["media_type"]
+
+    def encode(self, speech: torch.Tensor) -> bytes:
+        """编码一个 chunk，speech 形状为 (1, T) 的 float 音频"""
+        chunk = speech.detach().to(torch.float32).cpu().reshape(-1, 1).clamp(-1.0, 1.0)
+        self.writer.write_audio_chunk(0, chunk)
+        return self.sink.drain()
+
+    def close(self) -> bytes:
+        """刷新编码器并写出容器尾部"""
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+        return self.sink.drain()
+
+
+# ===== Telephony: streaming resampling + G.711 =====
+
+TELEPHONY_CODECS = ("linear16", "mulaw", "alaw")
+
+# WAVE fmt 的 audio format 字段与每样本位数
+WAV_CODEC_FORMATS = {
+    "linear16": (1, 16),
+    "alaw": (6, 8),
+    "mulaw": (7, 8)
+}
+
+
+def filter_half_width(up: int, down: int, zero_crossings: int = 16, rolloff: float = 0.94) -> int:
+    """polyphase_filter 的半宽（上采样域样本数），即滤波器中心抽头的下标、群延迟"""
+    cutoff = rolloff * 0.5 / max(up, down)  # 上采样域中的截止频率（cycles/sample）
+    return int(math.ceil(zero_crossings / (2 * cutoff)))
+
+
+@lru_cache(maxsize=16)
+def polyphase_filter(up: int, down: int, zero_crossings: int = 16, rolloff: float = 0.94, beta: float = 8.0) -> np.ndarray:
+    """
+    设计 Kaiser 窗 sinc 低通滤波器并拆成 up 个相位，按 (up, down) 缓存，所有流共享
+
+    Returns:
+        (up, taps_per_phase) 数组，poly[p, i] 作用于当前输入样本往前第 i 个样本
+    """
+    cutoff = rolloff * 0.5 / max(up, down)  # 上采样域中的截止频率（cycles/sample）
+    half_width = filter_half_width(up, down, zero_crossings, rolloff)
+    taps_per_phase = int(math.ceil((2 * half_width + 1) / up))
+    num_taps = taps_per_phase * up
+    k = np.arange(num_taps) - half_width
+    h = 2 * cutoff * np.sinc(2 * cutoff * k) * np.kaiser(num_taps, beta)
+    # 补偿插零上采样带来的 1/up 增益
+    h = h * up / h.sum()
+    return h.reshape(taps_per_phase, up).T.astype(np.float32).copy()
+
+
+class StreamingResampler:
+    """
+    Rational polyphase resampler that keeps its state across chunks
+
+    只计算实际输出的样本（等价于插零上采样→低通→抽取），上一个 chunk 的尾部样本作为历史保留，
+    因此 chunk 接缝处与整段一次性重采样的结果一致。开头丢掉滤波器群延迟对应的输出样本，flush 补零把尾部推出来，
+    输出与输入对齐，总长度为 ceil(输入长度 * target_sr / orig_sr)。
+    """
+
+    def __init__(self, orig_sr: int, target_sr: int):
+        g = math.gcd(orig_sr, target_sr)
+        self.up, self.down = target_sr // g, orig_sr // g
+        self.poly = polyphase_filter(self.up, self.down)
+        self.taps = self.poly.shape[1]
+        # 滤波器群延迟（输出样本数），开头这么多输出样本丢掉
+        self.skip = (filter_half_width(self.up, self.down) + self.down // 2) // self.down
+        # flush 时补零的输入样本数，足够把最后 skip 个输出样本推出来
+        self.delay = -(-(self.skip + 1) * self.down // self.up)
+        self.history = np.zeros(self.taps - 1, dtype=np.float32)
+        self.num_in = 0   # 已输入的样本数
+        self.num_out = 0  # 已输出的样本数
+
+    def process(self, x: np.ndarray) -> np.ndarray:
+        x = np.asarray(x, dtype=np.float32).reshape(-1)
+        if self.up == self.down:
+            return x
+        buf = np.concatenate([self.history, x])
+        offset = self.num_in - len(self.history)  # buf[0] 的全局输入下标
+        self.num_in += len(x)
+        # 输出 n 对应上采样域的位置 n*down，需要输入 (n*down)//up 已到达
+        end = (self.num_in * self.up + self.down - 1) // self.down
+        n = np.arange(max(self.num_out, self.skip), end, dtype=np.int64)
+        self.num_out = end
+        self.history = buf[len(buf) - (self.taps - 1):]
+        if len(n) == 0:
+            return np.zeros(0, dtype=np.float32)
+        t = n * self.down
+        base = t // self.up - offset
+        idx = base[:, None] - np.arange(self.taps)[None, :]
+        return np.einsum('nt,nt->n', buf[idx], self.poly[t % self.up])
+
+    def flush(self) -> np.ndarray:
+        if self.up == self.down:
+            return np.zeros(0, dtype=np.float32)
+        # 补零推出的输出只保留到与输入等长的位置
+        total = (self.num_in * self.up + self.down - 1) // self.down
+        emitted = max(self.num_out - self.skip, 0)
+        return self.process(np.zeros(self.delay, dtype=np.float32))[:total - emitted]
+
+
+_SEG_ALAW_END = np.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF])
+_SEG_ULAW_END = np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF])
+
+
+def numpy_to_pcm_bytes(audio_np: np.ndarray) -> bytes:
+    """Convert numpy array to raw PCM bytes (for streaming)"""
+    if audio_np.ndim == 2:
+        audio_np = audio_np.squeeze()
+    
+    audio_np = np.clip(audio_np, -1.0, 1.0)
+    audio_int16 = (audio_np * 32767).astype(np.int16)
+    return audio_int16.tobytes()
+
+
+def linear_to_alaw(pcm: np.ndarray) -> np.ndarray:
+    """int16 → A-law（ITU-T G.711，向量化）"""
+    val = pcm.astype(np.int32) >> 3
+    mask = np.where(val >= 0, 0xD5, 0x55)
+    val = np.where(val >= 0, val, -val - 1)
+    seg = np.searchsorted(_SEG_ALAW_END, val, side='left')
+    mantissa = np.where(seg < 2, val >> 1, val >> np.maximum(seg, 1)) & 0x0F
+    aval = np.where(seg >= 8, 0x7F, (np.minimum(seg, 7) << 4) | mantissa)
+    return (aval ^ mask).astype(np.uint8)
+
+
+def linear_to_mulaw(pcm: np.ndarray) -> np.ndarray:
+    """int16 → μ-law（ITU-T G.711，向量化）"""
+    val = pcm.astype(np.int32) >> 2
+    mask = np.where(val < 0, 0x7F, 0xFF)
+    val = np.minimum(np.abs(val), 8159) + 0x21
+    seg = np.searchsorted(_SEG_ULAW_END, val, side='left')
+    uval = np.where(seg >= 8, 0x7F, (np.minimum(seg, 7) << 4) | ((val >> (np.minimum(seg, 7) + 1)) & 0x0F))
+    return (uval ^ mask).astype(np.uint8)
+
+
+class TelephonyConverter:
+    """
+    Per-stream conversion: resample to the target rate, then encode as linear16 / μ-law / A-law
+    """
+
+    def __init__(self, orig_sr: int, target_sr: Optional[int] = None, codec: str = "linear16"):
+        if codec not in TELEPHONY_CODECS:
+            raise ValueError(f"Unsupported codec: {codec}")
+        self.codec = codec
+        self.sample_rate = target_sr or orig_sr
+        self.resampler = StreamingResampler(orig_sr, self.sample_rate) if self.sample_rate != orig_sr else None
+
+    def _encode(self, audio: np.ndarray) -> bytes:
+        pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
+        if self.codec == "mulaw":
+            return linear_to_mulaw(pcm).tobytes()
+        if self.codec == "alaw":
+            return linear_to_alaw(pcm).tobytes()
+        return pcm.tobytes()
+
+    def convert(self, speech: torch.Tensor) -> bytes:
+        audio = speech.detach().cpu().numpy().reshape(-1)
+        if self.resampler is not None:
+            audio = self.resampler.process(audio)
+        return self._encode(audio)
+
+    def flush(self) -> bytes:
+        if self.resampler is None:
+            return b""
+        return self._encode(self.resampler.flush())
+
+
+def benchmark_encoders(speech: torch.Tensor, sample_rate: int, chunk_seconds: float = 0.5) -> List[Dict[str, Any]]:
+    """
+    按模型流式输出的节奏逐 chunk 编码，统计每种格式的码率和每路流的编码 CPU 开销
+
+    Args:
+        speech: (1, T) 的 float 音频
+        sample_rate: 采样率
+        chunk_seconds: 模拟的模型 chunk 时长
+
+    Returns:
+        每种格式一条统计：kbit/s、相对 16-bit PCM 的压缩比、每秒音频的编码 CPU 毫秒数、首包字节数
+    """
+    audio_seconds = speech.shape[1] / sample_rate
+    chunk_len = int(sample_rate * chunk_seconds)
+    pcm_bytes = speech.shape[1] * 2
+    results = [{
+        "format": "pcm",
+        "kbps": round(pcm_bytes * 8 / audio_seconds / 1000, 1),
+        "ratio": 1.0,
+        "cpu_ms_per_audio_sec": 0.0,
+        "first_chunk_bytes": chunk_len * 2
+    }]
+    for response_format in STREAMING_FORMATS:
+        start = time.process_time()
+        encoder = StreamingEncoder(response_format, sample_rate)
+        sizes = [len(encoder.encode(speech[:, i:i + chunk_len])) for i in range(0, speech.shape[1], chunk_len)]
+        total = sum(sizes) + len(encoder.close())
+        cpu_seconds = time.process_time() - start
+        results.append({
+            "format": response_format,
+            "kbps": round(total * 8 / audio_seconds / 1000, 1),
+            "ratio": round(pcm_bytes / total, 1),
+            "cpu_ms_per_audio_sec": round(cpu_seconds * 1000 / audio_seconds, 2),
+            "first_chunk_bytes": sizes[0]
+        })
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import torchaudio
+
+    parser = argparse.ArgumentParser(description="Benchmark streaming encoders: bandwidth and CPU cost per stream")
+    parser.add_argument("--wav", default="zero_shot_prompt.wav", help="Audio used as model output")
+    parser.add_argument("--sample_rate", type=int, default=24000, help="Model output sample rate")
+    parser.add_argument("--chunk_seconds", type=float, default=0.5, help="Duration of one streamed chunk")
+    args = parser.parse_args()
+
+    speech, sr = torchaudio.load(args.wav)
+    speech = torchaudio.functional.resample(speech.mean(dim=0, keepdim=True), sr, args.sample_rate)
+    print(f"{'format':<8}{'kbit/s':>10}{'ratio':>8}{'cpu ms/s':>10}{'1st chunk B':>13}")
+    for row in benchmark_encoders(speech, args.sample_rate, args.chunk_seconds):
+        print(f"{row['format']:<8}{row['kbps']:>10}{row['ratio']:>8}{row['cpu_ms_per_audio_sec']:>10}{row['first_chunk_bytes']:>13}")
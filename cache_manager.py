@@ -236,6 +236,8 @@ class EmbeddingCache:
 
 # Global cache instance
 _global_cache = None
+_global_segment_cache = None
+_global_prompt_cache = None
 
 def get_embedding_cache() -> EmbeddingCache:
     """获取全局缓存实例（单例模式）"""
@@ -243,3 +245,21 @@ def get_embedding_cache() -> EmbeddingCache:
     if _global_cache is None:
         _global_cache = EmbeddingCache()
     return _global_cache
+
+def get_segment_cache():
+    """获取全局句子级音频缓存实例（单例模式），容量由 SEGMENT_CACHE_MB 控制"""
+    global _global_segment_cache
+    if _global_segment_cache is None:
+        from cosyvoice.utils.segment_cache import SegmentCache
+        max_mb = int(os.getenv("SEGMENT_CACHE_MB", 256))
+        _global_segment_cache = SegmentCache(max_bytes=max_mb * 1024 * 1024)
+    return _global_segment_cache
+
+def get_prompt_cache():
+    """获取全局音色提示特征缓存实例（单例模式），条目数由 PROMPT_CACHE_SIZE 控制"""
+    global _global_prompt_cache
+    if _global_prompt_cache is None:
+        from cosyvoice.utils.prompt_cache import PromptCache
+        max_entries = int(os.getenv("PROMPT_CACHE_SIZE", 16))
+        _global_prompt_cache = PromptCache(max_entries=max_entries)
+    return _global_prompt_cache
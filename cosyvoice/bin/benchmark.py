@@ -0,0 +1,417 @@
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from hyperpyyaml import load_hyperpyyaml
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.model import CosyVoice2Model
+from cosyvoice.utils.class_utils import get_model_type
+from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.memory import rss_bytes
+from cosyvoice.utils.metrics import RequestTimings
+from cosyvoice.utils.quantize import QUANTIZE_MODES, quantize_model
+
+# NOTE scaled-down versions of the released configs with random weights, every top level key can be changed with --overrides
+TINY_CONFIGS = {}
+TINY_CONFIGS['cosyvoice3'] = """
+sample_rate: 24000
+spk_embed_dim: 192
+speech_token_size: 6561
+token_frame_rate: 25
+token_mel_ratio: 2
+chunk_size: 25
+text_vocab_size: 4096
+llm_dim: 64
+llm_layers: 2
+llm_heads: 4
+llm_kv_heads: 2
+flow_dim: 128
+flow_depth: 2
+flow_heads: 4
+hift_channels: 64
+
+llm: !new:cosyvoice.llm.llm.CosyVoice3LM
+    llm_input_size: !ref <llm_dim>
+    llm_output_size: !ref <llm_dim>
+    speech_token_size: !ref <speech_token_size>
+    llm: !new:cosyvoice.llm.llm.Qwen2Encoder
+        pretrain_path: !new:transformers.Qwen2Config
+            vocab_size: !ref <text_vocab_size>
+            hidden_size: !ref <llm_dim>
+            intermediate_size: !ref <llm_dim> * 4
+            num_hidden_layers: !ref <llm_layers>
+            num_attention_heads: !ref <llm_heads>
+            num_key_value_heads: !ref <llm_kv_heads>
+    sampling: !name:cosyvoice.utils.common.ras_sampling
+        top_p: 0.8
+        top_k: 25
+        win_size: 10
+        tau_r: 0.1
+
+flow: !new:cosyvoice.flow.flow.CausalMaskedDiffWithDiT
+    input_size: 80
+    output_size: 80
+    spk_embed_dim: !ref <spk_embed_dim>
+    output_type: 'mel'
+    vocab_size: !ref <speech_token_size>
+    input_frame_rate: !ref <token_frame_rate>
+    only_mask_loss: True
+    token_mel_ratio: !ref <token_mel_ratio>
+    pre_lookahead_len: 3
+    pre_lookahead_layer: !new:cosyvoice.transformer.upsample_encoder.PreLookaheadLayer
+        in_channels: 80
+        channels: !ref <flow_dim>
+        pre_lookahead_len: 3
+    decoder: !new:cosyvoice.flow.flow_matching.CausalConditionalCFM
+        in_channels: 240
+        n_spks: 1
+        spk_emb_dim: 80
+        cfm_params: !new:omegaconf.DictConfig
+            content:
+                sigma_min: 0.000001
+                solver: 'euler'
+                t_scheduler: 'cosine'
+                training_cfg_rate: 0.2
+                inference_cfg_rate: 0.7
+                reg_loss_type: 'l1'
+        estimator: !new:cosyvoice.flow.DiT.dit.DiT
+            dim: !ref <flow_dim>
+            depth: !ref <flow_depth>
+            heads: !ref <flow_heads>
+            dim_head: 32
+            ff_mult: 2
+            mel_dim: 80
+            mu_dim: 80
+            spk_dim: 80
+            out_channels: 80
+            static_chunk_size: !ref <chunk_size> * <token_mel_ratio>
+            num_decoding_left_chunks: -1
+
+hift: !new:cosyvoice.hifigan.generator.CausalHiFTGenerator
+    in_channels: 80
+    base_channels: !ref <hift_channels>
+    nb_harmonics: 8
+    sampling_rate: !ref <sample_rate>
+    nsf_alpha: 0.1
+    nsf_sigma: 0.003
+    nsf_voiced_threshold: 10
+    upsample_rates: [8, 5, 3]
+    upsample_kernel_sizes: [16, 11, 7]
+    istft_params:
+        n_fft: 16
+        hop_len: 4
+    resblock_kernel_sizes: [3, 7, 11]
+    resblock_dilation_sizes: [[1, 3, 5], [1, 3, 5], [1, 3, 5]]
+    source_resblock_kernel_sizes: [7, 7, 11]
+    source_resblock_dilation_sizes: [[1, 3, 5], [1, 3, 5], [1, 3, 5]]
+    lrelu_slope: 0.1
+    audio_limit: 0.99
+    conv_pre_look_right: 4
+    f0_predictor: !new:cosyvoice.hifigan.f0_predictor.CausalConvRNNF0Predictor
+        num_class: 1
+        in_channels: 80
+        cond_channels: !ref <hift_channels>
+"""
+TINY_CONFIGS['cosyvoice2'] = """
+sample_rate: 24000
+spk_embed_dim: 192
+speech_token_size: 6561
+token_frame_rate: 25
+token_mel_ratio: 2
+chunk_size: 25
+text_vocab_size: 4096
+llm_dim: 64
+llm_layers: 2
+llm_heads: 4
+llm_kv_heads: 2
+flow_dim: 64
+flow_depth: 1
+flow_heads: 2
+hift_channels: 64
+
+llm: !new:cosyvoice.llm.llm.Qwen2LM
+    llm_input_size: !ref <llm_dim>
+    llm_output_size: !ref <llm_dim>
+    speech_token_size: !ref <speech_token_size>
+    llm: !new:cosyvoice.llm.llm.Qwen2Encoder
+        pretrain_path: !new:transformers.Qwen2Config
+            vocab_size: !ref <text_vocab_size>
+            hidden_size: !ref <llm_dim>
+            intermediate_size: !ref <llm_dim> * 4
+            num_hidden_layers: !ref <llm_layers>
+            num_attention_heads: !ref <llm_heads>
+            num_key_value_heads: !ref <llm_kv_heads>
+    sampling: !name:cosyvoice.utils.common.ras_sampling
+        top_p: 0.8
+        top_k: 25
+        win_size: 10
+        tau_r: 0.1
+
+flow: !new:cosyvoice.flow.flow.CausalMaskedDiffWithXvec
+    input_size: 512
+    output_size: 80
+    spk_embed_dim: !ref <spk_embed_dim>
+    output_type: 'mel'
+    vocab_size: !ref <speech_token_size>
+    input_frame_rate: !ref <token_frame_rate>
+    only_mask_loss: True
+    token_mel_ratio: !ref <token_mel_ratio>
+    pre_lookahead_len: 3
+    # NOTE UpsampleConformerEncoder hardcodes 512 channels, only its depth can be scaled down
+    encoder: !new:cosyvoice.transformer.upsample_encoder.UpsampleConformerEncoder
+        output_size: 512
+        attention_heads: 8
+        linear_units: !ref <flow_dim> * 4
+        num_blocks: !ref <flow_depth>
+        dropout_rate: 0.1
+        positional_dropout_rate: 0.1
+        attention_dropout_rate: 0.1
+        normalize_before: True
+        input_layer: 'linear'
+        pos_enc_layer_type: 'rel_pos_espnet'
+        selfattention_layer_type: 'rel_selfattn'
+        input_size: 512
+        use_cnn_module: False
+        macaron_style: False
+        static_chunk_size: !ref <chunk_size>
+    decoder: !new:cosyvoice.flow.flow_matching.CausalConditionalCFM
+        in_channels: 240
+        n_spks: 1
+        spk_emb_dim: 80
+        cfm_params: !new:omegaconf.DictConfig
+            content:
+                sigma_min: 0.000001
+                solver: 'euler'
+                t_scheduler: 'cosine'
+                training_cfg_rate: 0.2
+                inference_cfg_rate: 0.7
+                reg_loss_type: 'l1'
+        estimator: !new:cosyvoice.flow.decoder.CausalConditionalDecoder
+            in_channels: 320
+            out_channels: 80
+            channels: [!ref <flow_dim>]
+            dropout: 0.0
+            attention_head_dim: 32
+            n_blocks: 1
+            num_mid_blocks: !ref <flow_depth>
+            num_heads: !ref <flow_heads>
+            act_fn: 'gelu'
+            static_chunk_size: !ref <chunk_size> * <token_mel_ratio>
+            num_decoding_left_chunks: -1
+
+hift: !new:cosyvoice.hifigan.generator.HiFTGenerator
+    in_channels: 80
+    base_channels: !ref <hift_channels>
+    nb_harmonics: 8
+    sampling_rate: !ref <sample_rate>
+    nsf_alpha: 0.1
+    nsf_sigma: 0.003
+    nsf_voiced_threshold: 10
+    upsample_rates: [8, 5, 3]
+    upsample_kernel_sizes: [16, 11, 7]
+    istft_params:
+        n_fft: 16
+        hop_len: 4
+    resblock_kernel_sizes: [3, 7, 11]
+    resblock_dilation_sizes: [[1, 3, 5], [1, 3, 5], [1, 3, 5]]
+    source_resblock_kernel_sizes: [7, 7, 11]
+    source_resblock_dilation_sizes: [[1, 3, 5], [1, 3, 5], [1, 3, 5]]
+    lrelu_slope: 0.1
+    audio_limit: 0.99
+    f0_predictor: !new:cosyvoice.hifigan.f0_predictor.ConvRNNF0Predictor
+        num_class: 1
+        in_channels: 80
+        cond_channels: !ref <hift_channels>
+"""
+
+
+class FixedLengthSampling:
+    """Random weights rarely produce eos, so decode exactly num_tokens speech tokens with the configured sampling."""
+
+    def __init__(self, sampling, speech_token_size, eos_token):
+        self.sampling = sampling
+        self.speech_token_size = speech_token_size
+        self.eos_token = eos_token
+        self.num_tokens = 0
+
+    def __call__(self, weighted_scores, decoded_tokens, sampling):
+        if len(decoded_tokens) >= self.num_tokens:
+            return self.eos_token
+        return self.sampling(weighted_scores[:self.speech_token_size], decoded_tokens, sampling)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark cosyvoice inference with randomly initialized tiny models')
+    parser.add_argument('--model', default='cosyvoice3', choices=list(TINY_CONFIGS.keys()), help='built-in tiny config')
+    parser.add_argument('--config', default=None, help='yaml config replacing the built-in one, weights are still random')
+    parser.add_argument('--overrides', default=None, help='yaml overrides of top level keys, e.g. "{flow_depth: 8, llm_layers: 4}"')
+    parser.add_argument('--text_lens', default='16,64', help='comma separated text token lengths')
+    parser.add_argument('--streams', default='false,true', help='comma separated stream modes')
+    parser.add_argument('--concurrency', default='1,4', help='comma separated numbers of concurrent sessions')
+    parser.add_argument('--token_text_ratio', default=6, type=float, help='speech tokens decoded per text token, between 2 and 20')
+    parser.add_argument('--prompt_tokens', default=75, type=int, help='prompt speech tokens, 75 is 3s at 25Hz')
+    parser.add_argument('--prompt_text_len', default=10, type=int, help='prompt text tokens')
+    parser.add_argument('--repeats', default=3, type=int, help='measured rounds per setting')
+    parser.add_argument('--warmup', default=1, type=int, help='unmeasured sessions before benchmarking')
+    parser.add_argument('--threads', default=0, type=int, help='torch intra-op threads, 0 keeps the default')
+    parser.add_argument('--quantize', default=None, choices=QUANTIZE_MODES, help='quantize the llm and flow estimator, cpu only')
+    parser.add_argument('--dtype', default='fp32', choices=['fp32', 'bf16'], help='bf16 runs the llm and flow under cpu bf16 autocast')
+    parser.add_argument('--seed', default=0, type=int, help='seed of the random weights and inputs')
+    parser.add_argument('--output', default=None, help='write the json report to this file as well')
+    parser.add_argument('--verbose', action='store_true', help='keep info logging of the model')
+    args = parser.parse_args()
+    assert args.quantize is None or args.dtype == 'fp32', 'bf16 autocast does not apply to quantized layers'
+    assert 2 <= args.token_text_ratio <= 20, 'token_text_ratio must lie within the llm min/max token text ratio [2, 20]'
+    return args
+
+
+def build_model(args, device):
+    if args.config is not None:
+        with open(args.config, 'r') as f:
+            configs = load_hyperpyyaml(f, overrides=args.overrides)
+    else:
+        configs = load_hyperpyyaml(TINY_CONFIGS[args.model], overrides=args.overrides)
+    model = get_model_type(configs)(configs['llm'], configs['flow'], configs['hift'], False, args.dtype == 'bf16')
+    assert isinstance(model, CosyVoice2Model), 'only CosyVoice2/CosyVoice3 stacks are supported'
+    # NOTE same as model.load, without the state dicts
+    for module in [model.llm, model.flow, model.hift]:
+        module.to(device).eval()
+    model.llm.sampling = FixedLengthSampling(model.llm.sampling, model.llm.speech_token_size, model.llm.eos_token)
+    return model, configs
+
+
+def make_inputs(model, text_len, args):
+    text_vocab_size = model.llm.llm.model.config.vocab_size
+    prompt_speech_token = torch.randint(0, model.llm.speech_token_size, (1, args.prompt_tokens), dtype=torch.int32)
+    embedding = torch.randn(1, model.flow.spk_embed_affine_layer.in_features)
+    return {'text': torch.randint(0, text_vocab_size, (1, text_len), dtype=torch.int32),
+            'flow_embedding': embedding,
+            'llm_embedding': embedding,
+            'prompt_text': torch.randint(0, text_vocab_size, (1, args.prompt_text_len), dtype=torch.int32),
+            'llm_prompt_speech_token': prompt_speech_token,
+            'flow_prompt_speech_token': prompt_speech_token,
+            'prompt_speech_feat': torch.randn(1, args.prompt_tokens * model.flow.token_mel_ratio, 80)}
+
+
+def run_session(model, inputs, stream):
+    sample_rate = model.hift.sampling_rate
+    timings = RequestTimings()
+    start_time, ttfb, num_samples = time.perf_counter(), None, 0
+    with timings.activate():
+        for output in model.tts(**inputs, stream=stream):
+            if ttfb is None:
+                ttfb = time.perf_counter() - start_time
+            num_samples += output['tts_speech'].shape[1]
+    elapsed = time.perf_counter() - start_time
+    summary = timings.to_dict()
+    stages, info = summary['stages'], summary['info']
+    llm_ms = sum(stages[k]['total_ms'] for k in ['llm_prefill', 'llm_decode'] if k in stages)
+    return {'ttfb_ms': ttfb * 1000,
+            'rtf': elapsed / (num_samples / sample_rate),
+            'llm_tokens_per_s': info.get('llm_tokens', 0) / llm_ms * 1000 if llm_ms > 0 else 0,
+            'flow_ms_per_chunk': stages['flow']['ms'],
+            'hift_ms_per_chunk': stages['hift']['ms'],
+            'audio_s': num_samples / sample_rate}
+
+
+def describe(values):
+    values = np.array(values, dtype=np.float64)
+    return {'mean': round(float(values.mean()), 3), 'p50': round(float(np.percentile(values, 50)), 3),
+            'p90': round(float(np.percentile(values, 90)), 3), 'max': round(float(values.max()), 3)}
+
+
+def benchmark(model, text_len, stream, concurrency, args):
+    model.llm.sampling.num_tokens = int(text_len * args.token_text_ratio)
+    sessions, wall_time = [], 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(args.repeats):
+            inputs = [make_inputs(model, text_len, args) for _ in range(concurrency)]
+            start_time = time.perf_counter()
+            sessions += list(executor.map(lambda x: run_session(model, x, stream), inputs))
+            wall_time += time.perf_counter() - start_time
+    audio_s = sum(i['audio_s'] for i in sessions)
+    return {'text_len': text_len,
+            'stream': stream,
+            'concurrency': concurrency,
+            'sessions': len(sessions),
+            'speech_tokens': model.llm.sampling.num_tokens,
+            'ttfb_ms': describe([i['ttfb_ms'] for i in sessions]),
+            'rtf': describe([i['rtf'] for i in sessions]),
+            'llm_tokens_per_s': describe([i['llm_tokens_per_s'] for i in sessions]),
+            'flow_ms_per_chunk': describe([j for i in sessions for j in i['flow_ms_per_chunk']]),
+            'hift_ms_per_chunk': describe([j for i in sessions for j in i['hift_ms_per_chunk']]),
+            'audio_s_per_wall_s': round(audio_s / wall_time, 3)}
+
+
+def get_meta(args, configs):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'model': args.model if args.config is None else args.config,
+            'overrides': args.overrides,
+            'config': {k: v for k, v in configs.items() if isinstance(v, (int, float, str))},
+            'token_text_ratio': args.token_text_ratio,
+            'prompt_tokens': args.prompt_tokens,
+            'repeats': args.repeats,
+            'seed': args.seed,
+            'quantize': args.quantize,
+            'dtype': args.dtype,
+            'rss_mb': round(rss_bytes() / 1024 ** 2, 1),
+            'torch': torch.__version__,
+            'threads': torch.get_num_threads(),
+            'device': 'cuda' if torch.cuda.is_available() else 'cpu',
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+@torch.no_grad()
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    set_all_random_seed(args.seed)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model, configs = build_model(args, device)
+    if args.quantize is not None:
+        quantize_model(model, args.quantize)
+    text_lens = [int(i) for i in args.text_lens.split(',')]
+    streams = [i.strip().lower() == 'true' for i in args.streams.split(',')]
+    concurrency = [int(i) for i in args.concurrency.split(',')]
+
+    model.llm.sampling.num_tokens = int(min(text_lens) * args.token_text_ratio)
+    for _ in range(args.warmup):
+        run_session(model, make_inputs(model, min(text_lens), args), False)
+
+    results = []
+    for text_len in text_lens:
+        for stream in streams:
+            for c in concurrency:
+                result = benchmark(model, text_len, stream, c, args)
+                print('text_len {} stream {} concurrency {}: ttfb {:.1f}ms rtf {:.3f} llm {:.1f} tok/s flow {:.1f}ms/chunk hift {:.1f}ms/chunk'.format(
+                      text_len, stream, c, result['ttfb_ms']['mean'], result['rtf']['mean'], result['llm_tokens_per_s']['mean'],
+                      result['flow_ms_per_chunk']['mean'], result['hift_ms_per_chunk']['mean']), file=sys.stderr)
+                results.append(result)
+    report = {'meta': get_meta(args, configs), 'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import numpy as np
+import librosa
+import pyworld
+import torch
+import torchaudio
+import torchaudio.compliance.kaldi as kaldi
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.file_utils import logging, load_wav
+
+# NOTE keys of a mode passed to inference_zero_shot, all others are AutoModel arguments
+INFERENCE_KEYS = ['stream', 'speed', 'text_frontend']
+DEFAULT_PROMPT_WAV = '{}/../../zero_shot_prompt.wav'.format(ROOT_DIR)
+DEFAULT_PROMPT_TEXT = '希望你以后能够做的比我还好呦。'
+DEFAULT_TEXTS = ['收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+                 '八百标兵奔北坡，北坡炮兵并排跑，炮兵怕把标兵碰，标兵怕碰炮兵炮。',
+                 'CosyVoice is undergoing a comprehensive upgrade, providing more accurate, stable, faster, and better voice generation.',
+                 'The quick brown fox jumps over the lazy dog, and then it runs back into the forest before sunset.']
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='compare audio quality and speed of a candidate inference mode against a baseline')
+    parser.add_argument('--model_dir', default='pretrained_models/Fun-CosyVoice3-0.5B', help='local path or modelscope repo id')
+    parser.add_argument('--baseline', default='{"stream": false}', help='json dict of the baseline mode, AutoModel and inference arguments')
+    parser.add_argument('--candidate', default='{"stream": true}', help='json dict of the candidate mode')
+    parser.add_argument('--eval_set', default=None, help='jsonl with text / prompt_wav / prompt_text per line, default is a small built-in set')
+    parser.add_argument('--seed', default=0, type=int, help='sampling seed, the same for both modes')
+    parser.add_argument('--output', default=None, help='write the json report to this file')
+    parser.add_argument('--wav_dir', default=None, help='save the synthesized audio of both modes here')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def load_eval_set(path):
+    if path is None:
+        return [{'text': text, 'prompt_wav': DEFAULT_PROMPT_WAV, 'prompt_text': DEFAULT_PROMPT_TEXT} for text in DEFAULT_TEXTS]
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def split_mode(mode):
+    model_kwargs = {k: v for k, v in mode.items() if k not in INFERENCE_KEYS}
+    inference_kwargs = {k: v for k, v in mode.items() if k in INFERENCE_KEYS}
+    return model_kwargs, inference_kwargs
+
+
+def synthesize(model, item, inference_kwargs, seed):
+    prompt_text = model.zero_shot_prompt_text(item['prompt_text'])
+    start_time = time.perf_counter()
+    chunks = [i['tts_speech'].flatten() for i in model.inference_zero_shot(item['text'], prompt_text, item['prompt_wav'], seed=seed, **inference_kwargs)]
+    elapsed = time.perf_counter() - start_time
+    # NOTE chunk boundaries in samples, where streaming / segment splicing may leave discontinuities
+    boundaries = np.cumsum([len(i) for i in chunks])[:-1]
+    return torch.concat(chunks).numpy().astype(np.float64), boundaries, elapsed
+
+
+def run_mode(args, mode, items, model=None):
+    model_kwargs, inference_kwargs = split_mode(mode)
+    if model is None:
+        model = AutoModel(model_dir=args.model_dir, **model_kwargs)
+    # warm up, the first call pays for lazy initialization
+    synthesize(model, items[0], inference_kwargs, args.seed)
+    return model, [synthesize(model, item, inference_kwargs, args.seed) for item in items]
+
+
+def world_features(speech, sample_rate):
+    f0, t = pyworld.dio(speech, sample_rate, frame_period=5.0)
+    f0 = pyworld.stonemask(speech, f0, t, sample_rate)
+    sp = pyworld.cheaptrick(speech, f0, t, sample_rate)
+    return f0, pyworld.code_spectral_envelope(sp, sample_rate, 25)
+
+
+def mcd_f0(baseline, candidate, sample_rate):
+    """Mel-cepstral distortion over WORLD coded spectral envelopes (c0 excluded) and F0 RMSE, frames aligned by DTW."""
+    f0_x, mcep_x = world_features(baseline, sample_rate)
+    f0_y, mcep_y = world_features(candidate, sample_rate)
+    _, path = librosa.sequence.dtw(X=mcep_x[:, 1:].T, Y=mcep_y[:, 1:].T, metric='euclidean')
+    path = path[::-1]
+    diff = mcep_x[path[:, 0], 1:] - mcep_y[path[:, 1], 1:]
+    mcd = float(np.mean(10 / math.log(10) * np.sqrt(2 * np.sum(diff ** 2, axis=1))))
+    f0_x, f0_y = f0_x[path[:, 0]], f0_y[path[:, 1]]
+    voiced = (f0_x > 0) & (f0_y > 0)
+    f0_rmse = float(np.sqrt(np.mean((f0_x[voiced] - f0_y[voiced]) ** 2))) if voiced.any() else None
+    # voicing decision error, share of frames voiced in one and unvoiced in the other
+    vde = float(np.mean((f0_x > 0) != (f0_y > 0)))
+    return mcd, f0_rmse, vde
+
+
+def speaker_embedding(model, speech, sample_rate):
+    # NOTE same features as CosyVoiceFrontEnd._extract_spk_embedding, from a waveform instead of a file
+    speech = torchaudio.functional.resample(torch.from_numpy(speech).float().unsqueeze(0), sample_rate, 16000)
+    feat = kaldi.fbank(speech, num_mel_bins=80, dither=0, sample_frequency=16000)
+    feat = feat - feat.mean(dim=0, keepdim=True)
+    session = model.frontend.campplus_session
+    return session.run(None, {session.get_inputs()[0].name: feat.unsqueeze(dim=0).numpy()})[0].flatten()
+
+
+def cosine(x, y):
+    return float(np.dot(x, y) / (np.linalg.norm(x) * np.linalg.norm(y) + 1e-8))
+
+
+def discontinuity(speech, boundaries, n_fft=1024, hop_length=256):
+    """Sample jump and spectral flux at chunk boundaries relative to their medians over the whole utterance, ~1 means seamless."""
+    if len(boundaries) == 0:
+        return {'boundaries': 0, 'jump_ratio': None, 'flux_ratio': None}
+    diff = np.abs(np.diff(speech))
+    jump_ratio = float(np.mean(diff[boundaries - 1]) / (np.median(diff) + 1e-8))
+    log_mag = np.log(np.abs(librosa.stft(speech, n_fft=n_fft, hop_length=hop_length, center=True)) + 1e-5)
+    flux = np.sqrt(np.sum(np.diff(log_mag, axis=1) ** 2, axis=0))
+    frames = np.clip(np.round(boundaries / hop_length).astype(int) - 1, 0, len(flux) - 1)
+    flux_ratio = float(np.mean(flux[frames]) / (np.median(flux) + 1e-8))
+    return {'boundaries': int(len(boundaries)), 'jump_ratio': round(jump_ratio, 3), 'flux_ratio': round(flux_ratio, 3)}
+
+
+def mean(values):
+    values = [i for i in values if i is not None]
+    return round(float(np.mean(values)), 4) if len(values) != 0 else None
+
+
+@torch.no_grad()
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(message)s')
+    baseline_mode, candidate_mode = json.loads(args.baseline), json.loads(args.candidate)
+    items = load_eval_set(args.eval_set)
+
+    model, baseline_outputs = run_mode(args, baseline_mode, items)
+    # reuse the loaded model when only inference arguments differ
+    if split_mode(baseline_mode)[0] != split_mode(candidate_mode)[0]:
+        del model
+        model = None
+    model, candidate_outputs = run_mode(args, candidate_mode, items, model)
+    sample_rate = model.sample_rate
+
+    per_item = []
+    for index, (item, baseline, candidate) in enumerate(zip(items, baseline_outputs, candidate_outputs)):
+        (speech_x, boundaries_x, time_x), (speech_y, boundaries_y, time_y) = baseline, candidate
+        mcd, f0_rmse, vde = mcd_f0(speech_x, speech_y, sample_rate)
+        prompt = load_wav(item['prompt_wav'], 16000).flatten().numpy().astype(np.float64)
+        embedding_x, embedding_y = speaker_embedding(model, speech_x, sample_rate), speaker_embedding(model, speech_y, sample_rate)
+        embedding_prompt = speaker_embedding(model, prompt, 16000)
+        per_item.append({'text': item['text'],
+                         'mcd': round(mcd, 3),
+                         'f0_rmse': round(f0_rmse, 2) if f0_rmse is not None else None,
+                         'vde': round(vde, 4),
+                         'spk_cos': round(cosine(embedding_x, embedding_y), 4),
+                         'spk_sim_prompt': {'baseline': round(cosine(embedding_x, embedding_prompt), 4),
+                                            'candidate': round(cosine(embedding_y, embedding_prompt), 4)},
+                         'discontinuity': {'baseline': discontinuity(speech_x, boundaries_x), 'candidate': discontinuity(speech_y, boundaries_y)},
+                         'rtf': {'baseline': round(time_x / (len(speech_x) / sample_rate), 4),
+                                 'candidate': round(time_y / (len(speech_y) / sample_rate), 4)},
+                         'speedup': round(time_x / time_y, 3)})
+        if args.wav_dir is not None:
+            os.makedirs(args.wav_dir, exist_ok=True)
+            for name, speech in [('baseline', speech_x), ('candidate', speech_y)]:
+                torchaudio.save('{}/{}_{}.wav'.format(args.wav_dir, index, name), torch.from_numpy(speech).float().unsqueeze(0), sample_rate)
+        logging.warning('item {} mcd {:.3f} f0_rmse {} spk_cos {:.4f} speedup {:.3f}'.format(
+            index, mcd, f0_rmse, per_item[-1]['spk_cos'], per_item[-1]['speedup']))
+
+    total_x, total_y = sum(i[2] for i in baseline_outputs), sum(i[2] for i in candidate_outputs)
+    summary = {'mcd': mean([i['mcd'] for i in per_item]),
+               'f0_rmse': mean([i['f0_rmse'] for i in per_item]),
+               'vde': mean([i['vde'] for i in per_item]),
+               'spk_cos': mean([i['spk_cos'] for i in per_item]),
+               'spk_sim_prompt': {k: mean([i['spk_sim_prompt'][k] for i in per_item]) for k in ['baseline', 'candidate']},
+               'jump_ratio': {k: mean([i['discontinuity'][k]['jump_ratio'] for i in per_item]) for k in ['baseline', 'candidate']},
+               'flux_ratio': {k: mean([i['discontinuity'][k]['flux_ratio'] for i in per_item]) for k in ['baseline', 'candidate']},
+               'rtf': {k: mean([i['rtf'][k] for i in per_item]) for k in ['baseline', 'candidate']},
+               'speedup': round(total_x / total_y, 3)}
+    report = {'model_dir': args.model_dir, 'baseline': baseline_mode, 'candidate': candidate_mode, 'seed': args.seed,
+              'summary': summary, 'items': per_item}
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
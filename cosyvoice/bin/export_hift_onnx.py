@@ -0,0 +1,141 @@
+from __future__ import print_function
+
+import argparse
+import copy
+import os
+import random
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.hifigan.generator import CausalHiFTGenerator
+from cosyvoice.utils.common import OrtHiFTWrapper, set_all_random_seed
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='export the hift vocoder body to onnx for the cpu onnxruntime backend')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/Fun-CosyVoice3-0.5B',
+                        help='local path')
+    parser.add_argument('--atol', default=1e-3, type=float, help='maximal absolute waveform difference to eager torch')
+    parser.add_argument('--benchmark_mel_lens', default='50,200', help='comma separated mel lengths of the cpu latency benchmark')
+    parser.add_argument('--benchmark_repeats', default=10, type=int, help='timed vocoder calls per length')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+class HiFTBody(torch.nn.Module):
+    def __init__(self, hift):
+        super().__init__()
+        self.hift = hift
+
+    def forward(self, x, s_stft):
+        return self.hift.decode_body(x, s_stft)
+
+
+def fold_weight_norm(module):
+    """remove_weight_norm for both the hook based and the parametrization based weight_norm"""
+    from torch.nn.utils import parametrize
+    for m in module.modules():
+        if parametrize.is_parametrized(m, 'weight'):
+            parametrize.remove_parametrizations(m, 'weight')
+        elif hasattr(m, 'weight_g'):
+            torch.nn.utils.remove_weight_norm(m)
+
+
+def get_dummy_input(hift, mel_len):
+    # NOTE conv_pre keeps the mel length, the body upsamples it to the source stft frames (plus one of reflection pad)
+    upsample_rate = int(hift.f0_upsamp.scale_factor) // hift.istft_params['hop_len']
+    x = torch.rand(1, hift.conv_pre.out_channels, mel_len)
+    s_stft = torch.rand(1, hift.istft_params['n_fft'] + 2, mel_len * upsample_rate + 1)
+    return x, s_stft
+
+
+def run(hift, onnx_body, *args, **kwargs):
+    # NOTE the sine source adds noise, seed it so eager and onnxruntime see the same excitation
+    hift.onnx_body = onnx_body
+    set_all_random_seed(0)
+    return hift.inference(*args, **kwargs)[0]
+
+
+def check_chunked(hift, hift_onnx, atol, max_len=300, chunk_size=30, context_size=8):
+    """The chunked-consistency check of generator.py, with onnxruntime compared to eager at every chunk."""
+    mel = torch.rand(1, 80, max_len)
+    errors = [(run(hift, None, mel) - run(hift, hift_onnx, mel)).abs().max().item()]
+    if isinstance(hift, CausalHiFTGenerator):
+        for i in range(0, max_len, chunk_size):
+            finalize = True if i + chunk_size + context_size >= max_len else False
+            mel_chunk = mel[:, :, : i + chunk_size + context_size]
+            errors.append((run(hift, None, mel_chunk, finalize=finalize) - run(hift, hift_onnx, mel_chunk, finalize=finalize)).abs().max().item())
+    hift.onnx_body = None
+    logging.info('max abs difference to eager, full {:.2e}, chunks {:.2e}'.format(errors[0], max(errors)))
+    assert max(errors) <= atol, 'onnxruntime hift differs from eager by {} > {}'.format(max(errors), atol)
+
+
+def benchmark(hift, hift_onnx, mel_lens, repeats):
+    for mel_len in mel_lens:
+        mel = torch.rand(1, 80, mel_len)
+        result = {}
+        for name, onnx_body in [('torch', None), ('onnxruntime', hift_onnx)]:
+            hift.onnx_body = onnx_body
+            hift.inference(mel)
+            start_time = time.perf_counter()
+            for _ in range(repeats):
+                hift.inference(mel)
+            result[name] = (time.perf_counter() - start_time) / repeats * 1000
+        hift.onnx_body = None
+        logging.info('hift mel_len {}: torch {:.2f}ms, onnxruntime {:.2f}ms, speedup {:.2f}x'.format(
+            mel_len, result['torch'], result['onnxruntime'], result['torch'] / result['onnxruntime']))
+
+
+@torch.no_grad()
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    assert torch.cuda.is_available() is False, 'the onnxruntime hift backend is cpu only, export on a cpu host'
+
+    model = AutoModel(model_dir=args.model_dir)
+    hift = model.model.hift
+    hift.eval()
+
+    # 1. export the body with weight norm folded into the conv weights, the f0 predictor, sine source and istft stay in torch
+    body = HiFTBody(copy.deepcopy(hift))
+    fold_weight_norm(body)
+    onnx_path = '{}/hift.fp32.onnx'.format(args.model_dir)
+    torch.onnx.export(
+        body,
+        get_dummy_input(hift, 100),
+        onnx_path,
+        export_params=True,
+        opset_version=18,
+        do_constant_folding=True,
+        input_names=['x', 's_stft'],
+        output_names=['hift_out'],
+        dynamic_axes={
+            'x': {2: 'mel_len'},
+            's_stft': {2: 'stft_len'},
+            'hift_out': {2: 'stft_len'},
+        }
+    )
+
+    # 2. test computation consistency, of the body and of the chunked vocoder output
+    hift_onnx = OrtHiFTWrapper(onnx_path, intra_op_num_threads=torch.get_num_threads())
+    for _ in range(10):
+        x, s_stft = get_dummy_input(hift, random.randint(8, 300))
+        torch.testing.assert_close(hift.decode_body(x, s_stft), hift_onnx(x, s_stft), rtol=1e-2, atol=1e-4)
+    check_chunked(hift, hift_onnx, args.atol)
+    logging.info('successfully export hift')
+
+    # 3. cpu latency of the load_onnx_hift backend against eager torch
+    benchmark(hift, hift_onnx, [int(i) for i in args.benchmark_mel_lens.split(',')], args.benchmark_repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+import torch
+import torch.nn.functional as F
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel, CosyVoice2, CosyVoice3
+from cosyvoice.utils.common import OrtLLMWrapper, set_all_random_seed
+from cosyvoice.utils.file_utils import logging
+
+DEFAULT_PROMPT_WAV = '{}/../../zero_shot_prompt.wav'.format(ROOT_DIR)
+DEFAULT_PROMPT_TEXT = '希望你以后能够做的比我还好呦。'
+TEXTS = ['收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+         'CosyVoice is undergoing a comprehensive upgrade, providing more accurate, stable, faster, and better voice generation.']
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='export the qwen2 llm prefill and decode step with explicit kv cache to onnx')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/Fun-CosyVoice3-0.5B',
+                        help='local path')
+    parser.add_argument('--prompt_wav', default=DEFAULT_PROMPT_WAV, help='prompt audio of the token check')
+    parser.add_argument('--prompt_text', default=DEFAULT_PROMPT_TEXT, help='transcript of the prompt audio')
+    parser.add_argument('--seed', default=0, type=int, help='sampling seed of the token check')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+class Qwen2Step(torch.nn.Module):
+    """Prefill (no past) or one decode step of the Qwen2 llm, kv cache in / out time major as [seq_len, kv_heads, head_dim].
+
+    The attention is written out explicitly instead of tracing the transformers cache classes, so the graph has plain
+    tensor inputs and outputs, the logits go through llm_decoder and log_softmax as in Qwen2LM.inference_wrapper.
+    """
+
+    def __init__(self, llm):
+        super().__init__()
+        self.model, self.llm_decoder = llm.llm.model.model, llm.llm_decoder
+        config = llm.llm.model.config
+        self.num_heads, self.kv_heads = config.num_attention_heads, config.num_key_value_heads
+        self.head_dim = getattr(config, 'head_dim', None) or config.hidden_size // config.num_attention_heads
+        inv_freq = 1.0 / (config.rope_theta ** (torch.arange(0, self.head_dim, 2, dtype=torch.float32) / self.head_dim))
+        self.register_buffer('inv_freq', inv_freq, persistent=False)
+
+    @staticmethod
+    def rotate_half(x):
+        x1, x2 = x.chunk(2, dim=-1)
+        return torch.cat([-x2, x1], dim=-1)
+
+    def forward(self, inputs_embeds, *past):
+        seq_len = inputs_embeds.shape[1]
+        past_len = past[0].shape[0] if len(past) != 0 else 0
+        positions = torch.arange(past_len, past_len + seq_len, dtype=torch.float32)
+        freqs = positions[:, None] * self.inv_freq[None]
+        emb = torch.cat([freqs, freqs], dim=-1)
+        cos, sin = emb.cos()[None, None], emb.sin()[None, None]
+        hidden, present = inputs_embeds, []
+        for i, layer in enumerate(self.model.layers):
+            attn = layer.self_attn
+            x = layer.input_layernorm(hidden)
+            q = attn.q_proj(x).view(1, seq_len, self.num_heads, self.head_dim).transpose(1, 2)
+            k = attn.k_proj(x).view(1, seq_len, self.kv_heads, self.head_dim).transpose(1, 2)
+            v = attn.v_proj(x).view(1, seq_len, self.kv_heads, self.head_dim).transpose(1, 2)
+            q = q * cos + self.rotate_half(q) * sin
+            k = k * cos + self.rotate_half(k) * sin
+            present += [k[0].transpose(0, 1), v[0].transpose(0, 1)]
+            if len(past) != 0:
+                k = torch.cat([past[2 * i].transpose(0, 1)[None], k], dim=2)
+                v = torch.cat([past[2 * i + 1].transpose(0, 1)[None], v], dim=2)
+            k = k.repeat_interleave(self.num_heads // self.kv_heads, dim=1)
+            v = v.repeat_interleave(self.num_heads // self.kv_heads, dim=1)
+            # NOTE prefill attends causally within the prompt, a decode step attends to the whole past
+            out = F.scaled_dot_product_attention(q, k, v, is_causal=len(past) == 0)
+            hidden = hidden + attn.o_proj(out.transpose(1, 2).reshape(1, seq_len, -1))
+            hidden = hidden + layer.mlp(layer.post_attention_layernorm(hidden))
+        hidden = self.model.norm(hidden)
+        logp = self.llm_decoder(hidden[:, -1]).log_softmax(dim=-1)
+        return (logp, *present)
+
+
+def export(step, args, onnx_path, input_names, output_names, dynamic_axes):
+    torch.onnx.export(
+        step,
+        args,
+        onnx_path,
+        export_params=True,
+        opset_version=18,
+        do_constant_folding=True,
+        input_names=input_names,
+        output_names=output_names,
+        dynamic_axes=dynamic_axes
+    )
+
+
+def eager_tokens(llm, model_input, seed):
+    set_all_random_seed(seed)
+    return list(llm.inference(text=model_input['text'],
+                              text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32),
+                              prompt_text=model_input['prompt_text'],
+                              prompt_text_len=torch.tensor([model_input['prompt_text'].shape[1]], dtype=torch.int32),
+                              prompt_speech_token=model_input['llm_prompt_speech_token'],
+                              prompt_speech_token_len=torch.tensor([model_input['llm_prompt_speech_token'].shape[1]], dtype=torch.int32),
+                              embedding=model_input['llm_embedding']))
+
+
+@torch.no_grad()
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    assert torch.cuda.is_available() is False, 'the onnxruntime llm backend is cpu only, export on a cpu host'
+
+    model = AutoModel(model_dir=args.model_dir)
+    assert isinstance(model, CosyVoice2), 'onnx llm export targets the Qwen2 llm of CosyVoice2/CosyVoice3'
+    llm = model.model.llm
+    llm.eval()
+    step = Qwen2Step(llm)
+    num_layers, hidden_size = len(step.model.layers), llm.llm_input_size
+    kv_names = [['key_{}'.format(i), 'value_{}'.format(i)] for i in range(num_layers)]
+    kv_names = sum(kv_names, [])
+
+    # 1. export prefill, prompt embeddings in, last position log probs and the prompt kv cache out
+    prefill_path = '{}/llm.prefill.fp32.onnx'.format(args.model_dir)
+    export(step, (torch.rand(1, 16, hidden_size), ), prefill_path, ['inputs_embeds'], ['logp'] + kv_names,
+           dict({'inputs_embeds': {1: 'seq_len'}}, **{name: {0: 'seq_len'} for name in kv_names}))
+
+    # 2. export the decode step, one embedding and the past kv cache in, log probs and the kv of this position out
+    decode_path = '{}/llm.decode.fp32.onnx'.format(args.model_dir)
+    past = tuple(torch.rand(16, step.kv_heads, step.head_dim) for _ in kv_names)
+    export(step, (torch.rand(1, 1, hidden_size), ) + past, decode_path, ['inputs_embeds'] + ['past_' + name for name in kv_names],
+           ['logp'] + kv_names, {'past_' + name: {0: 'past_len'} for name in kv_names})
+
+    # 3. test computation consistency against the transformers forward and the tokens of eager decoding under a fixed seed
+    llm_onnx = OrtLLMWrapper(prefill_path, decode_path, intra_op_num_threads=torch.get_num_threads())
+    context = llm_onnx.acquire()
+    lm_input = torch.rand(1, 32, hidden_size)
+    hidden, cache = llm.llm.forward_one_step(lm_input, masks=torch.tril(torch.ones((1, 32, 32))).to(torch.bool))
+    torch.testing.assert_close(llm_onnx.prefill(context, lm_input), llm.llm_decoder(hidden[:, -1]).log_softmax(dim=-1), rtol=1e-3, atol=1e-3)
+    lm_input = torch.rand(1, 1, hidden_size)
+    hidden, cache = llm.llm.forward_one_step(lm_input, masks=torch.ones((1, 33, 33)).to(torch.bool), cache=cache)
+    torch.testing.assert_close(llm_onnx.decode(context, lm_input), llm.llm_decoder(hidden[:, -1]).log_softmax(dim=-1), rtol=1e-3, atol=1e-3)
+    llm_onnx.release(context)
+
+    prompt_text = args.prompt_text
+    if isinstance(model, CosyVoice3) and '<|endofprompt|>' not in prompt_text:
+        prompt_text = 'You are a helpful assistant.<|endofprompt|>' + prompt_text
+    for text in TEXTS:
+        model_input = model.frontend.frontend_zero_shot(text, prompt_text, args.prompt_wav, model.sample_rate, '')
+        start_time = time.perf_counter()
+        tokens = eager_tokens(llm, model_input, args.seed)
+        eager_seconds = time.perf_counter() - start_time
+        llm.onnx = llm_onnx
+        start_time = time.perf_counter()
+        onnx_tokens = eager_tokens(llm, model_input, args.seed)
+        onnx_seconds = time.perf_counter() - start_time
+        del llm.onnx
+        assert tokens == onnx_tokens, 'onnx llm decodes different tokens than eager, first mismatch at {}'.format(
+            next(i for i, (x, y) in enumerate(zip(tokens + [None], onnx_tokens + [None])) if x != y))
+        logging.info('{} tokens, torch {:.1f} tokens/s, onnxruntime {:.1f} tokens/s'.format(
+            len(tokens), len(tokens) / eager_seconds, len(tokens) / onnx_seconds))
+    logging.info('successfully export llm')
+
+
+if __name__ == "__main__":
+    main()
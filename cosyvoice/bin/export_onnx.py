@@ -22,12 +22,14 @@ import os
 import sys
 import onnxruntime
 import random
+import time
 import torch
 from tqdm import tqdm
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../..'.format(ROOT_DIR))
 sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
-from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.cli.cosyvoice import AutoModel, CosyVoice2
+from cosyvoice.utils.common import OrtEstimatorWrapper
 from cosyvoice.utils.file_utils import logging
 
 
@@ -41,37 +43,36 @@ def get_dummy_input(batch_size, seq_len, out_channels, device):
     return x, mask, mu, t, spks, cond
 
 
+class StreamingEstimator(torch.nn.Module):
+    """Traces the chunk masked attention of CausalConditionalDecoder / DiT, selected by a python flag in eager mode."""
+
+    def __init__(self, estimator):
+        super().__init__()
+        self.estimator = estimator
+
+    def forward(self, x, mask, mu, t, spks, cond):
+        return self.estimator(x, mask, mu, t, spks, cond, streaming=True)
+
+
 def get_args():
     parser = argparse.ArgumentParser(description='export your model for deployment')
     parser.add_argument('--model_dir',
                         type=str,
                         default='pretrained_models/CosyVoice-300M',
                         help='local path')
+    parser.add_argument('--benchmark_seq_lens', default='64,256,512', help='comma separated mel lengths of the cpu latency benchmark')
+    parser.add_argument('--benchmark_repeats', default=20, type=int, help='timed estimator calls per length')
     args = parser.parse_args()
     print(args)
     return args
 
 
-@torch.no_grad()
-def main():
-    args = get_args()
-    logging.basicConfig(level=logging.DEBUG,
-                        format='%(asctime)s %(levelname)s %(message)s')
-
-    model = AutoModel(model_dir=args.model_dir)
-
-    # 1. export flow decoder estimator
-    estimator = model.model.flow.decoder.estimator
-    estimator.eval()
-
-    device = model.model.device
-    batch_size, seq_len = 2, 256
-    out_channels = model.model.flow.decoder.estimator.out_channels
+def export_estimator(estimator, onnx_path, batch_size, seq_len, out_channels, device):
     x, mask, mu, t, spks, cond = get_dummy_input(batch_size, seq_len, out_channels, device)
     torch.onnx.export(
         estimator,
         (x, mask, mu, t, spks, cond),
-        '{}/flow.decoder.estimator.fp32.onnx'.format(args.model_dir),
+        onnx_path,
         export_params=True,
         opset_version=18,
         do_constant_folding=True,
@@ -86,13 +87,13 @@ def main():
         }
     )
 
-    # 2. test computation consistency
+
+def test_estimator(estimator, onnx_path, batch_size, out_channels, device):
     option = onnxruntime.SessionOptions()
     option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
     option.intra_op_num_threads = 1
     providers = ['CUDAExecutionProvider' if torch.cuda.is_available() else 'CPUExecutionProvider']
-    estimator_onnx = onnxruntime.InferenceSession('{}/flow.decoder.estimator.fp32.onnx'.format(args.model_dir),
-                                                  sess_options=option, providers=providers)
+    estimator_onnx = onnxruntime.InferenceSession(onnx_path, sess_options=option, providers=providers)
 
     for _ in tqdm(range(10)):
         x, mask, mu, t, spks, cond = get_dummy_input(batch_size, random.randint(16, 512), out_channels, device)
@@ -107,8 +108,57 @@ def main():
         }
         output_onnx = estimator_onnx.run(None, ort_inputs)[0]
         torch.testing.assert_allclose(output_pytorch, torch.from_numpy(output_onnx).to(device), rtol=1e-2, atol=1e-4)
+
+
+def benchmark_estimator(estimator, estimator_onnx, streaming, batch_size, out_channels, seq_lens, repeats):
+    """Latency of eager torch against the onnxruntime backend used by load_onnx, both on cpu with torch's thread count."""
+    for seq_len in seq_lens:
+        x, mask, mu, t, spks, cond = get_dummy_input(batch_size, seq_len, out_channels, 'cpu')
+        result = {}
+        for name, func in [('torch', lambda: estimator(x.clone(), mask, mu, t, spks, cond, streaming=streaming)),
+                           ('onnxruntime', lambda: estimator_onnx(x.clone(), mask, mu, t, spks, cond, streaming=streaming))]:
+            func()
+            start_time = time.perf_counter()
+            for _ in range(repeats):
+                func()
+            result[name] = (time.perf_counter() - start_time) / repeats * 1000
+        logging.info('estimator {} seq_len {}: torch {:.2f}ms, onnxruntime {:.2f}ms, speedup {:.2f}x'.format(
+            'streaming' if streaming else 'offline', seq_len, result['torch'], result['onnxruntime'], result['torch'] / result['onnxruntime']))
+
+
+@torch.no_grad()
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    model = AutoModel(model_dir=args.model_dir)
+
+    # 1. export flow decoder estimator, plus its chunk masked streaming graph for CosyVoice2/CosyVoice3
+    estimator = model.model.flow.decoder.estimator
+    estimator.eval()
+
+    device = model.model.device
+    batch_size, seq_len = 2, 256
+    out_channels = model.model.flow.decoder.estimator.out_channels
+    onnx_paths = {False: '{}/flow.decoder.estimator.fp32.onnx'.format(args.model_dir)}
+    if isinstance(model, CosyVoice2):
+        onnx_paths[True] = '{}/flow.decoder.estimator.streaming.fp32.onnx'.format(args.model_dir)
+    for streaming, onnx_path in onnx_paths.items():
+        export_estimator(StreamingEstimator(estimator) if streaming else estimator, onnx_path, batch_size, seq_len, out_channels, device)
+
+    # 2. test computation consistency
+    for streaming, onnx_path in onnx_paths.items():
+        test_estimator(StreamingEstimator(estimator) if streaming else estimator, onnx_path, batch_size, out_channels, device)
     logging.info('successfully export estimator')
 
+    # 3. cpu latency of the load_onnx backend against eager torch
+    if torch.cuda.is_available() is False:
+        seq_lens = [int(i) for i in args.benchmark_seq_lens.split(',')]
+        estimator_onnx = OrtEstimatorWrapper(onnx_paths[False], onnx_paths.get(True), intra_op_num_threads=torch.get_num_threads())
+        for streaming in onnx_paths:
+            benchmark_estimator(estimator, estimator_onnx, streaming, batch_size, out_channels, seq_lens, args.benchmark_repeats)
+
 
 if __name__ == "__main__":
     main()
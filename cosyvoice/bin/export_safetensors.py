@@ -0,0 +1,48 @@
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.startup import checkpoint_fingerprint
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='convert llm.pt / flow.pt / hift.pt to safetensors for faster, memory mapped loading')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/Fun-CosyVoice3-0.5B',
+                        help='local path')
+    parser.add_argument('--names', default='llm,flow,hift', help='comma separated checkpoints to convert')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    from safetensors.torch import save_file, load_file
+
+    for name in args.names.split(','):
+        pt_path, safetensors_path = '{}/{}.pt'.format(args.model_dir, name), '{}/{}.safetensors'.format(args.model_dir, name)
+        state_dict = torch.load(pt_path, map_location='cpu')
+        # NOTE safetensors refuses tensors sharing storage, clone gives every tensor its own
+        state_dict = {k: v.detach().clone().contiguous() for k, v in state_dict.items()}
+        # NOTE load_checkpoint only prefers this copy while the fingerprint matches the .pt
+        save_file(state_dict, safetensors_path, metadata={'source_fingerprint': checkpoint_fingerprint(pt_path)})
+        start_time = time.time()
+        loaded = load_file(safetensors_path)
+        assert loaded.keys() == state_dict.keys() and all(torch.equal(loaded[k], v) for k, v in state_dict.items()), \
+            '{} does not match {}'.format(safetensors_path, pt_path)
+        logging.info('export {} to {}, {:.1f}MB, reloaded in {:.2f}s'.format(pt_path, safetensors_path,
+                                                                            os.path.getsize(safetensors_path) / 1024 ** 2, time.time() - start_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.abspath('{}/../..'.format(ROOT_DIR))
+
+# NOTE seconds to import each entry point without loading a model, torch alone takes about a second
+DEFAULT_BUDGETS = {'api_server': 5.0, 'cosyvoice.cli.cosyvoice': 4.0}
+# heavy packages that must only be imported once a model is loaded or a feature is used
+DEFERRED_MODULES = ['whisper', 'onnxruntime', 'inflect', 'wetext', 'ttsfrd', 'transformers', 'modelscope', 'funasr',
+                    'torchaudio', 'matcha', 'tensorrt', 'vllm', 'cosyvoice.llm.llm', 'cosyvoice.flow.flow', 'cosyvoice.hifigan.generator']
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='report python -X importtime of the server entry points and check an import time budget')
+    parser.add_argument('modules', nargs='*', default=list(DEFAULT_BUDGETS), help='modules to import')
+    parser.add_argument('--top', default=25, type=int, help='number of slowest modules to report, by cumulative time')
+    parser.add_argument('--repeats', default=3, type=int, help='imports per module, the fastest one is reported')
+    parser.add_argument('--budget', action='append', default=[], help='module=seconds, overrides the default budget, may be repeated')
+    parser.add_argument('--check', action='store_true', help='exit 1 when a budget is exceeded or a deferred module is imported')
+    parser.add_argument('--output', default=None, help='write the json report to this file')
+    return parser.parse_args()
+
+
+def import_time(module):
+    """Import module in a fresh interpreter, returns {name: (self_us, cumulative_us)} parsed from -X importtime."""
+    env = dict(os.environ)
+    paths = [REPO_DIR, '{}/third_party/Matcha-TTS'.format(REPO_DIR)]
+    env['PYTHONPATH'] = os.pathsep.join(paths + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                            cwd=REPO_DIR, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError('import {} failed:\n{}'.format(module, result.stderr[-2000:]))
+    modules = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+def report_module(module, args):
+    runs = [import_time(module) for _ in range(args.repeats)]
+    # NOTE the first import warms the page cache, the fastest run is the least noisy
+    modules = min(runs, key=lambda x: x[module][1])
+    top = sorted(modules.items(), key=lambda x: x[1][1], reverse=True)[:args.top]
+    deferred = sorted(i for i in modules if i.split('.')[0] in DEFERRED_MODULES or i in DEFERRED_MODULES)
+    return {'seconds': round(modules[module][1] / 1e6, 3),
+            'modules': len(modules),
+            'top': [{'module': k, 'cumulative_ms': round(v[1] / 1e3, 1), 'self_ms': round(v[0] / 1e3, 1)} for k, v in top],
+            'deferred_imported': deferred}
+
+
+def main():
+    args = get_args()
+    budgets = dict(DEFAULT_BUDGETS)
+    for budget in args.budget:
+        module, seconds = budget.split('=')
+        budgets[module] = float(seconds)
+
+    report, failures = {}, []
+    for module in args.modules:
+        report[module] = result = report_module(module, args)
+        print('import {}: {:.2f}s, {} modules (budget {})'.format(module, result['seconds'], result['modules'], budgets.get(module, '-')))
+        for i in result['top']:
+            print('  {:>9.1f} ms {:>9.1f} ms  {}'.format(i['cumulative_ms'], i['self_ms'], i['module']))
+        if module in budgets and result['seconds'] > budgets[module]:
+            failures.append('{} took {:.2f}s, budget {:.2f}s'.format(module, result['seconds'], budgets[module]))
+        if len(result['deferred_imported']) != 0:
+            failures.append('{} imports deferred modules: {}'.format(module, ', '.join(result['deferred_imported'])))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'budgets': budgets, 'results': report}, f, indent=2)
+    for failure in failures:
+        print('FAIL {}'.format(failure))
+    sys.exit(1 if args.check and len(failures) != 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+from functools import partial
+import numpy as np
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.utils.common import nucleus_sampling, ras_sampling, fade_in_out, set_all_random_seed
+from cosyvoice.utils.mask import make_pad_mask, add_optional_chunk_mask
+from cosyvoice.utils.frontend_utils import split_paragraph, replace_blank
+
+ZH_TEXT = '收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。' * 4
+EN_TEXT = 'CosyVoice is undergoing a comprehensive upgrade, providing more accurate, stable, faster, and better voice generation capabilities. ' * 4
+
+
+def sampling_cases():
+    # NOTE one decoding step of CosyVoice3LM, speech_token_size + 200 logits
+    weighted_scores = torch.randn(6561 + 200).log_softmax(dim=0)
+    decoded_tokens = torch.randint(0, 6561, (200,)).tolist()
+    return {'nucleus_sampling': partial(nucleus_sampling, weighted_scores, top_p=0.8, top_k=25),
+            'ras_sampling': partial(ras_sampling, weighted_scores, decoded_tokens, 25)}
+
+
+def mask_cases():
+    lengths = torch.tensor([500, 480, 300, 120])
+    xs, masks = torch.randn(1, 500, 80), torch.ones(1, 1, 500, dtype=torch.bool)
+    return {'make_pad_mask': partial(make_pad_mask, lengths, 500),
+            'add_optional_chunk_mask_static': partial(add_optional_chunk_mask, xs, masks, False, False, 0, 50, -1),
+            'add_optional_chunk_mask_full': partial(add_optional_chunk_mask, xs, masks, False, False, 0, 0, -1)}
+
+
+def fade_cases():
+    # NOTE sizes of CosyVoice2Model, 8 mel frames of hift cache at 480 samples per frame
+    speech_window = np.hamming(2 * 8 * 480)
+    mel_window = np.hamming(2 * 34)
+    return {'fade_in_out_speech': partial(fade_in_out, torch.randn(1, 24000), torch.randn(1, 8 * 480), speech_window),
+            'fade_in_out_mel': partial(fade_in_out, torch.randn(1, 80, 200), torch.randn(1, 80, 34), mel_window)}
+
+
+def text_cases(tokenizer):
+    # NOTE without --tokenizer_path split_paragraph tokenizes by character, which keeps the splitting logic but not the tokenizer cost
+    tokenize = list if tokenizer is None else tokenizer.encode
+    cases = {'split_paragraph_zh': lambda: list(split_paragraph(ZH_TEXT, tokenize, 'zh', token_max_n=80, token_min_n=60, merge_len=20, comma_split=False)),
+             'split_paragraph_en': lambda: list(split_paragraph(EN_TEXT, tokenize, 'en', token_max_n=80, token_min_n=60, merge_len=20, comma_split=False)),
+             'replace_blank': partial(replace_blank, 'CosyVoice 是 一个 语音 合成 模型 , supports zero shot 以及 cross lingual 合成 。' * 4)}
+    if tokenizer is not None:
+        cases['tokenizer_encode_zh'] = partial(tokenizer.encode, ZH_TEXT)
+        cases['tokenizer_encode_en'] = partial(tokenizer.encode, EN_TEXT)
+    return cases
+
+
+def pcm_cases():
+    # NOTE audio_encoders only needs numpy / torch, importing api_server would load the model and the web stack
+    from audio_encoders import numpy_to_pcm_bytes
+    # NOTE one second of 24kHz audio, a typical streaming chunk
+    return {'numpy_to_pcm_bytes': partial(numpy_to_pcm_bytes, np.random.uniform(-1, 1, (1, 24000)).astype(np.float32))}
+
+
+def get_cases(args):
+    tokenizer = None
+    if args.tokenizer_path is not None:
+        from cosyvoice.tokenizer.tokenizer import CosyVoice2Tokenizer
+        tokenizer = CosyVoice2Tokenizer(args.tokenizer_path)
+    cases = {}
+    for group in [sampling_cases(), mask_cases(), fade_cases(), text_cases(tokenizer), pcm_cases()]:
+        cases.update(group)
+    if args.filter is not None:
+        cases = {k: v for k, v in cases.items() if args.filter in k}
+    return cases
+
+
+def measure(func, repeats, min_time):
+    # NOTE calibrate the number of calls per repeat so one repeat takes at least min_time, like timeit.autorange
+    func()
+    number = 1
+    while True:
+        start_time = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - start_time >= min_time:
+            break
+        number *= 2
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start_time) / number * 1e6)
+    return {'median_us': round(float(np.median(times)), 3), 'min_us': round(float(np.min(times)), 3),
+            'max_us': round(float(np.max(times)), 3), 'calls': number * repeats}
+
+
+def run(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    set_all_random_seed(args.seed)
+    results = {}
+    for name, func in get_cases(args).items():
+        results[name] = measure(func, args.repeats, args.min_time)
+        print('{:<34} {:>12.2f} us (min {:.2f})'.format(name, results[name]['median_us'], results[name]['min_us']), file=sys.stderr)
+    report = {'meta': {'torch': torch.__version__, 'threads': torch.get_num_threads(), 'platform': platform.platform(),
+                       'tokenizer': args.tokenizer_path is not None, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+              'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            return compare_reports(json.load(f), report, args.threshold)
+    return 0
+
+
+def compare_reports(baseline, current, threshold):
+    regressions = []
+    for name, result in sorted(current['results'].items()):
+        if name not in baseline['results']:
+            print('{:<34} {:>12.2f} us   (new)'.format(name, result['median_us']))
+            continue
+        before, after = baseline['results'][name]['median_us'], result['median_us']
+        change = after / before - 1
+        regressed = change > threshold
+        print('{:<34} {:>12.2f} -> {:>12.2f} us {:>+8.1%}{}'.format(name, before, after, change, '  REGRESSION' if regressed else ''))
+        if regressed:
+            regressions.append(name)
+    for name in sorted(set(baseline['results']) - set(current['results'])):
+        print('{:<34} missing from current run'.format(name))
+    if len(regressions) != 0:
+        print('{} case(s) slower than baseline by more than {:.0%}: {}'.format(len(regressions), threshold, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+def compare(args):
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+    with open(args.current, 'r') as f:
+        current = json.load(f)
+    return compare_reports(baseline, current, args.threshold)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='micro-benchmark hot helper functions and gate regressions against a baseline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='measure every case')
+    run_parser.add_argument('--output', default=None, help='json report, e.g. to store as a baseline')
+    run_parser.add_argument('--baseline', default=None, help='compare against this report and fail on regression')
+    run_parser.add_argument('--threshold', default=0.15, type=float, help='allowed relative slowdown of the median')
+    run_parser.add_argument('--filter', default=None, help='only run cases whose name contains this string')
+    run_parser.add_argument('--tokenizer_path', default=None, help='qwen tokenizer dir, enables CosyVoice2Tokenizer.encode cases')
+    run_parser.add_argument('--repeats', default=7, type=int, help='timed repeats per case')
+    run_parser.add_argument('--min_time', default=0.05, type=float, help='minimal seconds per repeat')
+    run_parser.add_argument('--threads', default=1, type=int, help='torch intra-op threads, 0 keeps the default')
+    run_parser.add_argument('--seed', default=0, type=int, help='seed of the random inputs')
+    compare_parser = subparsers.add_parser('compare', help='compare two reports and fail on regression')
+    compare_parser.add_argument('baseline', help='baseline json report')
+    compare_parser.add_argument('current', help='current json report')
+    compare_parser.add_argument('--threshold', default=0.15, type=float, help='allowed relative slowdown of the median')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    sys.exit(run(args) if args.command == 'run' else compare(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import numpy as np
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel, CosyVoice2
+from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.memory import tensor_bytes
+from cosyvoice.utils.metrics import RequestTimings
+from cosyvoice.utils.quantize import QUANTIZE_MODES, quantize_model, save_quantized
+
+DEFAULT_PROMPT_WAV = '{}/../../zero_shot_prompt.wav'.format(ROOT_DIR)
+DEFAULT_PROMPT_TEXT = '希望你以后能够做的比我还好呦。'
+CALIBRATION_TEXTS = ['收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。',
+                     '今天是2024年3月15日，气温18度，我们下午3点在会议室见面。',
+                     'CosyVoice is undergoing a comprehensive upgrade, providing more accurate, stable, faster, and better voice generation.']
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='quantize the llm and flow estimator for cpu inference, validate against fp32, benchmark and serialize')
+    parser.add_argument('--model_dir', default='pretrained_models/Fun-CosyVoice3-0.5B', help='local path')
+    parser.add_argument('--mode', default='int8', choices=QUANTIZE_MODES, help='int8: dynamic int8 everywhere, int4: weight only int4 llm backbone')
+    parser.add_argument('--exclude', default='', help='comma separated parts kept in float, among llm, llm_decoder, estimator')
+    parser.add_argument('--texts', default=None, help='text file, one calibration / validation sentence per line')
+    parser.add_argument('--prompt_wav', default=DEFAULT_PROMPT_WAV, help='prompt audio')
+    parser.add_argument('--prompt_text', default=DEFAULT_PROMPT_TEXT, help='transcript of the prompt audio')
+    parser.add_argument('--max_kl', default=0.05, type=float, help='maximal mean KL(fp32 || quantized) of the llm token distribution')
+    parser.add_argument('--min_top1', default=0.9, type=float, help='minimal top-1 agreement of the llm with fp32 on fp32 tokens')
+    parser.add_argument('--max_estimator_error', default=0.05, type=float, help='maximal relative L2 error of the flow estimator output')
+    parser.add_argument('--max_estimator_calls', default=64, type=int, help='estimator calls recorded for validation')
+    parser.add_argument('--output_dir', default=None, help='where the quantized checkpoints are written, default model_dir')
+    parser.add_argument('--force', action='store_true', help='save the checkpoints even if validation fails')
+    parser.add_argument('--no_save', action='store_true', help='only validate and benchmark')
+    parser.add_argument('--threads', default=0, type=int, help='torch intra-op threads, 0 keeps the default')
+    parser.add_argument('--seed', default=0, type=int, help='sampling seed')
+    parser.add_argument('--output', default=None, help='write the json report to this file')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+class Recorder:
+    """Records llm prompts with their decoded tokens and flow estimator calls of a synthesis, for offline comparison."""
+
+    def __init__(self, model, max_estimator_calls):
+        self.llm_calls, self.estimator_calls = [], []
+        self.max_estimator_calls = max_estimator_calls
+        self.llm = model.llm
+        self.inference_wrapper = self.llm.inference_wrapper
+        self.llm.inference_wrapper = self.record_llm
+        self.hook = model.flow.decoder.estimator.register_forward_hook(self.record_estimator, with_kwargs=True)
+
+    def record_llm(self, lm_input, *args, **kwargs):
+        record = {'lm_input': lm_input.clone(), 'tokens': []}
+        self.llm_calls.append(record)
+        for token in self.inference_wrapper(lm_input, *args, **kwargs):
+            record['tokens'].append(token)
+            yield token
+
+    def record_estimator(self, module, args, kwargs, output):
+        if len(self.estimator_calls) < self.max_estimator_calls:
+            clone = lambda x: x.clone() if isinstance(x, torch.Tensor) else x
+            self.estimator_calls.append(([clone(i) for i in args], {k: clone(v) for k, v in kwargs.items()}, output.clone()))
+
+    def remove(self):
+        self.llm.inference_wrapper = self.inference_wrapper
+        self.hook.remove()
+
+
+def teacher_forced_logp(llm, lm_input, tokens):
+    """Log probabilities of every decoding step given the recorded tokens, in a single forward pass."""
+    speech_emb = llm.speech_embedding.weight[torch.tensor(tokens, device=lm_input.device)].unsqueeze(0)
+    xs = torch.concat([lm_input, speech_emb], dim=1)
+    hidden, _ = llm.llm(xs, torch.tensor([xs.shape[1]], device=xs.device))
+    # NOTE the hidden state at position i predicts the token at i + 1
+    return llm.llm_decoder(hidden[:, lm_input.shape[1] - 1:-1]).log_softmax(dim=-1).squeeze(0).float()
+
+
+def synthesize(cosyvoice, model_inputs, seed):
+    sessions = []
+    for model_input in model_inputs:
+        set_all_random_seed(seed)
+        timings, num_samples = RequestTimings(), 0
+        start_time = time.perf_counter()
+        with timings.activate():
+            for output in cosyvoice.model.tts(**model_input, stream=False):
+                num_samples += output['tts_speech'].shape[1]
+        elapsed = time.perf_counter() - start_time
+        summary = timings.to_dict()
+        stages, info = summary['stages'], summary['info']
+        llm_ms = sum(stages[k]['total_ms'] for k in ['llm_prefill', 'llm_decode'] if k in stages)
+        sessions.append({'rtf': elapsed / (num_samples / cosyvoice.sample_rate),
+                         'llm_tokens_per_s': info.get('llm_tokens', 0) / llm_ms * 1000 if llm_ms > 0 else 0,
+                         'flow_ms_per_chunk': float(np.mean(stages['flow']['ms']))})
+    gc.collect()
+    return {'rtf': round(float(np.mean([i['rtf'] for i in sessions])), 4),
+            'llm_tokens_per_s': round(float(np.mean([i['llm_tokens_per_s'] for i in sessions])), 2),
+            'flow_ms_per_chunk': round(float(np.mean([i['flow_ms_per_chunk'] for i in sessions])), 2),
+            # NOTE weight bytes instead of rss, the fp32 weights replaced by quantization stay in the process rss
+            'weight_mb': round(sum(tensor_bytes(getattr(cosyvoice.model, k).state_dict()) for k in ['llm', 'flow', 'hift']) / 1024 ** 2, 1),
+            'llm_weight_mb': round(tensor_bytes(cosyvoice.model.llm.state_dict()) / 1024 ** 2, 1),
+            'flow_weight_mb': round(tensor_bytes(cosyvoice.model.flow.state_dict()) / 1024 ** 2, 1)}
+
+
+@torch.inference_mode()
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s %(message)s')
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    exclude = [i for i in args.exclude.split(',') if i != '']
+    cosyvoice = AutoModel(model_dir=args.model_dir)
+    assert isinstance(cosyvoice, CosyVoice2), 'quantization targets the Qwen2 llm of CosyVoice2/CosyVoice3'
+    prompt_text = cosyvoice.zero_shot_prompt_text(args.prompt_text)
+    texts = CALIBRATION_TEXTS
+    if args.texts is not None:
+        with open(args.texts, 'r', encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+    model_inputs = [cosyvoice.frontend.frontend_zero_shot(text, prompt_text, args.prompt_wav, cosyvoice.sample_rate, '') for text in texts]
+
+    # 1. fp32 reference: record llm prompts / tokens and estimator calls, then the reference outputs
+    synthesize(cosyvoice, model_inputs[:1], args.seed)
+    recorder = Recorder(cosyvoice.model, args.max_estimator_calls)
+    fp32 = synthesize(cosyvoice, model_inputs, args.seed)
+    recorder.remove()
+    reference_logp = [teacher_forced_logp(cosyvoice.model.llm, i['lm_input'], i['tokens']) for i in recorder.llm_calls]
+
+    # 2. quantize in place
+    start_time = time.perf_counter()
+    quantize_model(cosyvoice.model, args.mode, exclude)
+    quantize_seconds = time.perf_counter() - start_time
+
+    # 3. validate the quantized llm on the fp32 tokens and the estimator on the recorded inputs
+    kl, top1 = [], []
+    for record, logp in zip(recorder.llm_calls, reference_logp):
+        quantized_logp = teacher_forced_logp(cosyvoice.model.llm, record['lm_input'], record['tokens'])
+        kl.append(torch.sum(logp.exp() * (logp - quantized_logp), dim=-1).mean().item())
+        top1.append((logp.argmax(dim=-1) == quantized_logp.argmax(dim=-1)).float().mean().item())
+    estimator_error = []
+    for call_args, call_kwargs, output in recorder.estimator_calls:
+        quantized_output = cosyvoice.model.flow.decoder.estimator(*call_args, **call_kwargs)
+        estimator_error.append((torch.norm(quantized_output.float() - output.float()) / torch.norm(output.float())).item())
+    validation = {'llm_kl': round(float(np.mean(kl)), 5),
+                  'llm_top1': round(float(np.mean(top1)), 4),
+                  'estimator_rel_error': round(float(np.mean(estimator_error)), 5),
+                  'estimator_rel_error_max': round(float(np.max(estimator_error)), 5)}
+    failures = []
+    if validation['llm_kl'] > args.max_kl:
+        failures.append('llm KL {} > {}'.format(validation['llm_kl'], args.max_kl))
+    if validation['llm_top1'] < args.min_top1:
+        failures.append('llm top-1 agreement {} < {}'.format(validation['llm_top1'], args.min_top1))
+    if validation['estimator_rel_error'] > args.max_estimator_error:
+        failures.append('estimator relative error {} > {}'.format(validation['estimator_rel_error'], args.max_estimator_error))
+
+    # 4. benchmark against fp32
+    synthesize(cosyvoice, model_inputs[:1], args.seed)
+    quantized = synthesize(cosyvoice, model_inputs, args.seed)
+    report = {'model_dir': args.model_dir, 'mode': args.mode, 'exclude': exclude, 'texts': len(texts),
+              'quantize_seconds': round(quantize_seconds, 2), 'validation': validation, 'failures': failures,
+              'fp32': fp32, args.mode: quantized,
+              'speedup': {'llm_tokens_per_s': round(quantized['llm_tokens_per_s'] / fp32['llm_tokens_per_s'], 3),
+                          'flow_ms_per_chunk': round(fp32['flow_ms_per_chunk'] / quantized['flow_ms_per_chunk'], 3),
+                          'rtf': round(fp32['rtf'] / quantized['rtf'], 3)}}
+
+    # 5. serialize, loaded by CosyVoice2/CosyVoice3(quantize=mode) instead of quantizing at every start
+    if not args.no_save and (len(failures) == 0 or args.force):
+        output_dir = args.output_dir or args.model_dir
+        save_quantized(cosyvoice.model, output_dir, args.mode, exclude)
+        report['saved_to'] = output_dir
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    for failure in failures:
+        print('FAIL {}'.format(failure), file=sys.stderr)
+    sys.exit(1 if len(failures) != 0 else 0)
+
+
+if __name__ == '__main__':
+    main()
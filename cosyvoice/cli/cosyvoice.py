@@ -14,53 +14,129 @@
 import os
 import time
 from typing import Generator
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from hyperpyyaml import load_hyperpyyaml
-from modelscope import snapshot_download
 import torch
 from cosyvoice.cli.frontend import CosyVoiceFrontEnd
 from cosyvoice.cli.model import CosyVoiceModel, CosyVoice2Model, CosyVoice3Model
+from cosyvoice.cli.pipeline import Token2WavPool
 from cosyvoice.utils.file_utils import logging
-from cosyvoice.utils.class_utils import get_model_type
+from cosyvoice.utils.segment_cache import SegmentSplicer
+from cosyvoice.utils.metrics import RTF, current_timings
+from cosyvoice.utils.startup import startup_timer, skip_init_weights
+from cosyvoice.utils.thread_plan import thread_plan
+from cosyvoice.utils.quantize import quantize_model, prepare_quantized
+
+
+def snapshot_download(model_dir):
+    # NOTE modelscope is slow to import and only needed when the model is not local
+    from modelscope import snapshot_download
+    return snapshot_download(model_dir)
+
+
+def get_model_type(configs):
+    # NOTE class_utils imports every model definition (transformers, matcha), defer it to model loading
+    from cosyvoice.utils.class_utils import get_model_type
+    return get_model_type(configs)
+
+
+def use_cpu_bf16(dtype, quantize=None):
+    """Whether the llm and flow estimator run under cpu bf16 autocast, dtype is None / 'fp32' / 'bf16'"""
+    assert dtype in [None, 'fp32', 'bf16'], 'dtype should be fp32 or bf16, got {}'.format(dtype)
+    if dtype != 'bf16':
+        return False
+    if torch.cuda.is_available() is True:
+        logging.warning('bf16 autocast is cpu only, use fp16 on cuda, set dtype to fp32')
+        return False
+    if quantize is not None:
+        logging.warning('bf16 autocast does not apply to quantized layers, set dtype to fp32')
+        return False
+    if torch.ops.mkldnn._is_mkldnn_bf16_supported() is False:
+        logging.warning('cpu has no native bf16 (avx512_bf16 / amx), bf16 autocast may be slower than fp32')
+    return True
 
 
 class CosyVoice:
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, fp16=False, trt_concurrent=1, quantize=None, dtype=None, load_onnx=False, load_onnx_hift=False,
+                 load_onnx_llm=False, token2wav_workers=0, token2wav_cores=None):
+        assert load_onnx_llm is False, 'onnx llm decoding is only implemented for the Qwen2 llm of CosyVoice2/CosyVoice3'
+        assert token2wav_workers == 0, 'token2wav worker processes are only implemented for CosyVoice2/CosyVoice3'
         self.model_dir = model_dir
         self.fp16 = fp16
+        startup_timer.reset()
         if not os.path.exists(model_dir):
             model_dir = snapshot_download(model_dir)
         hyper_yaml_path = '{}/cosyvoice.yaml'.format(model_dir)
         if not os.path.exists(hyper_yaml_path):
             raise ValueError('{} not found!'.format(hyper_yaml_path))
-        with open(hyper_yaml_path, 'r') as f:
+        # NOTE every module is overwritten by the checkpoints below, skip the random init
+        with open(hyper_yaml_path, 'r') as f, startup_timer.phase('configs'), skip_init_weights():
             configs = load_hyperpyyaml(f)
         assert get_model_type(configs) == CosyVoiceModel, 'do not use {} for CosyVoice initialization!'.format(model_dir)
-        self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
-                                          configs['feat_extractor'],
-                                          '{}/campplus.onnx'.format(model_dir),
-                                          '{}/speech_tokenizer_v1.onnx'.format(model_dir),
-                                          '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+        # NOTE the frontend (onnx sessions, text normalizer) loads while the model weights are read
+        executor = ThreadPoolExecutor(max_workers=1)
+        frontend = executor.submit(startup_timer.wrap('frontend', CosyVoiceFrontEnd), configs['get_tokenizer'],
+                                   configs['feat_extractor'],
+                                   '{}/campplus.onnx'.format(model_dir),
+                                   '{}/speech_tokenizer_v1.onnx'.format(model_dir),
+                                   '{}/spk2info.pt'.format(model_dir),
+                                   configs['allowed_special'])
+        executor.shutdown(wait=False)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or fp16 is True):
             load_jit, load_trt, fp16 = False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/fp16 to False')
-        self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16)
-        self.model.load('{}/llm.pt'.format(model_dir),
-                        '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
+        if torch.cuda.is_available() is True and quantize is not None:
+            quantize = None
+            logging.warning('quantized inference is cpu only, set quantize to None')
+        if torch.cuda.is_available() is True and (load_onnx is True or load_onnx_hift is True):
+            load_onnx, load_onnx_hift = False, False
+            logging.warning('onnxruntime estimator / hift is cpu only, set load_onnx/load_onnx_hift to False')
+        bf16 = use_cpu_bf16(dtype, quantize)
+        self.dtype = 'bf16' if bf16 is True else 'fp32'
+        self.model = CosyVoiceModel(configs['llm'], configs['flow'], configs['hift'], fp16, bf16)
+        self.load_model(model_dir, quantize)
+        self.frontend = frontend.result()
         if load_jit:
-            self.model.load_jit('{}/llm.text_encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/llm.llm.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
+            with startup_timer.phase('jit'):
+                self.model.load_jit('{}/llm.text_encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
+                                    '{}/llm.llm.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
+                                    '{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
         if load_trt:
-            self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
-                                trt_concurrent,
-                                self.fp16)
+            with startup_timer.phase('trt'):
+                self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
+                                    '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                    trt_concurrent,
+                                    self.fp16)
+        if load_onnx:
+            with startup_timer.phase('onnx'):
+                self.model.load_onnx('{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                     None,
+                                     trt_concurrent)
+        if load_onnx_hift:
+            with startup_timer.phase('onnx_hift'):
+                self.model.load_onnx_hift('{}/hift.fp32.onnx'.format(model_dir), trt_concurrent)
         del configs
+        self.startup_timings = startup_timer.log()
+        self.thread_plan = thread_plan.log()
+
+    def load_model(self, model_dir, quantize=None):
+        llm_model, flow_model = '{}/llm.pt'.format(model_dir), '{}/flow.pt'.format(model_dir)
+        # NOTE serialized quantized checkpoints (cosyvoice/bin/quantize.py) skip the float load and the quantization
+        quantized_model = prepare_quantized(self.model, model_dir, quantize) if quantize is not None else None
+        if quantized_model is not None:
+            llm_model, flow_model = quantized_model
+        self.model.load(llm_model, flow_model, '{}/hift.pt'.format(model_dir))
+        if quantize is not None and quantized_model is None:
+            with startup_timer.phase('quantize'):
+                quantize_model(self.model, quantize)
+        self.quantize = quantize
+
+    def zero_shot_prompt_text(self, prompt_text):
+        """prompt_text as the llm of this model expects it in zero shot mode"""
+        return prompt_text
 
     def list_available_spks(self):
         spks = list(self.frontend.spk2info.keys())
@@ -77,152 +153,296 @@ class CosyVoice:
     def save_spkinfo(self):
         torch.save(self.frontend.spk2info, '{}/spk2info.pt'.format(self.model_dir))
 
-    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True):
+    def estimate_memory(self, tts_text, prompt_text='', prompt_speech_seconds=0, text_frontend=True):
+        """Rough upper bound of the peak bytes of one inference call, to reject oversized inputs before synthesis."""
+        text_len = len(self.frontend.tokenizer.encode(tts_text, allowed_special=self.frontend.allowed_special))
+        prompt_text_len = len(self.frontend.tokenizer.encode(prompt_text, allowed_special=self.frontend.allowed_special))
+        prompt_speech_token_len = int(prompt_speech_seconds * self.model.flow.input_frame_rate)
+        # NOTE with text_frontend the text is split into segments of about 80 tokens which are synthesized one after another,
+        # merging short tails can make a segment longer, so allow twice that
+        segment_len = min(text_len, 160) if text_frontend is True else text_len
+        session = self.model.estimate_session_bytes(segment_len, prompt_text_len, prompt_speech_token_len)
+        # the generated speech of all segments, held by callers which concatenate it
+        speech = int(text_len * 20 / self.model.flow.input_frame_rate * self.sample_rate) * 4
+        return session + speech
+
+    def inference_sft(self, tts_text, spk_id, stream=False, speed=1.0, text_frontend=True, cancel_event=None):
         for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+            if cancel_event is not None and cancel_event.is_set():
+                logging.info('synthesis cancelled, skip remaining text')
+                break
             model_input = self.frontend.frontend_sft(i, spk_id)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, cancel_event=cancel_event):
                 speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
+                RTF.observe((time.time() - start_time) / speech_len)
                 yield model_output
                 start_time = time.time()
 
-    def inference_zero_shot(self, tts_text, prompt_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+    def inference_zero_shot(self, tts_text, prompt_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True,
+                            segment_cache=None, seed=None, cancel_event=None):
         prompt_text = self.frontend.text_normalize(prompt_text, split=False, text_frontend=text_frontend)
+        # NOTE segments are only cacheable when the voice can be identified by spk_id or prompt wav path
+        voice = zero_shot_spk_id if zero_shot_spk_id != '' else prompt_wav
+        if segment_cache is not None and not isinstance(voice, str):
+            logging.warning('prompt_wav is not a path, segment cache is disabled for this request')
+            segment_cache = None
+        splicer = SegmentSplicer(self.sample_rate) if segment_cache is not None else None
         for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+            if cancel_event is not None and cancel_event.is_set():
+                logging.info('synthesis cancelled, skip remaining text')
+                break
             if (not isinstance(i, Generator)) and len(i) < 0.5 * len(prompt_text):
                 logging.warning('synthesis text {} too short than prompt text {}, this may lead to bad performance'.format(i, prompt_text))
+            cache_key = None
+            if segment_cache is not None and not isinstance(i, Generator):
+                cache_key = segment_cache.make_key('{}|{}'.format(voice, prompt_text), i, speed, seed)
+                cache_speech = segment_cache.get(cache_key)
+                if cache_speech is not None:
+                    logging.info('segment cache hit for text {}'.format(i))
+                    if current_timings() is not None:
+                        current_timings().incr('segment_cache_hits')
+                    splicer.start_segment()
+                    yield {'tts_speech': splicer.push(cache_speech)}
+                    continue
+            # NOTE every segment starts fresh generators seeded with seed (llm sampling, flow / hift noise), so that a
+            # segment's speech does not depend on which segments were cached or on concurrent sessions
             model_input = self.frontend.frontend_zero_shot(i, prompt_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            speech_list = []
+            if splicer is not None:
+                splicer.start_segment()
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, cancel_event=cancel_event, seed=seed):
                 speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
+                RTF.observe((time.time() - start_time) / speech_len)
+                if splicer is not None:
+                    speech_list.append(model_output['tts_speech'])
+                    model_output = {'tts_speech': splicer.push(model_output['tts_speech'])}
                 yield model_output
                 start_time = time.time()
+            # NOTE do not cache truncated speech of a cancelled segment
+            if cache_key is not None and len(speech_list) != 0 and (cancel_event is None or not cancel_event.is_set()):
+                segment_cache.put(cache_key, torch.concat(speech_list, dim=1))
+        if splicer is not None:
+            yield {'tts_speech': splicer.flush()}
 
-    def inference_cross_lingual(self, tts_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+    def inference_cross_lingual(self, tts_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, cancel_event=None):
         for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+            if cancel_event is not None and cancel_event.is_set():
+                logging.info('synthesis cancelled, skip remaining text')
+                break
             model_input = self.frontend.frontend_cross_lingual(i, prompt_wav, self.sample_rate, zero_shot_spk_id)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, cancel_event=cancel_event):
                 speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
+                RTF.observe((time.time() - start_time) / speech_len)
                 yield model_output
                 start_time = time.time()
 
-    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True):
+    def inference_instruct(self, tts_text, spk_id, instruct_text, stream=False, speed=1.0, text_frontend=True, cancel_event=None):
         assert isinstance(self.model, CosyVoiceModel), 'inference_instruct is only implemented for CosyVoice!'
         instruct_text = self.frontend.text_normalize(instruct_text, split=False, text_frontend=text_frontend)
         for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+            if cancel_event is not None and cancel_event.is_set():
+                logging.info('synthesis cancelled, skip remaining text')
+                break
             model_input = self.frontend.frontend_instruct(i, spk_id, instruct_text)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, cancel_event=cancel_event):
                 speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
+                RTF.observe((time.time() - start_time) / speech_len)
                 yield model_output
                 start_time = time.time()
 
-    def inference_vc(self, source_wav, prompt_wav, stream=False, speed=1.0):
+    def inference_vc(self, source_wav, prompt_wav, stream=False, speed=1.0, cancel_event=None):
         model_input = self.frontend.frontend_vc(source_wav, prompt_wav, self.sample_rate)
         start_time = time.time()
-        for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+        for model_output in self.model.tts(**model_input, stream=stream, speed=speed, cancel_event=cancel_event):
             speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
             logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
+            RTF.observe((time.time() - start_time) / speech_len)
             yield model_output
             start_time = time.time()
 
 
 class CosyVoice2(CosyVoice):
 
-    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_jit=False, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, quantize=None, dtype=None, load_onnx=False, load_onnx_hift=False, load_onnx_llm=False,
+                 token2wav_workers=0, token2wav_cores=None):
         self.model_dir = model_dir
         self.fp16 = fp16
+        startup_timer.reset()
         if not os.path.exists(model_dir):
             model_dir = snapshot_download(model_dir)
         hyper_yaml_path = '{}/cosyvoice2.yaml'.format(model_dir)
         if not os.path.exists(hyper_yaml_path):
             raise ValueError('{} not found!'.format(hyper_yaml_path))
-        with open(hyper_yaml_path, 'r') as f:
+        # NOTE every module is overwritten by the checkpoints below, skip the random init
+        with open(hyper_yaml_path, 'r') as f, startup_timer.phase('configs'), skip_init_weights():
             configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
         assert get_model_type(configs) == CosyVoice2Model, 'do not use {} for CosyVoice2 initialization!'.format(model_dir)
-        self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
-                                          configs['feat_extractor'],
-                                          '{}/campplus.onnx'.format(model_dir),
-                                          '{}/speech_tokenizer_v2.onnx'.format(model_dir),
-                                          '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+        # NOTE the frontend (onnx sessions, text normalizer) loads while the model weights are read
+        executor = ThreadPoolExecutor(max_workers=1)
+        frontend = executor.submit(startup_timer.wrap('frontend', CosyVoiceFrontEnd), configs['get_tokenizer'],
+                                   configs['feat_extractor'],
+                                   '{}/campplus.onnx'.format(model_dir),
+                                   '{}/speech_tokenizer_v2.onnx'.format(model_dir),
+                                   '{}/spk2info.pt'.format(model_dir),
+                                   configs['allowed_special'])
+        executor.shutdown(wait=False)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_jit is True or load_trt is True or load_vllm is True or fp16 is True):
             load_jit, load_trt, load_vllm, fp16 = False, False, False, False
             logging.warning('no cuda device, set load_jit/load_trt/load_vllm/fp16 to False')
-        self.model = CosyVoice2Model(configs['llm'], configs['flow'], configs['hift'], fp16)
-        self.model.load('{}/llm.pt'.format(model_dir),
-                        '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
+        if torch.cuda.is_available() is True and quantize is not None:
+            quantize = None
+            logging.warning('quantized inference is cpu only, set quantize to None')
+        if torch.cuda.is_available() is True and (load_onnx is True or load_onnx_hift is True or load_onnx_llm is True):
+            load_onnx, load_onnx_hift, load_onnx_llm = False, False, False
+            logging.warning('onnxruntime estimator / hift / llm is cpu only, set load_onnx/load_onnx_hift/load_onnx_llm to False')
+        bf16 = use_cpu_bf16(dtype, quantize)
+        self.dtype = 'bf16' if bf16 is True else 'fp32'
+        self.model = CosyVoice2Model(configs['llm'], configs['flow'], configs['hift'], fp16, bf16)
+        self.load_model(model_dir, quantize)
+        self.frontend = frontend.result()
         if load_vllm:
-            self.model.load_vllm('{}/vllm'.format(model_dir))
+            with startup_timer.phase('vllm'):
+                self.model.load_vllm('{}/vllm'.format(model_dir))
+        if load_onnx_llm:
+            assert load_vllm is False, 'load_onnx_llm and load_vllm both replace the llm decoding, choose one'
+            with startup_timer.phase('onnx_llm'):
+                self.model.load_onnx_llm('{}/llm.prefill.fp32.onnx'.format(model_dir), '{}/llm.decode.fp32.onnx'.format(model_dir))
         if load_jit:
-            self.model.load_jit('{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
+            with startup_timer.phase('jit'):
+                self.model.load_jit('{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'))
         if load_trt:
-            self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
-                                trt_concurrent,
-                                self.fp16)
+            with startup_timer.phase('trt'):
+                self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
+                                    '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                    trt_concurrent,
+                                    self.fp16)
+        if load_onnx:
+            with startup_timer.phase('onnx'):
+                self.model.load_onnx('{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                     '{}/flow.decoder.estimator.streaming.fp32.onnx'.format(model_dir),
+                                     trt_concurrent)
+        if load_onnx_hift:
+            with startup_timer.phase('onnx_hift'):
+                self.model.load_onnx_hift('{}/hift.fp32.onnx'.format(model_dir), trt_concurrent)
+        if token2wav_workers > 0:
+            # NOTE workers load the same flow / hift backends, the llm options only apply to this process
+            model_kwargs = dict(load_jit=load_jit, load_trt=load_trt, trt_concurrent=trt_concurrent, fp16=fp16, quantize=quantize, dtype=dtype,
+                                load_onnx=load_onnx, load_onnx_hift=load_onnx_hift)
+            with startup_timer.phase('token2wav_workers'):
+                self.model.load_token2wav_pool(Token2WavPool(model_dir, model_kwargs, token2wav_workers, cores=token2wav_cores,
+                                                             samples_per_token=self.sample_rate // self.model.flow.input_frame_rate))
         del configs
+        self.startup_timings = startup_timer.log()
+        self.thread_plan = thread_plan.log()
 
-    def inference_instruct2(self, tts_text, instruct_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True):
+    def inference_instruct2(self, tts_text, instruct_text, prompt_wav, zero_shot_spk_id='', stream=False, speed=1.0, text_frontend=True, cancel_event=None):
         for i in tqdm(self.frontend.text_normalize(tts_text, split=True, text_frontend=text_frontend)):
+            if cancel_event is not None and cancel_event.is_set():
+                logging.info('synthesis cancelled, skip remaining text')
+                break
             model_input = self.frontend.frontend_instruct2(i, instruct_text, prompt_wav, self.sample_rate, zero_shot_spk_id)
             start_time = time.time()
             logging.info('synthesis text {}'.format(i))
-            for model_output in self.model.tts(**model_input, stream=stream, speed=speed):
+            for model_output in self.model.tts(**model_input, stream=stream, speed=speed, cancel_event=cancel_event):
                 speech_len = model_output['tts_speech'].shape[1] / self.sample_rate
                 logging.info('yield speech len {}, rtf {}'.format(speech_len, (time.time() - start_time) / speech_len))
+                RTF.observe((time.time() - start_time) / speech_len)
                 yield model_output
                 start_time = time.time()
 
 
 class CosyVoice3(CosyVoice2):
 
-    def __init__(self, model_dir, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1):
+    def __init__(self, model_dir, load_trt=False, load_vllm=False, fp16=False, trt_concurrent=1, quantize=None, dtype=None, load_onnx=False, load_onnx_hift=False, load_onnx_llm=False,
+                 token2wav_workers=0, token2wav_cores=None):
         self.model_dir = model_dir
         self.fp16 = fp16
+        startup_timer.reset()
         if not os.path.exists(model_dir):
             model_dir = snapshot_download(model_dir)
         hyper_yaml_path = '{}/cosyvoice3.yaml'.format(model_dir)
         if not os.path.exists(hyper_yaml_path):
             raise ValueError('{} not found!'.format(hyper_yaml_path))
-        with open(hyper_yaml_path, 'r') as f:
+        # NOTE every module is overwritten by the checkpoints below, skip the random init
+        with open(hyper_yaml_path, 'r') as f, startup_timer.phase('configs'), skip_init_weights():
             configs = load_hyperpyyaml(f, overrides={'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
         assert get_model_type(configs) == CosyVoice3Model, 'do not use {} for CosyVoice3 initialization!'.format(model_dir)
-        self.frontend = CosyVoiceFrontEnd(configs['get_tokenizer'],
-                                          configs['feat_extractor'],
-                                          '{}/campplus.onnx'.format(model_dir),
-                                          '{}/speech_tokenizer_v3.onnx'.format(model_dir),
-                                          '{}/spk2info.pt'.format(model_dir),
-                                          configs['allowed_special'])
+        # NOTE the frontend (onnx sessions, text normalizer) loads while the model weights are read
+        executor = ThreadPoolExecutor(max_workers=1)
+        frontend = executor.submit(startup_timer.wrap('frontend', CosyVoiceFrontEnd), configs['get_tokenizer'],
+                                   configs['feat_extractor'],
+                                   '{}/campplus.onnx'.format(model_dir),
+                                   '{}/speech_tokenizer_v3.onnx'.format(model_dir),
+                                   '{}/spk2info.pt'.format(model_dir),
+                                   configs['allowed_special'])
+        executor.shutdown(wait=False)
         self.sample_rate = configs['sample_rate']
         if torch.cuda.is_available() is False and (load_trt is True or fp16 is True):
             load_trt, fp16 = False, False
             logging.warning('no cuda device, set load_trt/fp16 to False')
-        self.model = CosyVoice3Model(configs['llm'], configs['flow'], configs['hift'], fp16)
-        self.model.load('{}/llm.pt'.format(model_dir),
-                        '{}/flow.pt'.format(model_dir),
-                        '{}/hift.pt'.format(model_dir))
+        if torch.cuda.is_available() is True and quantize is not None:
+            quantize = None
+            logging.warning('quantized inference is cpu only, set quantize to None')
+        if torch.cuda.is_available() is True and (load_onnx is True or load_onnx_hift is True or load_onnx_llm is True):
+            load_onnx, load_onnx_hift, load_onnx_llm = False, False, False
+            logging.warning('onnxruntime estimator / hift / llm is cpu only, set load_onnx/load_onnx_hift/load_onnx_llm to False')
+        bf16 = use_cpu_bf16(dtype, quantize)
+        self.dtype = 'bf16' if bf16 is True else 'fp32'
+        self.model = CosyVoice3Model(configs['llm'], configs['flow'], configs['hift'], fp16, bf16)
+        self.load_model(model_dir, quantize)
+        self.frontend = frontend.result()
         if load_vllm:
-            self.model.load_vllm('{}/vllm'.format(model_dir))
+            with startup_timer.phase('vllm'):
+                self.model.load_vllm('{}/vllm'.format(model_dir))
+        if load_onnx_llm:
+            assert load_vllm is False, 'load_onnx_llm and load_vllm both replace the llm decoding, choose one'
+            with startup_timer.phase('onnx_llm'):
+                self.model.load_onnx_llm('{}/llm.prefill.fp32.onnx'.format(model_dir), '{}/llm.decode.fp32.onnx'.format(model_dir))
         if load_trt:
             if self.fp16 is True:
                 logging.warning('DiT tensorRT fp16 engine have some performance issue, use at caution!')
-            self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
-                                '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
-                                trt_concurrent,
-                                self.fp16)
+            with startup_timer.phase('trt'):
+                self.model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if self.fp16 is True else 'fp32'),
+                                    '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                    trt_concurrent,
+                                    self.fp16)
+        if load_onnx:
+            with startup_timer.phase('onnx'):
+                self.model.load_onnx('{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                                     '{}/flow.decoder.estimator.streaming.fp32.onnx'.format(model_dir),
+                                     trt_concurrent)
+        if load_onnx_hift:
+            with startup_timer.phase('onnx_hift'):
+                self.model.load_onnx_hift('{}/hift.fp32.onnx'.format(model_dir), trt_concurrent)
+        if token2wav_workers > 0:
+            # NOTE workers load the same flow / hift backends, the llm options only apply to this process
+            model_kwargs = dict(load_trt=load_trt, trt_concurrent=trt_concurrent, fp16=fp16, quantize=quantize, dtype=dtype,
+                                load_onnx=load_onnx, load_onnx_hift=load_onnx_hift)
+            with startup_timer.phase('token2wav_workers'):
+                self.model.load_token2wav_pool(Token2WavPool(model_dir, model_kwargs, token2wav_workers, cores=token2wav_cores,
+                                                             samples_per_token=self.sample_rate // self.model.flow.input_frame_rate))
         del configs
+        self.startup_timings = startup_timer.log()
+        self.thread_plan = thread_plan.log()
+
+    def zero_shot_prompt_text(self, prompt_text):
+        # NOTE CosyVoice3 is trained with the system prompt in front of the prompt text
+        if '<|endofprompt|>' not in prompt_text:
+            prompt_text = 'You are a helpful assistant.<|endofprompt|>' + prompt_text
+        return prompt_text
 
 
 def AutoModel(**kwargs):
@@ -12,27 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from typing import Generator
 import json
-import onnxruntime
 import torch
 import numpy as np
-import whisper
 from typing import Callable
-import torchaudio.compliance.kaldi as kaldi
-import torchaudio
 import os
 import re
-import inflect
-try:
-    import ttsfrd
-    use_ttsfrd = True
-except ImportError:
-    print("failed to import ttsfrd, use wetext instead")
-    from wetext import Normalizer as ZhNormalizer
-    from wetext import Normalizer as EnNormalizer
-    use_ttsfrd = False
 from cosyvoice.utils.file_utils import logging, load_wav
+from cosyvoice.utils.metrics import timed, current_timings, FRONTEND_SECONDS
+from cosyvoice.utils.startup import startup_timer
+from cosyvoice.utils.thread_plan import thread_plan
 from cosyvoice.utils.frontend_utils import contains_chinese, replace_blank, replace_corner_mark, remove_bracket, spell_out_number, split_paragraph, is_only_punctuation
 
 
@@ -45,22 +36,43 @@ class CosyVoiceFrontEnd:
                  speech_tokenizer_model: str,
                  spk2info: str = '',
                  allowed_special: str = 'all'):
-        self.tokenizer = get_tokenizer()
+        # NOTE heavy dependencies (onnxruntime, whisper, text normalizers) are imported on first use, keeping `import cosyvoice` cheap
+        import onnxruntime
         self.feat_extractor = feat_extractor
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         option = onnxruntime.SessionOptions()
         option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
         option.intra_op_num_threads = 1
-        self.campplus_session = onnxruntime.InferenceSession(campplus_model, sess_options=option, providers=["CPUExecutionProvider"])
-        self.speech_tokenizer_session = onnxruntime.InferenceSession(speech_tokenizer_model, sess_options=option,
-                                                                     providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
-                                                                                "CPUExecutionProvider"])
+        thread_plan.apply_ort(option, 'frontend')
+        # NOTE onnx session creation and normalizer grammar loading are independent and mostly outside the gil
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            tokenizer = executor.submit(startup_timer.wrap('frontend.tokenizer', get_tokenizer))
+            campplus_session = executor.submit(startup_timer.wrap('frontend.campplus', onnxruntime.InferenceSession),
+                                               campplus_model, sess_options=option, providers=["CPUExecutionProvider"])
+            speech_tokenizer_session = executor.submit(startup_timer.wrap('frontend.speech_tokenizer', onnxruntime.InferenceSession),
+                                                       speech_tokenizer_model, sess_options=option,
+                                                       providers=["CUDAExecutionProvider" if torch.cuda.is_available() else
+                                                                  "CPUExecutionProvider"])
+            normalizer = executor.submit(startup_timer.wrap('frontend.normalizer', self._init_normalizer))
+            self.tokenizer = tokenizer.result()
+            self.campplus_session = campplus_session.result()
+            self.speech_tokenizer_session = speech_tokenizer_session.result()
+            normalizer.result()
         if os.path.exists(spk2info):
             self.spk2info = torch.load(spk2info, map_location=self.device)
         else:
             self.spk2info = {}
         self.allowed_special = allowed_special
-        self.use_ttsfrd = use_ttsfrd
+        # NOTE optional PromptCache of zero shot prompt features, set by the caller (see cache_manager.get_prompt_cache)
+        self.prompt_cache = None
+
+    def _init_normalizer(self):
+        try:
+            import ttsfrd
+            self.use_ttsfrd = True
+        except ImportError:
+            print("failed to import ttsfrd, use wetext instead")
+            self.use_ttsfrd = False
         if self.use_ttsfrd:
             self.frd = ttsfrd.TtsFrontendEngine()
             ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -68,6 +80,9 @@ class CosyVoiceFrontEnd:
                 'failed to initialize ttsfrd resource'
             self.frd.set_lang_type('pinyinvg')
         else:
+            import inflect
+            from wetext import Normalizer as ZhNormalizer
+            from wetext import Normalizer as EnNormalizer
             self.zh_tn_model = ZhNormalizer(remove_erhua=False)
             self.en_tn_model = EnNormalizer()
             self.inflect_parser = inflect.engine()
@@ -89,7 +104,9 @@ class CosyVoiceFrontEnd:
             for i in range(text_token.shape[1]):
                 yield text_token[:, i: i + 1]
 
+    @timed(FRONTEND_SECONDS.labels(stage='speech_token'), stage='speech_token')
     def _extract_speech_token(self, prompt_wav):
+        import whisper
         speech = load_wav(prompt_wav, 16000)
         assert speech.shape[1] / 16000 <= 30, 'do not support extract speech token for audio longer than 30s'
         feat = whisper.log_mel_spectrogram(speech, n_mels=128)
@@ -102,8 +119,10 @@ class CosyVoiceFrontEnd:
         speech_token_len = torch.tensor([speech_token.shape[1]], dtype=torch.int32).to(self.device)
         return speech_token, speech_token_len
 
+    @timed(FRONTEND_SECONDS.labels(stage='spk_embedding'), stage='spk_embedding')
     def _extract_spk_embedding(self, prompt_wav):
         speech = load_wav(prompt_wav, 16000)
+        import torchaudio.compliance.kaldi as kaldi
         feat = kaldi.fbank(speech,
                            num_mel_bins=80,
                            dither=0,
@@ -114,6 +133,7 @@ class CosyVoiceFrontEnd:
         embedding = torch.tensor([embedding]).to(self.device)
         return embedding
 
+    @timed(FRONTEND_SECONDS.labels(stage='speech_feat'), stage='speech_feat')
     def _extract_speech_feat(self, prompt_wav):
         speech = load_wav(prompt_wav, 24000)
         speech_feat = self.feat_extractor(speech).squeeze(dim=0).transpose(0, 1).to(self.device)
@@ -121,6 +141,7 @@ class CosyVoiceFrontEnd:
         speech_feat_len = torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(self.device)
         return speech_feat, speech_feat_len
 
+    @timed(FRONTEND_SECONDS.labels(stage='text_normalize'), stage='text_normalize')
     def text_normalize(self, text, split=True, text_frontend=True):
         if isinstance(text, Generator):
             logging.info('get tts_text generator, will skip text_normalize!')
@@ -163,26 +184,40 @@ class CosyVoiceFrontEnd:
     def frontend_zero_shot(self, tts_text, prompt_text, prompt_wav, resample_rate, zero_shot_spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
         if zero_shot_spk_id == '':
-            prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
-            speech_feat, speech_feat_len = self._extract_speech_feat(prompt_wav)
-            speech_token, speech_token_len = self._extract_speech_token(prompt_wav)
-            if resample_rate == 24000:
-                # cosyvoice2, force speech_feat % speech_token = 2
-                token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
-                speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
-                speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
-            embedding = self._extract_spk_embedding(prompt_wav)
-            model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
-                           'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
-                           'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
-                           'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
-                           'llm_embedding': embedding, 'flow_embedding': embedding}
+            model_input, prompt_source = self._extract_zero_shot_prompt(prompt_text, prompt_wav, resample_rate)
         else:
-            model_input = self.spk2info[zero_shot_spk_id]
+            model_input, prompt_source = self.spk2info[zero_shot_spk_id], 'spk2info'
+        if current_timings() is not None:
+            current_timings().set('prompt_source', prompt_source)
         model_input['text'] = tts_text_token
         model_input['text_len'] = tts_text_token_len
         return model_input
 
+    def _extract_zero_shot_prompt(self, prompt_text, prompt_wav, resample_rate):
+        key = None
+        if self.prompt_cache is not None and isinstance(prompt_wav, str):
+            key = self.prompt_cache.make_key(prompt_wav, prompt_text, resample_rate)
+            model_input = self.prompt_cache.get(key)
+            if model_input is not None:
+                return model_input, 'cache'
+        prompt_text_token, prompt_text_token_len = self._extract_text_token(prompt_text)
+        speech_feat, speech_feat_len = self._extract_speech_feat(prompt_wav)
+        speech_token, speech_token_len = self._extract_speech_token(prompt_wav)
+        if resample_rate == 24000:
+            # cosyvoice2, force speech_feat % speech_token = 2
+            token_len = min(int(speech_feat.shape[1] / 2), speech_token.shape[1])
+            speech_feat, speech_feat_len[:] = speech_feat[:, :2 * token_len], 2 * token_len
+            speech_token, speech_token_len[:] = speech_token[:, :token_len], token_len
+        embedding = self._extract_spk_embedding(prompt_wav)
+        model_input = {'prompt_text': prompt_text_token, 'prompt_text_len': prompt_text_token_len,
+                       'llm_prompt_speech_token': speech_token, 'llm_prompt_speech_token_len': speech_token_len,
+                       'flow_prompt_speech_token': speech_token, 'flow_prompt_speech_token_len': speech_token_len,
+                       'prompt_speech_feat': speech_feat, 'prompt_speech_feat_len': speech_feat_len,
+                       'llm_embedding': embedding, 'flow_embedding': embedding}
+        if key is not None:
+            self.prompt_cache.put(key, model_input)
+        return model_input, 'extracted'
+
     def frontend_cross_lingual(self, tts_text, prompt_wav, resample_rate, zero_shot_spk_id):
         model_input = self.frontend_zero_shot(tts_text, '', prompt_wav, resample_rate, zero_shot_spk_id)
         # in cross lingual mode, we remove prompt in llm
@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import sys
 from typing import Generator
 import torch
 import numpy as np
@@ -20,10 +21,25 @@ import threading
 import time
 from torch.nn import functional as F
 from contextlib import nullcontext
+from functools import wraps
 import uuid
-from cosyvoice.utils.common import fade_in_out
-from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
-from cosyvoice.utils.common import TrtContextWrapper
+from concurrent.futures import ThreadPoolExecutor
+from cosyvoice.utils.common import fade_in_out, SessionRNG
+from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm, logging
+from cosyvoice.utils.common import TrtContextWrapper, OrtEstimatorWrapper, OrtHiFTWrapper, OrtLLMWrapper
+from cosyvoice.utils.metrics import timer, current_timings, FLOW_SECONDS, HIFT_SECONDS, LLM_TTFT_SECONDS, LLM_TOKENS_PER_SECOND, INFLIGHT_SESSIONS, TOKEN_BUFFER_DEPTH
+from cosyvoice.utils.memory import memory_stats, tensor_bytes
+from cosyvoice.utils.startup import startup_timer, load_checkpoint
+from cosyvoice.utils.thread_plan import thread_plan
+
+
+def session_rng(token2wav):
+    """Activate the SessionRNG of the uuid session on the calling thread, flow / hift noise of token2wav is drawn from it"""
+    @wraps(token2wav)
+    def wrapper(self, *args, **kwargs):
+        with self.rng_dict.get(kwargs['uuid'], SessionRNG()).activate():
+            return token2wav(self, *args, **kwargs)
+    return wrapper
 
 
 class CosyVoiceModel:
@@ -32,12 +48,14 @@ class CosyVoiceModel:
                  llm: torch.nn.Module,
                  flow: torch.nn.Module,
                  hift: torch.nn.Module,
-                 fp16: bool = False):
+                 fp16: bool = False,
+                 bf16: bool = False):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.llm = llm
         self.flow = flow
         self.hift = hift
         self.fp16 = fp16
+        self.bf16 = bf16
         self.token_min_hop_len = 2 * self.flow.input_frame_rate
         self.token_max_hop_len = 4 * self.flow.input_frame_rate
         self.token_overlap_len = 20
@@ -60,16 +78,27 @@ class CosyVoiceModel:
         self.mel_overlap_dict = {}
         self.flow_cache_dict = {}
         self.hift_cache_dict = {}
+        self.cancel_dict = {}
+        self.rng_dict = {}
+        self.llm_context_len_dict = {}
 
     def load(self, llm_model, flow_model, hift_model):
-        self.llm.load_state_dict(torch.load(llm_model, map_location=self.device), strict=True)
-        self.llm.to(self.device).eval()
-        self.flow.load_state_dict(torch.load(flow_model, map_location=self.device), strict=True)
-        self.flow.to(self.device).eval()
-        # in case hift_model is a hifigan model
-        hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(hift_model, map_location=self.device).items()}
-        self.hift.load_state_dict(hift_state_dict, strict=True)
-        self.hift.to(self.device).eval()
+        def load_module(module, model_path, rename=None):
+            state_dict = load_checkpoint(model_path, self.device)
+            if rename is not None:
+                state_dict = {rename(k): v for k, v in state_dict.items()}
+            module.load_state_dict(state_dict, strict=True)
+            module.to(self.device).eval()
+        # NOTE modules are independent, torch.load and the copies into parameters release the gil
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            futures = [executor.submit(startup_timer.wrap('flow', load_module), self.flow, flow_model),
+                       # in case hift_model is a hifigan model
+                       executor.submit(startup_timer.wrap('hift', load_module), self.hift, hift_model, lambda k: k.replace('generator.', ''))]
+            # NOTE token2wav worker processes are built without llm
+            if self.llm is not None:
+                futures.append(executor.submit(startup_timer.wrap('llm', load_module), self.llm, llm_model))
+            for future in futures:
+                future.result()
 
     def load_jit(self, llm_text_encoder_model, llm_llm_model, flow_encoder_model):
         llm_text_encoder = torch.jit.load(llm_text_encoder_model, map_location=self.device)
@@ -90,6 +119,27 @@ class CosyVoiceModel:
         assert estimator_engine is not None, 'failed to load trt {}'.format(flow_decoder_estimator_model)
         self.flow.decoder.estimator = TrtContextWrapper(estimator_engine, trt_concurrent=trt_concurrent, device=self.device)
 
+    def load_onnx(self, flow_decoder_onnx_model, flow_decoder_streaming_onnx_model, ort_concurrent):
+        assert os.path.exists(flow_decoder_onnx_model), '{} not found, export it with cosyvoice/bin/export_onnx.py'.format(flow_decoder_onnx_model)
+        if flow_decoder_streaming_onnx_model is not None and not os.path.exists(flow_decoder_streaming_onnx_model):
+            logging.warning('{} not found, streaming chunks use the offline estimator graph'.format(flow_decoder_streaming_onnx_model))
+            flow_decoder_streaming_onnx_model = None
+        del self.flow.decoder.estimator
+        # NOTE onnxruntime uses the intra op threads the thread plan gives the torch stage, it replaces torch compute, not adds to it
+        self.flow.decoder.estimator = OrtEstimatorWrapper(flow_decoder_onnx_model, flow_decoder_streaming_onnx_model,
+                                                          ort_concurrent=ort_concurrent, intra_op_num_threads=thread_plan.threads('flow'), stage='flow')
+
+    def load_onnx_hift(self, hift_onnx_model, ort_concurrent):
+        assert os.path.exists(hift_onnx_model), '{} not found, export it with cosyvoice/bin/export_hift_onnx.py'.format(hift_onnx_model)
+        # NOTE only the conv body moves to onnxruntime, the f0 predictor, sine source and istft stay in torch
+        self.hift.onnx_body = OrtHiFTWrapper(hift_onnx_model, ort_concurrent=ort_concurrent, intra_op_num_threads=thread_plan.threads('hift'), stage='hift')
+
+    def autocast(self, enabled=True):
+        """fp16 autocast on cuda, or bf16 autocast on cpu when built with bf16=True"""
+        if self.bf16 is True:
+            return torch.autocast('cpu', dtype=torch.bfloat16, enabled=enabled)
+        return torch.cuda.amp.autocast(self.fp16 is True and enabled)
+
     def get_trt_kwargs(self):
         min_shape = [(2, 80, 4), (2, 1, 4), (2, 80, 4), (2, 80, 4)]
         opt_shape = [(2, 80, 500), (2, 1, 500), (2, 80, 500), (2, 80, 500)]
@@ -97,35 +147,121 @@ class CosyVoiceModel:
         input_names = ["x", "mask", "mu", "cond"]
         return {'min_shape': min_shape, 'opt_shape': opt_shape, 'max_shape': max_shape, 'input_names': input_names}
 
-    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
-        with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
+    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid, timings=None, seed=None):
+        # NOTE number of positions in the llm kv cache, used for per session memory accounting
+        self.llm_context_len_dict[uuid] = prompt_text.shape[1] + llm_prompt_speech_token.shape[1] + (0 if isinstance(text, Generator) else text.shape[1])
+        with self.llm_context, self.autocast(hasattr(self.llm, 'vllm') is False), memory_stats.sample('llm'), thread_plan.stage('llm'), \
+                SessionRNG(seed).activate():
             if isinstance(text, Generator):
-                assert isinstance(self, CosyVoice2Model) and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2 and do not support vllm!'
-                for i in self.llm.inference_bistream(text=text,
+                assert isinstance(self, CosyVoice2Model) and not hasattr(self.llm, 'vllm') and not hasattr(self.llm, 'onnx'), 'streaming input text is only implemented for CosyVoice2/CosyVoice3 and do not support vllm/onnx llm!'
+                tokens = self.llm.inference_bistream(text=text,
                                                      prompt_text=prompt_text.to(self.device),
                                                      prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
                                                      prompt_speech_token=llm_prompt_speech_token.to(self.device),
                                                      prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                     embedding=llm_embedding.to(self.device)):
-                    self.tts_speech_token_dict[uuid].append(i)
+                                                     embedding=llm_embedding.to(self.device),
+                                                     cancel_event=self.cancel_dict[uuid])
             else:
-                for i in self.llm.inference(text=text.to(self.device),
+                tokens = self.llm.inference(text=text.to(self.device),
                                             text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
                                             prompt_text=prompt_text.to(self.device),
                                             prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
                                             prompt_speech_token=llm_prompt_speech_token.to(self.device),
                                             prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
                                             embedding=llm_embedding.to(self.device),
-                                            uuid=uuid):
-                    self.tts_speech_token_dict[uuid].append(i)
+                                            uuid=uuid,
+                                            cancel_event=self.cancel_dict[uuid])
+            start_time, num_tokens = time.time(), 0
+            for i in tokens:
+                if num_tokens == 0:
+                    first_token_time = time.time()
+                    LLM_TTFT_SECONDS.observe(first_token_time - start_time)
+                num_tokens += 1
+                self.tts_speech_token_dict[uuid].append(i)
+                self.llm_context_len_dict[uuid] += 1
+            if num_tokens != 0:
+                LLM_TOKENS_PER_SECOND.observe(num_tokens / (time.time() - start_time))
+                # NOTE prefill is approximated by time to first token, decode is the remaining time
+                if timings is not None:
+                    timings.add('llm_prefill', first_token_time - start_time)
+                    timings.add('llm_decode', time.time() - first_token_time)
+                    timings.incr('llm_tokens', num_tokens)
         self.llm_end_dict[uuid] = True
 
     def vc_job(self, source_speech_token, uuid):
         self.tts_speech_token_dict[uuid] = source_speech_token.flatten().tolist()
         self.llm_end_dict[uuid] = True
 
+    def kv_bytes_per_token(self):
+        # NOTE vllm manages its own kv cache, the preallocated onnx llm contexts are counted by kv_cache_bytes
+        if hasattr(self.llm, 'vllm') or hasattr(self.llm, 'onnx'):
+            return 0
+        llm = self.llm.llm
+        element_size = 2 if self.fp16 is True or self.bf16 is True else next(self.llm.parameters()).element_size()
+        if hasattr(llm, 'model') and hasattr(llm.model, 'config'):
+            config = llm.model.config
+            head_dim = getattr(config, 'head_dim', None) or config.hidden_size // config.num_attention_heads
+            return 2 * config.num_hidden_layers * config.num_key_value_heads * head_dim * element_size
+        if hasattr(llm, 'encoders'):
+            return 2 * len(llm.encoders) * llm.output_size() * element_size
+        # NOTE jit exported llm, layer layout is not inspectable
+        return 0
+
+    def kv_cache_bytes(self, context_len):
+        # NOTE the onnx llm holds a whole preallocated context per decoding session, whatever its length
+        if hasattr(self.llm, 'onnx'):
+            return self.llm.onnx.context_bytes if context_len > 0 else 0
+        return context_len * self.kv_bytes_per_token()
+
+    def session_memory(self, uuid):
+        speech_token = self.tts_speech_token_dict.get(uuid, [])
+        memory = {'speech_token': sys.getsizeof(speech_token) + len(speech_token) * sys.getsizeof(4096),
+                  'llm_kv_cache': self.kv_cache_bytes(self.llm_context_len_dict.get(uuid, 0))}
+        for name in ['flow_cache', 'mel_overlap', 'hift_cache']:
+            if hasattr(self, '{}_dict'.format(name)):
+                memory[name] = tensor_bytes(getattr(self, '{}_dict'.format(name)).get(uuid))
+        memory['total'] = sum(memory.values())
+        return memory
+
+    def log_session_memory(self, uuid, timings=None):
+        # NOTE called before the session variables are released, when token buffer and kv cache are at their largest
+        memory = self.session_memory(uuid)
+        logging.info('session {} memory {}'.format(uuid, ', '.join('{} {:.2f}MB'.format(k, v / 2 ** 20) for k, v in memory.items())))
+        if timings is not None:
+            timings.peak('peak_session_mb', round(memory['total'] / 2 ** 20, 2))
+
+    def sessions_memory(self):
+        """Bytes held by every live tts session, the transient flow/hift activations are covered by memory_stats instead."""
+        with self.lock:
+            uuids = list(self.tts_speech_token_dict.keys())
+        return {uuid: self.session_memory(uuid) for uuid in uuids}
+
+    def estimate_session_bytes(self, text_len, prompt_text_len=0, prompt_speech_token_len=0, max_token_text_ratio=20):
+        """Rough upper bound of the memory one tts session needs, used to reject oversized inputs before synthesis."""
+        max_token = int(text_len * max_token_text_ratio)
+        kv_cache = self.kv_cache_bytes(prompt_text_len + text_len + prompt_speech_token_len + max_token)
+        seconds = (prompt_speech_token_len + max_token) / self.flow.input_frame_rate
+        mel_len = int(seconds * self.hift.sampling_rate / self.hift.f0_upsamp.scale_factor)
+        # NOTE flow decoder runs x/mu/cond/output with cfg batch 2 and, without streaming, full attention over the whole mel,
+        # counted with 8 heads; hift keeps the source excitation and speech at sample rate
+        flow = 2 * 4 * 80 * mel_len * 4 + 2 * 8 * mel_len ** 2 * 4
+        hift = 2 * int(seconds * self.hift.sampling_rate) * 4
+        return kv_cache + flow + hift
+
+    def is_cancelled(self, uuid, cancel_event=None):
+        # propagate caller cancel_event to the per-session flag which llm_job checks every decoding step
+        if cancel_event is not None and cancel_event.is_set():
+            self.cancel_dict[uuid].set()
+        return self.cancel_dict[uuid].is_set()
+
+    def wait_llm_job(self, p, uuid, cancel_event=None):
+        while p.is_alive():
+            p.join(0.1)
+            self.is_cancelled(uuid, cancel_event)
+
+    @session_rng
     def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
-        with torch.cuda.amp.autocast(self.fp16):
+        with self.autocast(), timer(FLOW_SECONDS, sync=True, stage='flow'), thread_plan.stage('flow'):
             tts_mel, self.flow_cache_dict[uuid] = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
                                                                       token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
                                                                       prompt_token=prompt_token.to(self.device),
@@ -148,7 +284,8 @@ class CosyVoiceModel:
         if finalize is False:
             self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
             tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with timer(HIFT_SECONDS, sync=True, stage='hift'), thread_plan.stage('hift'):
+                tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
             self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
@@ -159,7 +296,8 @@ class CosyVoiceModel:
             if speed != 1.0:
                 assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with timer(HIFT_SECONDS, sync=True, stage='hift'), thread_plan.stage('hift'):
+                tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
         return tts_speech
@@ -168,67 +306,96 @@ class CosyVoiceModel:
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0,
+            cancel_event=None, seed=None, **kwargs):
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
+        timings = current_timings()
+        if timings is not None:
+            timings.incr('segments')
         with self.lock:
             self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
             self.hift_cache_dict[this_uuid] = None
             self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
             self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
+            self.cancel_dict[this_uuid] = threading.Event()
+            # NOTE flow / hift noise of the session, kept apart from the llm generators of llm_job so the two threads do not interleave draws
+            self.rng_dict[this_uuid] = SessionRNG(seed)
         if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
+            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid, timings, seed))
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
         p.start()
-        if stream is True:
-            token_hop_len = self.token_min_hop_len
-            while True:
-                time.sleep(0.1)
-                if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
-                        .unsqueeze(dim=0)
+        INFLIGHT_SESSIONS.inc()
+        buffered = 0
+        try:
+            if stream is True:
+                token_hop_len = self.token_min_hop_len
+                while True:
+                    time.sleep(0.1)
+                    if self.is_cancelled(this_uuid, cancel_event):
+                        break
+                    # NOTE consumed tokens are dropped from tts_speech_token_dict, so its length is the buffer depth
+                    TOKEN_BUFFER_DEPTH.inc(len(self.tts_speech_token_dict[this_uuid]) - buffered)
+                    buffered = len(self.tts_speech_token_dict[this_uuid])
+                    if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
+                        this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
+                            .unsqueeze(dim=0)
+                        this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         uuid=this_uuid,
+                                                         finalize=False)
+                        yield {'tts_speech': this_tts_speech.cpu()}
+                        with self.lock:
+                            self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
+                        # increase token_hop_len for better speech quality
+                        token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
+                    if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
+                        break
+                p.join()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                if self.is_cancelled(this_uuid, cancel_event) is False:
+                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
                                                      prompt_feat=prompt_speech_feat,
                                                      embedding=flow_embedding,
                                                      uuid=this_uuid,
-                                                     finalize=False)
+                                                     finalize=True)
                     yield {'tts_speech': this_tts_speech.cpu()}
-                    with self.lock:
-                        self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
+            else:
+                # deal with all tokens
+                self.wait_llm_job(p, this_uuid, cancel_event)
+                buffered = len(self.tts_speech_token_dict[this_uuid])
+                TOKEN_BUFFER_DEPTH.inc(buffered)
+                if self.is_cancelled(this_uuid, cancel_event) is False:
+                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                     prompt_token=flow_prompt_speech_token,
+                                                     prompt_feat=prompt_speech_feat,
+                                                     embedding=flow_embedding,
+                                                     uuid=this_uuid,
+                                                     finalize=True,
+                                                     speed=speed)
+                    yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            # NOTE also reached when the caller closes this generator early, stop llm_job before releasing session variables
+            self.cancel_dict[this_uuid].set()
             p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.mel_overlap_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
-            self.flow_cache_dict.pop(this_uuid)
+            TOKEN_BUFFER_DEPTH.dec(buffered)
+            INFLIGHT_SESSIONS.dec()
+            self.log_session_memory(this_uuid, timings)
+            with self.lock:
+                self.tts_speech_token_dict.pop(this_uuid)
+                self.llm_end_dict.pop(this_uuid)
+                self.mel_overlap_dict.pop(this_uuid)
+                self.hift_cache_dict.pop(this_uuid)
+                self.flow_cache_dict.pop(this_uuid)
+                self.cancel_dict.pop(this_uuid)
+                self.rng_dict.pop(this_uuid)
+                self.llm_context_len_dict.pop(this_uuid, None)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -240,12 +407,14 @@ class CosyVoice2Model(CosyVoiceModel):
                  llm: torch.nn.Module,
                  flow: torch.nn.Module,
                  hift: torch.nn.Module,
-                 fp16: bool = False):
+                 fp16: bool = False,
+                 bf16: bool = False):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.llm = llm
         self.flow = flow
         self.hift = hift
         self.fp16 = fp16
+        self.bf16 = bf16
         # NOTE must matching training static_chunk_size
         self.token_hop_len = 25
         # hift cache
@@ -260,6 +429,9 @@ class CosyVoice2Model(CosyVoiceModel):
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
         self.hift_cache_dict = {}
+        self.cancel_dict = {}
+        self.rng_dict = {}
+        self.llm_context_len_dict = {}
 
     def load_jit(self, flow_encoder_model):
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
@@ -276,8 +448,26 @@ class CosyVoice2Model(CosyVoiceModel):
         self.llm.lock = threading.Lock()
         del self.llm.llm.model.model.layers
 
+    def load_onnx_llm(self, llm_prefill_onnx_model, llm_decode_onnx_model, max_cache_len=4096, max_contexts=4):
+        for onnx_model in [llm_prefill_onnx_model, llm_decode_onnx_model]:
+            assert os.path.exists(onnx_model), '{} not found, export it with cosyvoice/bin/export_llm_onnx.py'.format(onnx_model)
+        self.llm.onnx = OrtLLMWrapper(llm_prefill_onnx_model, llm_decode_onnx_model, max_cache_len=max_cache_len, max_contexts=max_contexts,
+                                      intra_op_num_threads=thread_plan.threads('llm'), stage='llm')
+        # NOTE the text embedding stays in torch, the transformer layers are only used by the onnx graphs
+        del self.llm.llm.model.model.layers
+
+    def load_token2wav_pool(self, token2wav_pool):
+        """Run flow + hift of every session in the worker processes of token2wav_pool, this process keeps the llm"""
+        self.token2wav_pool = token2wav_pool.wait_ready()
+        # NOTE only the frame rate / ratio attributes of flow are still read here, release the bulk of its weights
+        del self.flow.encoder, self.flow.decoder
+
+    @session_rng
     def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
-        with torch.cuda.amp.autocast(self.fp16):
+        if hasattr(self, 'token2wav_pool'):
+            return self.token2wav_pool.token2wav(token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=stream, finalize=finalize,
+                                                 speed=speed, cancel_event=self.cancel_dict[uuid])
+        with self.autocast(), timer(FLOW_SECONDS, sync=True, stage='flow'), thread_plan.stage('flow'):
             tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
                                              token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
                                              prompt_token=prompt_token.to(self.device),
@@ -296,7 +486,8 @@ class CosyVoice2Model(CosyVoiceModel):
             hift_cache_source = torch.zeros(1, 1, 0)
         # keep overlap mel and hift cache
         if finalize is False:
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with timer(HIFT_SECONDS, sync=True, stage='hift'), thread_plan.stage('hift'):
+                tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
             self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
@@ -307,7 +498,8 @@ class CosyVoice2Model(CosyVoiceModel):
             if speed != 1.0:
                 assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
+            with timer(HIFT_SECONDS, sync=True, stage='hift'), thread_plan.stage('hift'):
+                tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
                 tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
         return tts_speech
@@ -316,65 +508,103 @@ class CosyVoice2Model(CosyVoiceModel):
             prompt_text=torch.zeros(1, 0, dtype=torch.int32),
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
-            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
+            prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0,
+            cancel_event=None, seed=None, **kwargs):
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
+        timings = current_timings()
+        if timings is not None:
+            timings.incr('segments')
+        # NOTE the token2wav slot is taken before the llm starts, saturated token2wav workers hold back new llm sessions
+        if hasattr(self, 'token2wav_pool') and self.token2wav_pool.acquire(this_uuid, cancel_event, seed) is None:
+            return
         with self.lock:
             self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
             self.hift_cache_dict[this_uuid] = None
+            self.cancel_dict[this_uuid] = threading.Event()
+            # NOTE flow / hift noise of the session, kept apart from the llm generators of llm_job so the two threads do not interleave draws
+            self.rng_dict[this_uuid] = SessionRNG(seed)
         if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
+            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid, timings, seed))
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
         p.start()
-        if stream is True:
-            token_offset = 0
-            prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
-            while True:
-                time.sleep(0.1)
-                this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
-                if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
+        INFLIGHT_SESSIONS.inc()
+        buffered = 0
+        try:
+            if stream is True:
+                token_offset = 0
+                prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
+                while True:
+                    time.sleep(0.1)
+                    if self.is_cancelled(this_uuid, cancel_event):
+                        break
+                    TOKEN_BUFFER_DEPTH.inc(len(self.tts_speech_token_dict[this_uuid]) - token_offset - buffered)
+                    buffered = len(self.tts_speech_token_dict[this_uuid]) - token_offset
+                    this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
+                    if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
+                        this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
+                        this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                         prompt_token=flow_prompt_speech_token,
+                                                         prompt_feat=prompt_speech_feat,
+                                                         embedding=flow_embedding,
+                                                         token_offset=token_offset,
+                                                         uuid=this_uuid,
+                                                         stream=stream,
+                                                         finalize=False)
+                        # NOTE a token2wav pool chunk abandoned on cancel comes back empty
+                        if self.is_cancelled(this_uuid, cancel_event):
+                            break
+                        token_offset += this_token_hop_len
+                        yield {'tts_speech': this_tts_speech.cpu()}
+                    if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
+                        break
+                p.join()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                if self.is_cancelled(this_uuid, cancel_event) is False:
+                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
                                                      prompt_token=flow_prompt_speech_token,
                                                      prompt_feat=prompt_speech_feat,
                                                      embedding=flow_embedding,
                                                      token_offset=token_offset,
                                                      uuid=this_uuid,
-                                                     stream=stream,
-                                                     finalize=False)
-                    token_offset += this_token_hop_len
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=token_offset,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        else:
-            # deal with all tokens
+                                                     finalize=True)
+                    if self.is_cancelled(this_uuid, cancel_event) is False:
+                        yield {'tts_speech': this_tts_speech.cpu()}
+            else:
+                # deal with all tokens
+                self.wait_llm_job(p, this_uuid, cancel_event)
+                buffered = len(self.tts_speech_token_dict[this_uuid])
+                TOKEN_BUFFER_DEPTH.inc(buffered)
+                if self.is_cancelled(this_uuid, cancel_event) is False:
+                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
+                                                     prompt_token=flow_prompt_speech_token,
+                                                     prompt_feat=prompt_speech_feat,
+                                                     embedding=flow_embedding,
+                                                     token_offset=0,
+                                                     uuid=this_uuid,
+                                                     finalize=True,
+                                                     speed=speed)
+                    if self.is_cancelled(this_uuid, cancel_event) is False:
+                        yield {'tts_speech': this_tts_speech.cpu()}
+        finally:
+            # NOTE also reached when the caller closes this generator early, stop llm_job before releasing session variables
+            self.cancel_dict[this_uuid].set()
             p.join()
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=0,
-                                             uuid=this_uuid,
-                                             finalize=True,
-                                             speed=speed)
-            yield {'tts_speech': this_tts_speech.cpu()}
-        with self.lock:
-            self.tts_speech_token_dict.pop(this_uuid)
-            self.llm_end_dict.pop(this_uuid)
-            self.hift_cache_dict.pop(this_uuid)
+            TOKEN_BUFFER_DEPTH.dec(buffered)
+            INFLIGHT_SESSIONS.dec()
+            if hasattr(self, 'token2wav_pool'):
+                self.token2wav_pool.release(this_uuid)
+            self.log_session_memory(this_uuid, timings)
+            with self.lock:
+                self.tts_speech_token_dict.pop(this_uuid)
+                self.llm_end_dict.pop(this_uuid)
+                self.hift_cache_dict.pop(this_uuid)
+                self.cancel_dict.pop(this_uuid)
+                self.rng_dict.pop(this_uuid)
+                self.llm_context_len_dict.pop(this_uuid, None)
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
             torch.cuda.current_stream().synchronize()
@@ -386,12 +616,14 @@ class CosyVoice3Model(CosyVoice2Model):
                  llm: torch.nn.Module,
                  flow: torch.nn.Module,
                  hift: torch.nn.Module,
-                 fp16: bool = False):
+                 fp16: bool = False,
+                 bf16: bool = False):
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         self.llm = llm
         self.flow = flow
         self.hift = hift
         self.fp16 = fp16
+        self.bf16 = bf16
         # NOTE must matching training static_chunk_size
         self.token_hop_len = 25
         # rtf and decoding related
@@ -401,18 +633,26 @@ class CosyVoice3Model(CosyVoice2Model):
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
         self.hift_cache_dict = {}
+        self.cancel_dict = {}
+        self.rng_dict = {}
+        self.llm_context_len_dict = {}
 
+    @session_rng
     def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
-        with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
+        if hasattr(self, 'token2wav_pool'):
+            return self.token2wav_pool.token2wav(token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=stream, finalize=finalize,
+                                                 speed=speed, cancel_event=self.cancel_dict[uuid])
+        with self.autocast():
+            with timer(FLOW_SECONDS, sync=True, stage='flow'), thread_plan.stage('flow'):
+                tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
+                                                 token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
+                                                 prompt_token=prompt_token.to(self.device),
+                                                 prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
+                                                 prompt_feat=prompt_feat.to(self.device),
+                                                 prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
+                                                 embedding=embedding.to(self.device),
+                                                 streaming=stream,
+                                                 finalize=finalize)
             tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
             # append mel cache
             if self.hift_cache_dict[uuid] is not None:
@@ -424,7 +664,8 @@ class CosyVoice3Model(CosyVoice2Model):
             if speed != 1.0:
                 assert token_offset == 0 and finalize is True, 'speed change only support non-stream inference mode'
                 tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, _ = self.hift.inference(speech_feat=tts_mel, finalize=finalize)
+            with timer(HIFT_SECONDS, sync=True, stage='hift'), thread_plan.stage('hift'):
+                tts_speech, _ = self.hift.inference(speech_feat=tts_mel, finalize=finalize)
             tts_speech = tts_speech[:, self.hift_cache_dict[uuid]['speech_offset']:]
             self.hift_cache_dict[uuid]['speech_offset'] += tts_speech.shape[1]
         return tts_speech
@@ -0,0 +1,408 @@
+import os
+import time
+import queue
+import shutil
+import atexit
+import hashlib
+import tempfile
+import threading
+import traceback
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import numpy as np
+import torch
+from cosyvoice.utils.common import SessionRNG
+from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.metrics import RequestTimings, current_timings, FLOW_SECONDS, HIFT_SECONDS, TOKEN2WAV_SLOT_WAIT_SECONDS, TOKEN2WAV_SESSIONS
+from cosyvoice.utils.thread_plan import thread_plan, available_cores, parse_cores
+
+STAGE_METRICS = {'flow': FLOW_SECONDS, 'hift': HIFT_SECONDS}
+
+
+def attach_shared_memory(name):
+    """Attach to a segment created by the main process without registering it to the resource tracker of this process,
+    which would otherwise unlink it when the worker exits"""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class Token2WavSlot:
+    """Shared memory of one token2wav session: the speech token buffer the llm fills and the pcm of the last chunk"""
+
+    def __init__(self, max_tokens, max_samples, name=None):
+        self.max_tokens, self.max_samples = max_tokens, max_samples
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=4 * max_tokens + 4 * max_samples)
+        else:
+            self.shm = attach_shared_memory(name)
+        self.tokens = np.ndarray((max_tokens, ), dtype=np.int32, buffer=self.shm.buf)
+        self.pcm = np.ndarray((max_samples, ), dtype=np.float32, buffer=self.shm.buf, offset=4 * max_tokens)
+
+    def close(self, unlink=False):
+        del self.tokens, self.pcm
+        self.shm.close()
+        if unlink is True:
+            self.shm.unlink()
+
+
+class PromptStore:
+    """Prompt token / feat / embedding of a session written once as .npy files and memory mapped by the workers.
+
+    Files are keyed by the digest of their content, so a voice used by many requests is written and mapped once. Every
+    put holds a reference until release, only unreferenced keys are evicted, a worker may still have to map them.
+    """
+
+    def __init__(self, directory=None, max_prompts=256):
+        if directory is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        self.directory = tempfile.mkdtemp(prefix='cosyvoice_prompt_', dir=directory)
+        self.max_prompts = max_prompts
+        self.keys = OrderedDict()
+        self.refs = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def path(directory, key, name):
+        return '{}/{}.{}.npy'.format(directory, key, name)
+
+    def put(self, prompt_token, prompt_feat, embedding):
+        arrays = {'token': prompt_token.cpu().numpy(), 'feat': prompt_feat.float().cpu().numpy(), 'embedding': embedding.float().cpu().numpy()}
+        digest = hashlib.sha1()
+        for name, array in arrays.items():
+            digest.update('{}{}{}'.format(name, array.shape, array.dtype).encode())
+            digest.update(np.ascontiguousarray(array).tobytes())
+        key = digest.hexdigest()
+        with self.lock:
+            self.refs[key] = self.refs.get(key, 0) + 1
+            if key in self.keys:
+                self.keys.move_to_end(key)
+                return key
+        for name, array in arrays.items():
+            # NOTE write a file of this call then rename, a worker never maps a partially written file, and concurrent
+            # first requests of the same voice each replace the path with complete, identical content
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp.npy', dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, array)
+            os.replace(tmp_path, self.path(self.directory, key, name))
+        with self.lock:
+            self.keys[key] = True
+            # NOTE workers keep their mappings of unlinked files valid, only new mappings need the file
+            evictable = [k for k in self.keys if self.refs.get(k, 0) == 0]
+            for evicted in evictable[:max(0, len(self.keys) - self.max_prompts)]:
+                del self.keys[evicted]
+                for name in arrays:
+                    try:
+                        os.remove(self.path(self.directory, evicted, name))
+                    except FileNotFoundError:
+                        pass
+        return key
+
+    def release(self, key):
+        with self.lock:
+            self.refs[key] -= 1
+            if self.refs[key] == 0:
+                del self.refs[key]
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def load_token2wav_model(model_dir, load_jit=False, load_trt=False, trt_concurrent=1, fp16=False, quantize=None, dtype=None, load_onnx=False,
+                         load_onnx_hift=False):
+    """Flow + hift of a CosyVoice2/CosyVoice3 model_dir with the backends of the main process, the llm and the frontend
+    are never built, a worker only pays for what it runs"""
+    from hyperpyyaml import load_hyperpyyaml
+    from cosyvoice.cli.cosyvoice import use_cpu_bf16
+    from cosyvoice.cli.model import CosyVoice2Model, CosyVoice3Model
+    from cosyvoice.utils.quantize import quantize_model, prepare_quantized
+    from cosyvoice.utils.startup import skip_init_weights
+    if os.path.exists('{}/cosyvoice3.yaml'.format(model_dir)):
+        hyper_yaml_path, model_class = '{}/cosyvoice3.yaml'.format(model_dir), CosyVoice3Model
+    else:
+        hyper_yaml_path, model_class = '{}/cosyvoice2.yaml'.format(model_dir), CosyVoice2Model
+    with open(hyper_yaml_path, 'r') as f, skip_init_weights():
+        configs = load_hyperpyyaml(f, overrides={'llm': None, 'qwen_pretrain_path': os.path.join(model_dir, 'CosyVoice-BlankEN')})
+    model = model_class(None, configs['flow'], configs['hift'], fp16, use_cpu_bf16(dtype, quantize))
+    flow_model = '{}/flow.pt'.format(model_dir)
+    quantized_model = prepare_quantized(model, model_dir, quantize) if quantize is not None else None
+    if quantized_model is not None:
+        flow_model = quantized_model[1]
+    model.load(None, flow_model, '{}/hift.pt'.format(model_dir))
+    if quantize is not None and quantized_model is None:
+        quantize_model(model, quantize)
+    if load_jit:
+        model.load_jit('{}/flow.encoder.{}.zip'.format(model_dir, 'fp16' if fp16 is True else 'fp32'))
+    if load_trt:
+        model.load_trt('{}/flow.decoder.estimator.{}.mygpu.plan'.format(model_dir, 'fp16' if fp16 is True else 'fp32'),
+                       '{}/flow.decoder.estimator.fp32.onnx'.format(model_dir), trt_concurrent, fp16)
+    if load_onnx:
+        model.load_onnx('{}/flow.decoder.estimator.fp32.onnx'.format(model_dir),
+                        '{}/flow.decoder.estimator.streaming.fp32.onnx'.format(model_dir), trt_concurrent)
+    if load_onnx_hift:
+        model.load_onnx_hift('{}/hift.fp32.onnx'.format(model_dir), trt_concurrent)
+    return model
+
+
+def token2wav_worker(index, model_dir, model_kwargs, slot_names, max_tokens, max_samples, prompt_dir, plan, request_queue, result_queue):
+    """Token2wav process: flow + hift of the sessions the main process assigns to it, one chunk at a time"""
+    try:
+        thread_plan.configure(plan)
+        model = load_token2wav_model(model_dir, **model_kwargs)
+        slots = [Token2WavSlot(max_tokens, max_samples, name) for name in slot_names]
+    except Exception:
+        result_queue.put(('ready', index, traceback.format_exc()))
+        return
+    result_queue.put(('ready', index, None))
+    prompts = OrderedDict()
+    while True:
+        request = request_queue.get()
+        if request is None:
+            break
+        if request[0] == 'end':
+            model.hift_cache_dict.pop(request[1], None)
+            model.rng_dict.pop(request[1], None)
+            continue
+        _, uuid, slot, overflow, key, num_tokens, token_offset, stream, finalize, speed, seed = request
+        try:
+            # NOTE sessions longer than the pooled slots carry their own segment, (name, max_tokens, max_samples)
+            buffer = slots[slot] if overflow is None else Token2WavSlot(overflow[1], overflow[2], overflow[0])
+            if key not in prompts:
+                # NOTE copy on write mapping, torch tensors need a writable buffer but the pages stay shared until written
+                prompts[key] = [torch.from_numpy(np.load(PromptStore.path(prompt_dir, key, name), mmap_mode='c'))
+                                for name in ['token', 'feat', 'embedding']]
+                while len(prompts) > 64:
+                    prompts.popitem(last=False)
+            prompts.move_to_end(key)
+            prompt_token, prompt_feat, embedding = prompts[key]
+            model.hift_cache_dict.setdefault(uuid, None)
+            model.rng_dict.setdefault(uuid, SessionRNG(seed))
+            token = torch.from_numpy(buffer.tokens[:num_tokens].copy()).unsqueeze(dim=0)
+            timings = RequestTimings()
+            with timings.activate(), torch.inference_mode():
+                tts_speech = model.token2wav(token=token, prompt_token=prompt_token, prompt_feat=prompt_feat, embedding=embedding,
+                                             token_offset=token_offset, uuid=uuid, stream=stream, finalize=finalize, speed=speed)
+            tts_speech = tts_speech.flatten().float().cpu().numpy()
+            if tts_speech.shape[0] > buffer.max_samples:
+                raise ValueError('chunk of {} samples exceeds the token2wav segment of {}'.format(tts_speech.shape[0], buffer.max_samples))
+            buffer.pcm[:tts_speech.shape[0]] = tts_speech
+            if overflow is not None:
+                buffer.close()
+            result_queue.put(('result', slot, tts_speech.shape[0], timings.stages, None))
+        except Exception:
+            result_queue.put(('result', slot, 0, {}, traceback.format_exc()))
+    for slot in slots:
+        slot.close()
+
+
+class Token2WavPool:
+    """Flow + hift in separate processes, fed with speech tokens through shared memory.
+
+    The main process keeps the frontend and the llm, every tts session acquires one of num_slots shared memory slots before
+    its llm starts and sticks to one worker, which keeps its hift cache. Slots bound the sessions in flight: when they are
+    all taken new sessions wait for one, so saturated workers hold back llm decoding as well, and a session goes to the
+    live worker with the fewest sessions.
+    """
+
+    def __init__(self, model_dir, model_kwargs, num_workers, num_slots=None, cores=None, max_tokens=4096, samples_per_token=960,
+                 chunk_timeout=300):
+        assert num_workers > 0, 'token2wav pool needs at least one worker'
+        num_slots = num_slots or 2 * num_workers
+        # NOTE a non streaming session returns the whole utterance at once, slowed down by at most speed 0.5;
+        # sessions beyond max_tokens get a segment of their own instead of a pooled slot, see buffer
+        self.samples_per_token = samples_per_token
+        self.max_tokens, self.max_samples = max_tokens, 2 * max_tokens * samples_per_token
+        self.slots = [Token2WavSlot(self.max_tokens, self.max_samples) for _ in range(num_slots)]
+        self.free_slots = queue.Queue()
+        for i in range(num_slots):
+            self.free_slots.put(i)
+        self.slot_results = [queue.Queue(maxsize=1) for _ in range(num_slots)]
+        # NOTE slots whose chunk was abandoned, their late result must not reach the next session of the slot
+        self.poisoned = set()
+        self.chunk_timeout = chunk_timeout
+        self.prompts = PromptStore()
+        self.sessions = {}
+        self.assigned = [0] * num_workers
+        self.lock = threading.Lock()
+        context = multiprocessing.get_context('spawn')
+        self.request_queues = [context.Queue() for _ in range(num_workers)]
+        self.result_queue = context.Queue()
+        self.workers = []
+        for i, plan in enumerate(self.worker_plans(num_workers, cores)):
+            worker = context.Process(target=token2wav_worker, daemon=True, name='token2wav-{}'.format(i),
+                                     args=(i, model_dir, model_kwargs, [slot.shm.name for slot in self.slots], self.max_tokens,
+                                           self.max_samples, self.prompts.directory, plan, self.request_queues[i], self.result_queue))
+            worker.start()
+            self.workers.append(worker)
+        self.closed = False
+        atexit.register(self.close)
+
+    @staticmethod
+    def worker_plans(num_workers, cores=None):
+        """Thread plan of every worker, cores split evenly among them, or threads split with the llm process otherwise"""
+        if cores is None:
+            intra = max(1, len(available_cores()) // (num_workers + 1))
+            return [{'flow': {'intra': intra}, 'hift': {'intra': intra}}] * num_workers
+        cores = parse_cores(cores)
+        assert len(cores) >= num_workers, 'token2wav pool needs at least one core per worker, got {} for {}'.format(len(cores), num_workers)
+        plans = []
+        for i in range(num_workers):
+            share = cores[i * len(cores) // num_workers:(i + 1) * len(cores) // num_workers]
+            plans.append({'flow': {'cores': share}, 'hift': {'cores': share}})
+        return plans
+
+    def wait_ready(self):
+        ready = 0
+        while ready < len(self.workers):
+            try:
+                message = self.result_queue.get(timeout=1)
+            except queue.Empty:
+                dead = [worker.name for worker in self.workers if worker.is_alive() is False]
+                assert len(dead) == 0, 'token2wav workers {} exited during startup'.format(dead)
+                continue
+            assert message[0] == 'ready', 'unexpected token2wav message {} during startup'.format(message[0])
+            if message[2] is not None:
+                self.close()
+                raise RuntimeError('token2wav worker {} failed to load\n{}'.format(message[1], message[2]))
+            ready += 1
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.dispatcher.start()
+        logging.info('{} token2wav workers ready, {} slots'.format(len(self.workers), len(self.slots)))
+        return self
+
+    def dispatch(self):
+        while True:
+            message = self.result_queue.get()
+            if message is None:
+                break
+            _, slot, num_samples, stages, error = message
+            with self.lock:
+                if slot in self.poisoned:
+                    # NOTE the worker is done with the abandoned chunk, the slot can be handed out again
+                    self.poisoned.remove(slot)
+                    self.free_slots.put(slot)
+                    continue
+                self.slot_results[slot].put_nowait((num_samples, stages, error))
+
+    def acquire(self, uuid, cancel_event=None, seed=None):
+        start_time = time.perf_counter()
+        while True:
+            try:
+                slot = self.free_slots.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+        TOKEN2WAV_SLOT_WAIT_SECONDS.observe(time.perf_counter() - start_time)
+        with self.lock:
+            alive = [i for i, worker in enumerate(self.workers) if worker.is_alive()]
+            if len(alive) == 0:
+                self.free_slots.put(slot)
+                raise RuntimeError('every token2wav worker died')
+            worker = min(alive, key=lambda i: self.assigned[i])
+            self.assigned[worker] += 1
+            TOKEN2WAV_SESSIONS.labels(worker=str(worker)).set(self.assigned[worker])
+            # NOTE the caller's cancel_event (client disconnect, deadline) is only seen by the tts thread between chunks,
+            # keep it so a chunk wait notices it as well
+            self.sessions[uuid] = {'slot': slot, 'worker': worker, 'prompt': None, 'written': 0, 'overflow': None, 'cancel_event': cancel_event,
+                                  'seed': seed}
+        return self.sessions[uuid]
+
+    def release(self, uuid):
+        with self.lock:
+            session = self.sessions.pop(uuid, None)
+            if session is None:
+                return
+            self.assigned[session['worker']] -= 1
+            TOKEN2WAV_SESSIONS.labels(worker=str(session['worker'])).set(self.assigned[session['worker']])
+            if session['prompt'] is not None:
+                self.prompts.release(session['prompt'])
+            abandoned = session.get('abandoned') is True
+            if abandoned:
+                try:
+                    # NOTE the result of the abandoned chunk arrived in the meantime, drop it
+                    self.slot_results[session['slot']].get_nowait()
+                    abandoned = False
+                except queue.Empty:
+                    self.poisoned.add(session['slot'])
+        self.request_queues[session['worker']].put(('end', uuid))
+        if abandoned is False:
+            self.free_slots.put(session['slot'])
+        if session['overflow'] is not None:
+            session['overflow'].close(unlink=True)
+
+    def buffer(self, session, num_tokens):
+        """The shared memory holding the tokens of session, a pooled slot or, past max_tokens, a segment of its own
+        grown by doubling, the llm output length has no fixed bound"""
+        buffer = session['overflow'] or self.slots[session['slot']]
+        if num_tokens <= buffer.max_tokens:
+            return buffer
+        max_tokens = max(num_tokens, 2 * buffer.max_tokens)
+        overflow = Token2WavSlot(max_tokens, 2 * max_tokens * self.samples_per_token)
+        overflow.tokens[:session['written']] = buffer.tokens[:session['written']]
+        if session['overflow'] is not None:
+            session['overflow'].close(unlink=True)
+        session['overflow'] = overflow
+        logging.info('token2wav session of {} tokens exceeds the pooled slots, use a segment of {} tokens'.format(num_tokens, max_tokens))
+        return overflow
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0,
+                  cancel_event=None):
+        """Same contract as CosyVoice2Model.token2wav, token is the session token list so far, of which only the tokens
+        not yet in the slot are copied"""
+        session = self.sessions[uuid]
+        if session['prompt'] is None:
+            session['prompt'] = self.prompts.put(prompt_token, prompt_feat, embedding)
+        num_tokens = token.shape[1]
+        buffer = self.buffer(session, num_tokens)
+        buffer.tokens[session['written']:num_tokens] = token[0, session['written']:].numpy()
+        session['written'] = num_tokens
+        overflow = None if session['overflow'] is None else (buffer.shm.name, buffer.max_tokens, buffer.max_samples)
+        self.request_queues[session['worker']].put(('chunk', uuid, session['slot'], overflow, session['prompt'], num_tokens, token_offset,
+                                                    stream, finalize, speed, session['seed']))
+        start_time = time.perf_counter()
+        while True:
+            try:
+                num_samples, stages, error = self.slot_results[session['slot']].get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self.workers[session['worker']].is_alive() is False:
+                    session['abandoned'] = True
+                    raise RuntimeError('token2wav worker {} died'.format(session['worker']))
+                # NOTE the worker may still write this slot, release quarantines it until the late result arrives
+                if any(event is not None and event.is_set() for event in [cancel_event, session['cancel_event']]):
+                    session['abandoned'] = True
+                    return torch.zeros(1, 0)
+                if time.perf_counter() - start_time > self.chunk_timeout:
+                    session['abandoned'] = True
+                    raise RuntimeError('token2wav worker {} did not return a chunk within {}s'.format(session['worker'], self.chunk_timeout))
+        if error is not None:
+            raise RuntimeError('token2wav worker {} failed\n{}'.format(session['worker'], error))
+        timings = current_timings()
+        for stage, seconds in stages.items():
+            for i in seconds:
+                STAGE_METRICS[stage].observe(i)
+                if timings is not None:
+                    timings.add(stage, i)
+        return torch.from_numpy(buffer.pcm[:num_samples].copy()).unsqueeze(dim=0)
+
+    def close(self):
+        if self.closed is True:
+            return
+        self.closed = True
+        for request_queue, worker in zip(self.request_queues, self.workers):
+            if worker.is_alive():
+                request_queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self.result_queue.put(None)
+        for slot in self.slots:
+            slot.close(unlink=True)
+        self.prompts.close()
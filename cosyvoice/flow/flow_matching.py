@@ -15,7 +15,7 @@
 import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
-from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.common import set_all_random_seed, session_generator, OrtEstimatorWrapper
 
 
 class ConditionalCFM(BASECFM):
@@ -53,7 +53,7 @@ class ConditionalCFM(BASECFM):
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = torch.randn_like(mu).to(mu.device).to(mu.dtype) * temperature
+        z = torch.randn(mu.shape, generator=session_generator(mu.device), device=mu.device).to(mu.dtype) * temperature
         cache_size = cache.shape[2]
         # fix prompt and overlap part mu and z
         if cache_size != 0:
@@ -126,6 +126,8 @@ class ConditionalCFM(BASECFM):
     def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False):
         if isinstance(self.estimator, torch.nn.Module):
             return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming)
+        elif isinstance(self.estimator, OrtEstimatorWrapper):
+            return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming)
         else:
             [estimator, stream], trt_engine = self.estimator.acquire_estimator()
             # NOTE need to synchronize when switching stream
@@ -14,6 +14,7 @@
 
 """HIFI-GAN"""
 
+import os
 from typing import Dict, Optional, List
 import numpy as np
 from scipy.signal import get_window
@@ -27,11 +28,11 @@ try:
     from torch.nn.utils.parametrizations import weight_norm
 except ImportError:
     from torch.nn.utils import weight_norm
-from torch.distributions.uniform import Uniform
 from cosyvoice.transformer.convolution import CausalConv1d, CausalConv1dDownSample, CausalConv1dUpsample
 from cosyvoice.transformer.activation import Snake
 from cosyvoice.utils.common import get_padding
 from cosyvoice.utils.common import init_weights
+from cosyvoice.utils.common import session_generator
 
 
 """hifigan based generator implementation.
@@ -167,8 +168,8 @@ class SineGen(torch.nn.Module):
             F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
 
         theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
+        # uniform in [-pi, pi)
+        phase_vec = torch.rand((f0.size(0), self.harmonic_num + 1, 1), generator=session_generator(F_mat.device), device=F_mat.device) * 2 * np.pi - np.pi
         phase_vec[:, 0, :] = 0
 
         # generate sine waveforms
@@ -181,7 +182,7 @@ class SineGen(torch.nn.Module):
         #        std = self.sine_amp/3 -> max value ~ self.sine_amp
         # .       for voiced regions is self.noise_std
         noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
-        noise = noise_amp * torch.randn_like(sine_waves)
+        noise = noise_amp * torch.randn(sine_waves.shape, generator=session_generator(sine_waves.device), device=sine_waves.device, dtype=sine_waves.dtype)
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
@@ -242,7 +243,7 @@ class SineGen2(torch.nn.Module):
         if self.training is False and self.causal is True:
             rad_values[:, 0, :] = rad_values[:, 0, :] + self.rand_ini.to(rad_values.device)
         else:
-            rand_ini = torch.rand(f0_values.shape[0], f0_values.shape[2], device=f0_values.device)
+            rand_ini = torch.rand(f0_values.shape[0], f0_values.shape[2], generator=session_generator(f0_values.device), device=f0_values.device)
             rand_ini[:, 0] = 0
             rad_values[:, 0, :] = rad_values[:, 0, :] + rand_ini
 
@@ -309,7 +310,7 @@ class SineGen2(torch.nn.Module):
         if self.training is False and self.causal is True:
             noise = noise_amp * self.sine_waves[:, :sine_waves.shape[1]].to(sine_waves.device)
         else:
-            noise = noise_amp * torch.randn_like(sine_waves)
+            noise = noise_amp * torch.randn(sine_waves.shape, generator=session_generator(sine_waves.device), device=sine_waves.device, dtype=sine_waves.dtype)
 
         # first: set the unvoiced part to 0 by uv
         # then: additive noise
@@ -371,7 +372,7 @@ class SourceModuleHnNSF(torch.nn.Module):
         if self.training is False and self.causal is True:
             noise = self.uv[:, :uv.shape[1]] * self.sine_amp / 3
         else:
-            noise = torch.randn_like(uv) * self.sine_amp / 3
+            noise = torch.randn(uv.shape, generator=session_generator(uv.device), device=uv.device, dtype=uv.dtype) * self.sine_amp / 3
         return sine_merge, noise, uv
 
 
@@ -473,6 +474,7 @@ class HiFTGenerator(nn.Module):
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
         self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
         self.f0_predictor = f0_predictor
+        self.onnx_body = None
 
     def remove_weight_norm(self):
         print('Removing weight norm...')
@@ -504,11 +506,8 @@ class HiFTGenerator(nn.Module):
                                         self.istft_params["n_fft"], window=self.stft_window.to(magnitude.device))
         return inverse_transform
 
-    def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
-        s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
-        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
-
-        x = self.conv_pre(x)
+    def decode_body(self, x: torch.Tensor, s_stft: torch.Tensor) -> torch.Tensor:
+        """upsampling, source fusion and resblocks, from the conv_pre output to the conv_post output"""
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, self.lrelu_slope)
             x = self.ups[i](x)
@@ -530,7 +529,17 @@ class HiFTGenerator(nn.Module):
             x = xs / self.num_kernels
 
         x = F.leaky_relu(x)
-        x = self.conv_post(x)
+        return self.conv_post(x)
+
+    def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
+        s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
+        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
+
+        x = self.conv_pre(x)
+        # NOTE the body runs in onnxruntime when loaded with load_onnx_hift, see cosyvoice/bin/export_hift_onnx.py
+        x = self.decode_body(x, s_stft) if self.onnx_body is None else self.onnx_body(x, s_stft)
+        # NOTE magnitude / phase and istft are precision sensitive, keep them in fp32 under cpu bf16 autocast
+        x = x.float()
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
         phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
 
@@ -556,12 +565,14 @@ class HiFTGenerator(nn.Module):
 
     @torch.inference_mode()
     def inference(self, speech_feat: torch.Tensor, cache_source: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
-        # mel->f0
-        f0 = self.f0_predictor(speech_feat)
-        # f0->source
-        s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
-        s, _, _ = self.m_source(s)
-        s = s.transpose(1, 2)
+        # NOTE f0 and the sine source stay in fp32 under cpu bf16 autocast
+        with torch.autocast('cpu', enabled=False):
+            # mel->f0
+            f0 = self.f0_predictor(speech_feat)
+            # f0->source
+            s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
+            s, _, _ = self.m_source(s)
+            s = s.transpose(1, 2)
         # use cache_source to avoid glitch
         if cache_source.shape[2] != 0:
             s[:, :, :cache_source.shape[2]] = cache_source
@@ -668,6 +679,7 @@ class CausalHiFTGenerator(HiFTGenerator):
         self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
         self.conv_pre_look_right = conv_pre_look_right
         self.f0_predictor = f0_predictor
+        self.onnx_body = None
 
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0), finalize: bool = True) -> torch.Tensor:
         s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
@@ -679,28 +691,10 @@ class CausalHiFTGenerator(HiFTGenerator):
             s_stft_imag = s_stft_imag[:, :, :-int(np.prod(self.upsample_rates) * self.conv_pre_look_right)]
         s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
 
-        for i in range(self.num_upsamples):
-            x = F.leaky_relu(x, self.lrelu_slope)
-            x = self.ups[i](x)
-
-            if i == self.num_upsamples - 1:
-                x = self.reflection_pad(x)
-
-            # fusion
-            si = self.source_downs[i](s_stft)
-            si = self.source_resblocks[i](si)
-            x = x + si
-
-            xs = None
-            for j in range(self.num_kernels):
-                if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
-                else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
-            x = xs / self.num_kernels
-
-        x = F.leaky_relu(x)
-        x = self.conv_post(x)
+        # NOTE the body runs in onnxruntime when loaded with load_onnx_hift, see cosyvoice/bin/export_hift_onnx.py
+        x = self.decode_body(x, s_stft) if self.onnx_body is None else self.onnx_body(x, s_stft)
+        # NOTE magnitude / phase and istft are precision sensitive, keep them in fp32 under cpu bf16 autocast
+        x = x.float()
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
         phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
 
@@ -713,12 +707,14 @@ class CausalHiFTGenerator(HiFTGenerator):
     @torch.inference_mode()
     def inference(self, speech_feat: torch.Tensor, finalize: bool = True) -> torch.Tensor:
         # mel->f0 NOTE f0_predictor precision is crucial for causal inference, move self.f0_predictor to cpu if necessary
+        # it also stays in fp32, with the sine source, under cpu bf16 autocast
         self.f0_predictor.to('cpu')
-        f0 = self.f0_predictor(speech_feat.cpu(), finalize=finalize).to(speech_feat)
-        # f0->source
-        s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
-        s, _, _ = self.m_source(s)
-        s = s.transpose(1, 2)
+        with torch.autocast('cpu', enabled=False):
+            f0 = self.f0_predictor(speech_feat.cpu().float(), finalize=finalize).to(speech_feat)
+            # f0->source
+            s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
+            s, _, _ = self.m_source(s)
+            s = s.transpose(1, 2)
         if finalize is True:
             generated_speech = self.decode(x=speech_feat, s=s, finalize=finalize)
         else:
@@ -744,3 +740,13 @@ if __name__ == '__main__':
         pred_chunk, _ = model.inference(mel[:, :, : i + chunk_size + context_size], finalize=finalize)
         pred_chunk = pred_chunk[:, i * 480:]
         print((pred_gt[:, i * 480:i * 480 + pred_chunk.shape[1]] - pred_chunk).abs().max().item())
+    # NOTE same check with the onnxruntime body of cosyvoice/bin/export_hift_onnx.py, against the eager full output
+    onnx_path = './pretrained_models/Fun-CosyVoice3-0.5B/hift.fp32.onnx'
+    if device == 'cpu' and os.path.exists(onnx_path):
+        from cosyvoice.utils.common import OrtHiFTWrapper
+        model.onnx_body = OrtHiFTWrapper(onnx_path)
+        for i in range(0, max_len, chunk_size):
+            finalize = True if i + chunk_size + context_size >= max_len else False
+            pred_chunk, _ = model.inference(mel[:, :, : i + chunk_size + context_size], finalize=finalize)
+            pred_chunk = pred_chunk[:, i * 480:]
+            print('onnx', (pred_gt[:, i * 480:i * 480 + pred_chunk.shape[1]] - pred_chunk).abs().max().item())
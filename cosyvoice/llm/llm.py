@@ -21,13 +21,15 @@ import numpy as np
 import torch
 from torch import nn
 import torch.nn.functional as F
-from transformers import Qwen2ForCausalLM
+from transformers import Qwen2Config, Qwen2ForCausalLM
+from transformers.modeling_utils import no_init_weights
 from torch.nn.utils.rnn import pad_sequence, unpad_sequence
 from cosyvoice.utils.common import IGNORE_ID
 from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
 from cosyvoice.utils.common import th_accuracy
 from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.mask import make_pad_mask
+from cosyvoice.utils.startup import init_skipped
 
 
 class TransformerLM(torch.nn.Module):
@@ -177,6 +179,7 @@ class TransformerLM(torch.nn.Module):
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
             uuid: str = '',
+            cancel_event: Optional[threading.Event] = None,
     ) -> Generator[torch.Tensor, None, None]:
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
@@ -212,6 +215,9 @@ class TransformerLM(torch.nn.Module):
         offset = 0
         att_cache, cnn_cache = torch.zeros((0, 0, 0, 0), device=lm_input.device), torch.zeros((0, 0, 0, 0), device=lm_input.device)
         for i in range(max_len):
+            if cancel_event is not None and cancel_event.is_set():
+                logging.info('llm decoding cancelled after {} tokens'.format(len(out_tokens)))
+                break
             y_pred, att_cache, cnn_cache = self.llm.forward_chunk(lm_input, offset=offset, required_cache_size=-1,
                                                                   att_cache=att_cache, cnn_cache=cnn_cache,
                                                                   att_mask=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]),
@@ -230,7 +236,15 @@ class TransformerLM(torch.nn.Module):
 class Qwen2Encoder(torch.nn.Module):
     def __init__(self, pretrain_path):
         super().__init__()
-        self.model = Qwen2ForCausalLM.from_pretrained(pretrain_path)
+        # NOTE a Qwen2Config builds a randomly initialized model, used by cosyvoice/bin/benchmark.py
+        if isinstance(pretrain_path, Qwen2Config):
+            self.model = Qwen2ForCausalLM(pretrain_path)
+        elif init_skipped():
+            # NOTE the pretrained weights are overwritten by llm.pt anyway, only read the config
+            with no_init_weights():
+                self.model = Qwen2ForCausalLM(Qwen2Config.from_pretrained(pretrain_path))
+        else:
+            self.model = Qwen2ForCausalLM.from_pretrained(pretrain_path)
 
     def forward(self, xs: torch.Tensor, xs_lens: torch.Tensor):
         T = xs.size(1)
@@ -446,6 +460,7 @@ class Qwen2LM(TransformerLM):
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
             uuid: str = '',
+            cancel_event: Optional[threading.Event] = None,
     ) -> Generator[torch.Tensor, None, None]:
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
@@ -466,11 +481,11 @@ class Qwen2LM(TransformerLM):
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
 
         # 5. step by step decode
-        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
+        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid, cancel_event):
             yield token
 
     @torch.inference_mode()
-    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid):
+    def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid, cancel_event=None):
         if hasattr(self, 'vllm'):
             from vllm import SamplingParams, RequestOutput
             sampling_params = SamplingParams(top_k=sampling,
@@ -482,6 +497,11 @@ class Qwen2LM(TransformerLM):
                 self.vllm_output_queue[uuid] = queue.Queue()
             out_tokens = []
             while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    logging.info('llm decoding cancelled after {} tokens'.format(len(out_tokens)))
+                    with self.lock:
+                        self.vllm.abort_request(uuid)
+                    break
                 with self.lock:
                     if self.vllm_output_queue[uuid].empty() is True:
                         request_outputs: List[RequestOutput] = self.vllm.step()
@@ -500,10 +520,35 @@ class Qwen2LM(TransformerLM):
                 time.sleep(0.001)
             with self.lock:
                 self.vllm_output_queue.pop(uuid)
+        elif hasattr(self, 'onnx'):
+            # NOTE prefill once, then decode step by step with the kv cache in preallocated onnxruntime buffers
+            if lm_input.shape[1] + max_len > self.onnx.max_cache_len:
+                max_len = self.onnx.max_cache_len - lm_input.shape[1]
+                logging.warning('onnx llm kv cache holds {} positions, limit max_len to {}'.format(self.onnx.max_cache_len, max_len))
+            out_tokens = []
+            context = self.onnx.acquire()
+            try:
+                for i in range(max_len):
+                    if cancel_event is not None and cancel_event.is_set():
+                        logging.info('llm decoding cancelled after {} tokens'.format(len(out_tokens)))
+                        break
+                    logp = self.onnx.prefill(context, lm_input) if i == 0 else self.onnx.decode(context, lm_input)
+                    top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
+                    if top_ids in self.stop_token_ids:
+                        break
+                    # in stream mode, yield token one by one
+                    yield top_ids
+                    out_tokens.append(top_ids)
+                    lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+            finally:
+                self.onnx.release(context)
         else:
             out_tokens = []
             cache = None
             for i in range(max_len):
+                if cancel_event is not None and cancel_event.is_set():
+                    logging.info('llm decoding cancelled after {} tokens'.format(len(out_tokens)))
+                    break
                 y_pred, cache = self.llm.forward_one_step(lm_input,
                                                           masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]), device=lm_input.device)).to(torch.bool),
                                                           cache=cache)
@@ -528,6 +573,7 @@ class Qwen2LM(TransformerLM):
             sampling: int = 25,
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
+            cancel_event: Optional[threading.Event] = None,
     ) -> Generator[torch.Tensor, None, None]:
 
         device = prompt_text.device
@@ -547,6 +593,9 @@ class Qwen2LM(TransformerLM):
         text_cache = self.llm.model.model.embed_tokens(prompt_text)
         next_fill_index = (int(prompt_speech_token.shape[1] / self.mix_ratio[1]) + 1) * self.mix_ratio[1] - prompt_speech_token.shape[1]
         for this_text in text:
+            if cancel_event is not None and cancel_event.is_set():
+                logging.info('llm decoding cancelled after {} tokens'.format(len(out_tokens)))
+                return
             text_cache = torch.concat([text_cache, self.llm.model.model.embed_tokens(this_text)], dim=1)
             # prompt_speech_token_emb not empty, try append to lm_input
             while prompt_speech_token_emb.size(1) != 0:
@@ -574,6 +623,9 @@ class Qwen2LM(TransformerLM):
                         logging.info('not enough text token to decode, wait for more')
                         continue
                 while True:
+                    if cancel_event is not None and cancel_event.is_set():
+                        logging.info('llm decoding cancelled after {} tokens'.format(len(out_tokens)))
+                        return
                     seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
                     y_pred, cache = self.llm.forward_one_step(lm_input,
                                                               masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
@@ -600,6 +652,9 @@ class Qwen2LM(TransformerLM):
         lm_input = torch.concat([lm_input, text_cache, task_id_emb], dim=1)
         logging.info('no more text token, decode until met eos')
         while True:
+            if cancel_event is not None and cancel_event.is_set():
+                logging.info('llm decoding cancelled after {} tokens'.format(len(out_tokens)))
+                return
             seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
             y_pred, cache = self.llm.forward_one_step(lm_input,
                                                       masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
@@ -715,6 +770,7 @@ class CosyVoice3LM(Qwen2LM):
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
             uuid: str = '',
+            cancel_event: Optional[threading.Event] = None,
     ) -> Generator[torch.Tensor, None, None]:
         device = text.device
         text = torch.concat([prompt_text, text], dim=1)
@@ -735,5 +791,110 @@ class CosyVoice3LM(Qwen2LM):
         max_len = int((text_len - prompt_text_len) * max_token_text_ratio)
 
         # 5. step by step decode
-        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
+        for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid, cancel_event):
             yield token
+
+    @torch.inference_mode()
+    def inference_bistream(
+            self,
+            text: Generator,
+            prompt_text: torch.Tensor,
+            prompt_text_len: torch.Tensor,
+            prompt_speech_token: torch.Tensor,
+            prompt_speech_token_len: torch.Tensor,
+            embedding: torch.Tensor,
+            sampling: int = 25,
+            max_token_text_ratio: float = 20,
+            min_token_text_ratio: float = 2,
+            cancel_event: Optional[threading.Event] = None,
+    ) -> Generator[torch.Tensor, None, None]:
+
+        device = prompt_text.device
+        # 1. prepare input, NOTE cosyvoice3 keeps sos/task_id/fill in speech_embedding
+        sos_emb = self.speech_embedding.weight[self.sos].reshape(1, 1, -1)
+        task_id_emb = self.speech_embedding.weight[self.task_id].reshape(1, 1, -1)
+        if prompt_speech_token_len != 0:
+            prompt_speech_token_emb = self.speech_embedding(prompt_speech_token)
+        else:
+            prompt_speech_token_emb = torch.zeros(1, 0, self.llm_input_size, dtype=self.speech_embedding.weight.dtype).to(device)
+        lm_input = sos_emb
+        # NOTE lm_input_fed marks whether lm_input is already inside the kv cache (last speech token before a fill token)
+        lm_input_fed = False
+
+        # 2. iterate text, interleave mix_ratio[0] text tokens with mix_ratio[1] speech tokens, continuing one kv cache
+        out_tokens = []
+        cache = None
+        text_cache = self.llm.model.model.embed_tokens(prompt_text)
+        text_len = 0
+        next_fill_index = (int(prompt_speech_token.shape[1] / self.mix_ratio[1]) + 1) * self.mix_ratio[1] - prompt_speech_token.shape[1]
+        for this_text in text:
+            if cancel_event is not None and cancel_event.is_set():
+                logging.info('llm decoding cancelled after {} tokens'.format(len(out_tokens)))
+                return
+            text_cache = torch.concat([text_cache, self.llm.model.model.embed_tokens(this_text)], dim=1)
+            text_len += this_text.shape[1]
+            # prompt_speech_token_emb not empty, try append to lm_input
+            while prompt_speech_token_emb.size(1) != 0:
+                if text_cache.size(1) >= self.mix_ratio[0]:
+                    lm_input_text, lm_input_speech = text_cache[:, :self.mix_ratio[0]], prompt_speech_token_emb[:, :self.mix_ratio[1]]
+                    logging.info('append {} text token {} speech token'.format(lm_input_text.size(1), lm_input_speech.size(1)))
+                    lm_input = torch.concat([lm_input, lm_input_text, lm_input_speech], dim=1)
+                    text_cache, prompt_speech_token_emb = text_cache[:, self.mix_ratio[0]:], prompt_speech_token_emb[:, self.mix_ratio[1]:]
+                else:
+                    break
+            if prompt_speech_token_emb.size(1) != 0:
+                continue
+            # no prompt_speech_token_emb remain, can decode some speech token
+            if (len(out_tokens) != 0 and out_tokens[-1] == self.fill_token) or (len(out_tokens) == 0 and lm_input.size(1) == 1):
+                if text_cache.size(1) < self.mix_ratio[0]:
+                    continue
+                lm_input_text = text_cache[:, :self.mix_ratio[0]]
+                logging.info('get fill token, append {} text token'.format(lm_input_text.size(1)))
+                lm_input = lm_input_text if lm_input_fed is True else torch.concat([lm_input, lm_input_text], dim=1)
+                lm_input_fed = False
+                text_cache = text_cache[:, self.mix_ratio[0]:]
+            while True:
+                if cancel_event is not None and cancel_event.is_set():
+                    logging.info('llm decoding cancelled after {} tokens'.format(len(out_tokens)))
+                    return
+                seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
+                y_pred, cache = self.llm.forward_one_step(lm_input,
+                                                          masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
+                                                          cache=cache)
+                lm_input_fed = True
+                logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+                if next_fill_index != -1 and len(out_tokens) == next_fill_index:
+                    top_ids = self.fill_token
+                    next_fill_index += (self.mix_ratio[1] + 1)
+                else:
+                    top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True)
+                out_tokens.append(top_ids)
+                if top_ids == self.fill_token:
+                    logging.info('fill_token index {} next fill_token index {}'.format(len(out_tokens) - 1, next_fill_index))
+                    break
+                yield top_ids
+                lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+                lm_input_fed = False
+
+        # 3. final decode, same layout as the last incomplete group in training: text, task_id, remaining prompt speech
+        lm_input = torch.concat([text_cache, task_id_emb, prompt_speech_token_emb], dim=1) if lm_input_fed is True else \
+            torch.concat([lm_input, text_cache, task_id_emb, prompt_speech_token_emb], dim=1)
+        logging.info('no more text token, decode until met eos')
+        max_len = int(max(text_len, 1) * max_token_text_ratio)
+        while len(out_tokens) < max_len:
+            if cancel_event is not None and cancel_event.is_set():
+                logging.info('llm decoding cancelled after {} tokens'.format(len(out_tokens)))
+                return
+            seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
+            y_pred, cache = self.llm.forward_one_step(lm_input,
+                                                      masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
+                                                      cache=cache)
+            logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
+            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=False)
+            # NOTE same as inference_wrapper, any of the special tokens ends decoding
+            if top_ids in self.stop_token_ids:
+                break
+            out_tokens.append(top_ids)
+            # in stream mode, yield token one by one
+            yield top_ids
+            lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
@@ -18,10 +18,13 @@
 
 import queue
 import random
+import threading
+from contextlib import contextmanager
 from typing import List
 
 import numpy as np
 import torch
+from cosyvoice.utils.memory import memory_stats
 
 IGNORE_ID = -1
 
@@ -138,6 +141,44 @@ def init_weights(m, mean=0.0, std=0.01):
         m.weight.data.normal_(mean, std)
 
 
+_session_rng = threading.local()
+
+
+class SessionRNG:
+    """Random generators of one synthesis session, one per device, all seeded with seed (None keeps the global rng).
+
+    While activated on a thread, llm sampling and the flow / hift noise of that thread draw from them, so a seeded session
+    produces the same speech whatever concurrent sessions do with the global rng.
+    """
+
+    def __init__(self, seed=None):
+        self.seed = seed
+        self.generators = {}
+
+    def generator(self, device):
+        if self.seed is None:
+            return None
+        device = torch.device(device)
+        if device not in self.generators:
+            self.generators[device] = torch.Generator(device=device).manual_seed(self.seed)
+        return self.generators[device]
+
+    @contextmanager
+    def activate(self):
+        previous = getattr(_session_rng, 'current', None)
+        _session_rng.current = self
+        try:
+            yield self
+        finally:
+            _session_rng.current = previous
+
+
+def session_generator(device):
+    """Generator for device of the session activated on this thread, None (global rng) outside a seeded session"""
+    current = getattr(_session_rng, 'current', None)
+    return None if current is None else current.generator(device)
+
+
 # Repetition Aware Sampling in VALL-E 2
 def ras_sampling(weighted_scores, decoded_tokens, sampling, top_p=0.8, top_k=25, win_size=10, tau_r=0.1):
     top_ids = nucleus_sampling(weighted_scores, top_p=top_p, top_k=top_k)
@@ -161,12 +202,12 @@ def nucleus_sampling(weighted_scores, top_p=0.8, top_k=25):
             break
     prob = torch.tensor(prob).to(weighted_scores)
     indices = torch.tensor(indices, dtype=torch.long).to(weighted_scores.device)
-    top_ids = indices[prob.multinomial(1, replacement=True)].item()
+    top_ids = indices[prob.multinomial(1, replacement=True, generator=session_generator(prob.device))].item()
     return top_ids
 
 
 def random_sampling(weighted_scores, decoded_tokens, sampling):
-    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True).item()
+    top_ids = weighted_scores.softmax(dim=0).multinomial(1, replacement=True, generator=session_generator(weighted_scores.device)).item()
     return top_ids
 
 
@@ -215,3 +256,158 @@ class TrtContextWrapper:
 
     def release_estimator(self, context, stream):
         self.trt_context_pool.put([context, stream])
+
+
+class OrtSessionWrapper:
+    """onnxruntime cpu sessions run with io binding over reusable buffers.
+
+    Every context owns fp32 input / output buffers which only grow, bound once per shape, so repeated calls with the
+    same shapes (e.g. the euler steps of a chunk) copy their inputs in place and run without allocation.
+    """
+
+    def __init__(self, onnx_models, ort_concurrent=1, intra_op_num_threads=0, stage=None):
+        import onnxruntime
+        option = onnxruntime.SessionOptions()
+        option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_num_threads > 0:
+            option.intra_op_num_threads = intra_op_num_threads
+        if stage is not None:
+            from cosyvoice.utils.thread_plan import thread_plan
+            thread_plan.apply_ort(option, stage)
+        self.sessions = {k: onnxruntime.InferenceSession(v, sess_options=option, providers=['CPUExecutionProvider'])
+                         for k, v in onnx_models.items() if v is not None}
+        session = next(iter(self.sessions.values()))
+        self.input_names = [i.name for i in session.get_inputs()]
+        self.output_name = session.get_outputs()[0].name
+        self.ort_context_pool = queue.Queue(maxsize=ort_concurrent)
+        for _ in range(ort_concurrent):
+            self.ort_context_pool.put({'key': None, 'buffers': {}})
+
+    def bind(self, context, session, shapes):
+        binding, views = session.io_binding(), {}
+        for name, shape in shapes.items():
+            numel = int(np.prod(shape))
+            buffer = context['buffers'].get(name)
+            if buffer is None or buffer.numel() < numel:
+                # NOTE grow geometrically, growing streaming chunks only reallocate a few times
+                buffer = context['buffers'][name] = torch.empty(max(numel, 2 * buffer.numel() if buffer is not None else 0), dtype=torch.float32)
+            views[name] = buffer[:numel].view(shape)
+            if name == self.output_name:
+                binding.bind_output(name, 'cpu', 0, np.float32, shape, views[name].data_ptr())
+            else:
+                binding.bind_input(name, 'cpu', 0, np.float32, shape, views[name].data_ptr())
+        context['binding'], context['views'] = binding, views
+
+    def run(self, session_key, inputs, output):
+        """Run sessions[session_key] on the list of inputs and copy its output into the output tensor"""
+        inputs = dict(zip(self.input_names, inputs))
+        context = self.ort_context_pool.get()
+        try:
+            key = (session_key, ) + tuple(tuple(value.shape) for value in inputs.values()) + (tuple(output.shape), )
+            if context['key'] != key:
+                shapes = {name: tuple(value.shape) for name, value in inputs.items()}
+                shapes[self.output_name] = tuple(output.shape)
+                self.bind(context, self.sessions[session_key], shapes)
+                context['key'] = key
+            for name, value in inputs.items():
+                context['views'][name].copy_(value)
+            self.sessions[session_key].run_with_iobinding(context['binding'])
+            output.copy_(context['views'][self.output_name])
+        finally:
+            self.ort_context_pool.put(context)
+        return output
+
+
+class OrtEstimatorWrapper(OrtSessionWrapper):
+    """Flow decoder estimator on onnxruntime, called like the torch estimator in forward_estimator.
+
+    Holds the offline graph and optionally the chunk masked streaming one, as with tensorrt the output is written into x.
+    """
+
+    def __init__(self, onnx_model, streaming_onnx_model=None, ort_concurrent=1, intra_op_num_threads=0, stage=None):
+        super().__init__({False: onnx_model, True: streaming_onnx_model}, ort_concurrent, intra_op_num_threads, stage)
+
+    def __call__(self, x, mask, mu, t, spks, cond, streaming=False):
+        # NOTE without a streaming graph, streaming chunks use full attention as in the tensorrt path
+        streaming = streaming is True and True in self.sessions
+        return self.run(streaming, [x, mask, mu, t, spks, cond], x)
+
+
+class OrtHiFTWrapper(OrtSessionWrapper):
+    """HiFT decode body (conv_pre output and source stft to conv_post output) on onnxruntime, see HiFTGenerator.decode_body."""
+
+    def __init__(self, onnx_model, ort_concurrent=1, intra_op_num_threads=0, stage=None):
+        super().__init__({None: onnx_model}, ort_concurrent, intra_op_num_threads, stage)
+        self.out_channels = self.sessions[None].get_outputs()[0].shape[1]
+
+    def __call__(self, x, s_stft):
+        output = torch.empty(x.shape[0], self.out_channels, s_stft.shape[2], dtype=torch.float32)
+        return self.run(None, [x, s_stft], output)
+
+
+class OrtLLMWrapper:
+    """Qwen2 llm prefill and decode step on onnxruntime cpu sessions, with the kv cache in preallocated buffers.
+
+    The cache of a context is time major, [layers, 2, max_cache_len, kv_heads, head_dim], so the past of a decode step
+    is a contiguous prefix bound as input, and every step writes its new keys / values straight into the next slots.
+    """
+
+    def __init__(self, prefill_onnx_model, decode_onnx_model, max_cache_len=4096, max_contexts=4, intra_op_num_threads=0, stage=None):
+        import onnxruntime
+        option = onnxruntime.SessionOptions()
+        option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if intra_op_num_threads > 0:
+            option.intra_op_num_threads = intra_op_num_threads
+        if stage is not None:
+            from cosyvoice.utils.thread_plan import thread_plan
+            thread_plan.apply_ort(option, stage)
+        self.prefill_session = onnxruntime.InferenceSession(prefill_onnx_model, sess_options=option, providers=['CPUExecutionProvider'])
+        self.decode_session = onnxruntime.InferenceSession(decode_onnx_model, sess_options=option, providers=['CPUExecutionProvider'])
+        past = [i for i in self.decode_session.get_inputs() if i.name.startswith('past_key_')]
+        self.num_layers, self.kv_heads, self.head_dim = len(past), past[0].shape[1], past[0].shape[2]
+        self.vocab_size = self.decode_session.get_outputs()[0].shape[1]
+        self.max_cache_len, self.max_contexts = max_cache_len, max_contexts
+        self.context_bytes = 4 * (self.num_layers * 2 * max_cache_len * self.kv_heads * self.head_dim + self.vocab_size)
+        # NOTE contexts are created on demand up to max_contexts and reused, further sessions wait for a released one
+        self.ort_context_pool = queue.Queue()
+        self.num_contexts = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            create = self.ort_context_pool.empty() and self.num_contexts < self.max_contexts
+            if create:
+                self.num_contexts += 1
+                memory_stats.reserve('onnx_llm_kv_cache', self.num_contexts * self.context_bytes)
+        if create is False:
+            return self.ort_context_pool.get()
+        return {'cache': torch.empty(self.num_layers, 2, self.max_cache_len, self.kv_heads, self.head_dim, dtype=torch.float32),
+                'logp': torch.empty(1, self.vocab_size, dtype=torch.float32),
+                'cache_len': 0}
+
+    def release(self, context):
+        self.ort_context_pool.put(context)
+
+    def run(self, session, context, inputs_embeds, past_len):
+        inputs_embeds = inputs_embeds.float().contiguous()
+        seq_len, cache = inputs_embeds.shape[1], context['cache']
+        assert past_len + seq_len <= self.max_cache_len, 'kv cache of {} positions exceeded'.format(self.max_cache_len)
+        binding = session.io_binding()
+        binding.bind_input('inputs_embeds', 'cpu', 0, np.float32, tuple(inputs_embeds.shape), inputs_embeds.data_ptr())
+        for i in range(self.num_layers):
+            for j, name in enumerate(['key', 'value']):
+                if past_len != 0:
+                    binding.bind_input('past_{}_{}'.format(name, i), 'cpu', 0, np.float32,
+                                       (past_len, self.kv_heads, self.head_dim), cache[i, j].data_ptr())
+                binding.bind_output('{}_{}'.format(name, i), 'cpu', 0, np.float32,
+                                    (seq_len, self.kv_heads, self.head_dim), cache[i, j, past_len].data_ptr())
+        binding.bind_output('logp', 'cpu', 0, np.float32, tuple(context['logp'].shape), context['logp'].data_ptr())
+        session.run_with_iobinding(binding)
+        context['cache_len'] = past_len + seq_len
+        return context['logp']
+
+    def prefill(self, context, lm_input):
+        return self.run(self.prefill_session, context, lm_input, 0)
+
+    def decode(self, context, lm_input):
+        return self.run(self.decode_session, context, lm_input, context['cache_len'])
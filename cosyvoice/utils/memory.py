@@ -0,0 +1,126 @@
+import os
+import ctypes
+import ctypes.util
+import resource
+import threading
+from contextlib import contextmanager
+import torch
+
+
+class _MallInfo2(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_size_t) for name in
+                ('arena', 'ordblks', 'smblks', 'hblks', 'hblkhd', 'usmblks', 'fsmblks', 'uordblks', 'fordblks', 'keepcost')]
+
+
+def _load_mallinfo2():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        mallinfo2 = libc.mallinfo2
+    except (OSError, AttributeError, TypeError):
+        return None
+    mallinfo2.restype = _MallInfo2
+    return mallinfo2
+
+
+_mallinfo2 = _load_mallinfo2()
+_page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def rss_bytes():
+    """Current resident set size of the process."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _page_size
+    except (OSError, IndexError, ValueError):
+        # NOTE no procfs (e.g. macOS), fall back to the peak which is all getrusage offers
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes():
+    # NOTE ru_maxrss is in KB on linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def allocator_bytes():
+    """Bytes currently handed out by the tensor allocator.
+
+    On cuda this is the caching allocator's live bytes, on cpu torch allocates through malloc so glibc's
+    in-use heap and mmap'ed chunks are reported instead, None if neither is available.
+    """
+    if torch.cuda.is_available():
+        return torch.cuda.memory_allocated()
+    if _mallinfo2 is not None:
+        info = _mallinfo2()
+        return info.uordblks + info.hblkhd
+    return None
+
+
+def tensor_bytes(obj):
+    """Bytes held by the tensors inside (possibly nested) dicts, lists and tuples, e.g. per session caches."""
+    if obj is None:
+        return 0
+    if isinstance(obj, torch.Tensor):
+        # NOTE quantized tensor subclasses (torchao int4) report the float dtype, count the packed tensors they wrap instead
+        if hasattr(obj, '__tensor_flatten__'):
+            return tensor_bytes([getattr(obj, k) for k in obj.__tensor_flatten__()[0]])
+        return obj.numel() * obj.element_size()
+    if isinstance(obj, dict):
+        return sum(tensor_bytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(tensor_bytes(v) for v in obj)
+    # huggingface Cache objects
+    if hasattr(obj, 'key_cache') and hasattr(obj, 'value_cache'):
+        return tensor_bytes(obj.key_cache) + tensor_bytes(obj.value_cache)
+    return 0
+
+
+class MemoryStats:
+    """Process wide RSS / allocator samples taken around each instrumented stage."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.peak_allocator = 0
+        self.reserved = {}
+
+    def record(self, stage, rss_before, rss_after, allocator_before, allocator_after):
+        with self.lock:
+            stats = self.stages.setdefault(stage, {'count': 0, 'peak_rss': 0, 'max_rss_delta': 0, 'peak_allocator': 0, 'max_allocator_delta': 0})
+            stats['count'] += 1
+            stats['peak_rss'] = max(stats['peak_rss'], rss_after)
+            stats['max_rss_delta'] = max(stats['max_rss_delta'], rss_after - rss_before)
+            if allocator_after is not None:
+                stats['peak_allocator'] = max(stats['peak_allocator'], allocator_after)
+                stats['max_allocator_delta'] = max(stats['max_allocator_delta'], allocator_after - allocator_before)
+                self.peak_allocator = max(self.peak_allocator, allocator_after)
+
+    def reserve(self, name, num_bytes):
+        """Bytes preallocated outside of any session, e.g. the kv cache contexts of the onnx llm"""
+        with self.lock:
+            self.reserved[name] = num_bytes
+
+    @contextmanager
+    def sample(self, stage):
+        rss_before, allocator_before = rss_bytes(), allocator_bytes()
+        try:
+            yield
+        finally:
+            self.record(stage, rss_before, rss_bytes(), allocator_before, allocator_bytes())
+
+    def snapshot(self):
+        allocator = allocator_bytes()
+        with self.lock:
+            stages = {k: dict(v) for k, v in self.stages.items()}
+            peak_allocator = self.peak_allocator
+            reserved = dict(self.reserved)
+        rss = rss_bytes()
+        snapshot = {'rss': rss, 'peak_rss': max(rss, peak_rss_bytes()), 'allocator': allocator, 'peak_allocator': peak_allocator, 'stages': stages,
+                    'reserved': reserved}
+        if torch.cuda.is_available():
+            snapshot['cuda_reserved'] = torch.cuda.memory_reserved()
+            snapshot['cuda_peak_allocated'] = torch.cuda.max_memory_allocated()
+        return snapshot
+
+
+memory_stats = MemoryStats()
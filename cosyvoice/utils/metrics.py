@@ -0,0 +1,174 @@
+import time
+import functools
+import threading
+from contextlib import contextmanager
+import torch
+from cosyvoice.utils.memory import memory_stats, rss_bytes, allocator_bytes
+try:
+    from prometheus_client import Counter, Gauge, Histogram
+    prometheus_available = True
+except ImportError:
+    prometheus_available = False
+
+
+class NoopMetric:
+    """Stand-in used when prometheus_client is not installed, every call is a no-op."""
+
+    def labels(self, *args, **kwargs):
+        return self
+
+    def observe(self, value):
+        pass
+
+    def inc(self, amount=1):
+        pass
+
+    def dec(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+
+def _build(metric_type, name, documentation, labelnames=(), **kwargs):
+    if prometheus_available is False:
+        return NoopMetric()
+    return {'counter': Counter, 'gauge': Gauge, 'histogram': Histogram}[metric_type](name, documentation, labelnames, **kwargs)
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+RTF_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0)
+TOKEN_RATE_BUCKETS = (5, 10, 25, 50, 75, 100, 150, 200, 300, 500)
+
+# frontend, text normalization and prompt feature extraction
+FRONTEND_SECONDS = _build('histogram', 'cosyvoice_frontend_seconds', 'Frontend time per call', ['stage'], buckets=LATENCY_BUCKETS)
+# llm
+LLM_TTFT_SECONDS = _build('histogram', 'cosyvoice_llm_time_to_first_token_seconds', 'Time from llm job start to first speech token',
+                          buckets=LATENCY_BUCKETS)
+LLM_TOKENS_PER_SECOND = _build('histogram', 'cosyvoice_llm_tokens_per_second', 'Speech tokens decoded per second per session',
+                               buckets=TOKEN_RATE_BUCKETS)
+# token2wav
+FLOW_SECONDS = _build('histogram', 'cosyvoice_flow_seconds', 'Flow matching time per chunk', buckets=LATENCY_BUCKETS)
+HIFT_SECONDS = _build('histogram', 'cosyvoice_hift_seconds', 'Vocoder time per chunk', buckets=LATENCY_BUCKETS)
+RTF = _build('histogram', 'cosyvoice_rtf', 'Real time factor per yielded chunk', buckets=RTF_BUCKETS)
+INFLIGHT_SESSIONS = _build('gauge', 'cosyvoice_inflight_sessions', 'Number of running tts sessions')
+TOKEN_BUFFER_DEPTH = _build('gauge', 'cosyvoice_token_buffer_depth', 'Speech tokens decoded by the llm but not yet vocoded, over all sessions')
+TOKEN2WAV_SLOT_WAIT_SECONDS = _build('histogram', 'cosyvoice_token2wav_slot_wait_seconds', 'Time a tts session waits for a token2wav process slot',
+                                     buckets=LATENCY_BUCKETS)
+TOKEN2WAV_SESSIONS = _build('gauge', 'cosyvoice_token2wav_sessions', 'Tts sessions assigned to each token2wav process', ['worker'])
+# serving
+REQUESTS = _build('counter', 'cosyvoice_requests_total', 'Speech requests by final status and response format', ['status', 'format'])
+QUEUE_WAIT_SECONDS = _build('histogram', 'cosyvoice_queue_wait_seconds', 'Time a synthesis waits for a worker thread', buckets=LATENCY_BUCKETS)
+TTFB_SECONDS = _build('histogram', 'cosyvoice_ttfb_seconds', 'Time from request arrival to first audio byte', ['format'], buckets=LATENCY_BUCKETS)
+CACHE_SIZE = _build('gauge', 'cosyvoice_cache_size', 'Number of entries / bytes held by each cache', ['cache', 'unit'])
+# memory
+MEMORY_BYTES = _build('gauge', 'cosyvoice_memory_bytes', 'Process memory by kind (rss, peak_rss, allocator)', ['kind'])
+SESSION_BYTES = _build('gauge', 'cosyvoice_session_bytes', 'Bytes held by live tts sessions (token buffers, flow/hift caches, llm kv cache)')
+# startup
+STARTUP_SECONDS = _build('gauge', 'cosyvoice_startup_seconds', 'Wall time of each model loading phase', ['phase'])
+# threads
+STAGE_THREADS = _build('gauge', 'cosyvoice_stage_threads', 'Intra op threads of the stage workers currently running, per stage', ['stage'])
+THREAD_OVERSUBSCRIPTION = _build('counter', 'cosyvoice_thread_oversubscription_total', 'Stage entries that found more busy intra op threads than cores')
+
+
+_local = threading.local()
+
+
+class RequestTimings:
+    """Stage durations and counters of a single request.
+
+    Filled by the same hooks that feed the global metrics, for the thread the timings are activated on.
+    Threads spawned for the request (e.g. llm_job) receive the object explicitly.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self.stages = {}
+        self.info = {}
+
+    @contextmanager
+    def activate(self):
+        previous = getattr(_local, 'timings', None)
+        _local.timings = self
+        try:
+            yield self
+        finally:
+            _local.timings = previous
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages.setdefault(stage, []).append(seconds)
+
+    def set(self, key, value):
+        with self.lock:
+            self.info[key] = value
+
+    def incr(self, key, amount=1):
+        with self.lock:
+            self.info[key] = self.info.get(key, 0) + amount
+
+    def peak(self, key, value):
+        with self.lock:
+            self.info[key] = max(self.info.get(key, value), value)
+
+    def finish(self):
+        self.end_time = time.perf_counter()
+
+    def to_dict(self):
+        with self.lock:
+            stages = {k: {'count': len(v), 'total_ms': round(sum(v) * 1000, 2), 'ms': [round(i * 1000, 2) for i in v]}
+                      for k, v in self.stages.items()}
+            info = dict(self.info)
+        total = (self.end_time or time.perf_counter()) - self.start_time
+        return {'finished': self.end_time is not None, 'total_ms': round(total * 1000, 2), 'stages': stages, 'info': info}
+
+    def server_timing(self):
+        # NOTE Server-Timing header, one metric per stage with the summed duration
+        summary = self.to_dict()
+        entries = ['{};dur={};desc="{} call(s)"'.format(k, v['total_ms'], v['count']) for k, v in summary['stages'].items()]
+        entries += ['{};desc="{}"'.format(k, v) for k, v in summary['info'].items()]
+        entries.append('total;dur={}'.format(summary['total_ms']))
+        return ', '.join(entries)
+
+
+def current_timings():
+    return getattr(_local, 'timings', None)
+
+
+@contextmanager
+def timer(metric, sync=False, stage=None):
+    timings = current_timings() if stage is not None else None
+    # NOTE cuda kernels are asynchronous, sync=True makes the observed time cover the gpu work of this stage
+    sync = sync and (prometheus_available or timings is not None) and torch.cuda.is_available()
+    if sync:
+        torch.cuda.synchronize()
+    if stage is not None:
+        rss_before, allocator_before = rss_bytes(), allocator_bytes()
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        if sync:
+            torch.cuda.synchronize()
+        seconds = time.perf_counter() - start_time
+        metric.observe(seconds)
+        if stage is not None:
+            rss_after, allocator_after = rss_bytes(), allocator_bytes()
+            memory_stats.record(stage, rss_before, rss_after, allocator_before, allocator_after)
+        if timings is not None:
+            timings.add(stage, seconds)
+            timings.peak('peak_rss_mb', round(rss_after / 2 ** 20, 1))
+            if allocator_after is not None:
+                timings.peak('peak_allocator_mb', round(allocator_after / 2 ** 20, 1))
+
+
+def timed(metric, stage=None):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(metric, stage=stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
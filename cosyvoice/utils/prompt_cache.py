@@ -0,0 +1,75 @@
+import os
+import threading
+from collections import OrderedDict
+import torch
+
+
+class PromptCache:
+    """LRU cache of zero shot prompt features (frontend_zero_shot model_input without the tts text).
+
+    Entries are keyed by (prompt wav path, its mtime, prompt text, resample rate) and bounded by
+    the number of entries, so that every segment of a request and later requests of the same
+    voice skip the speech feat / speech token / embedding extraction. A replaced prompt wav gets
+    a new mtime and misses the cache.
+    """
+
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'saves': 0, 'evictions': 0}
+
+    @staticmethod
+    def make_key(prompt_wav, prompt_text, resample_rate):
+        return (prompt_wav, os.path.getmtime(prompt_wav), prompt_text, resample_rate)
+
+    def get(self, key):
+        with self.lock:
+            model_input = self.entries.get(key)
+            if model_input is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            # callers add / delete keys of model_input, so hand out a copy
+            return dict(model_input)
+
+    def put(self, key, model_input):
+        if self.max_entries <= 0:
+            return
+        model_input = dict(model_input)
+        nbytes = self._nbytes(model_input)
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self._nbytes(self.entries.pop(key))
+            self.entries[key] = model_input
+            self.total_bytes += nbytes
+            self.stats['saves'] += 1
+            while len(self.entries) > self.max_entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= self._nbytes(evicted)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, prompt_wav):
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == prompt_wav]:
+                self.total_bytes -= self._nbytes(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def get_stats(self):
+        with self.lock:
+            total_requests = self.stats['hits'] + self.stats['misses']
+            hit_rate = self.stats['hits'] / total_requests * 100 if total_requests > 0 else 0
+            return {**self.stats, 'prompts': len(self.entries), 'bytes': self.total_bytes,
+                    'max_entries': self.max_entries, 'hit_rate': round(hit_rate, 2)}
+
+    @staticmethod
+    def _nbytes(model_input):
+        # NOTE llm_embedding / flow_embedding and the llm / flow speech tokens are the same tensors, count them once
+        tensors = {id(v): v for v in model_input.values() if isinstance(v, torch.Tensor)}
+        return sum(v.numel() * v.element_size() for v in tensors.values())
@@ -0,0 +1,77 @@
+import os
+import json
+import itertools
+import torch
+from cosyvoice.utils.file_utils import logging
+
+QUANTIZE_MODES = ['int8', 'int4']
+
+
+def quantize_int8(module, names=None):
+    """Dynamic int8 quantization of the Linear layers of module (or only of its submodules in names), in place.
+
+    Weights are stored as int8 with per tensor scales, activations are quantized on the fly, cpu (fbgemm / onednn) only.
+    """
+    qconfig_spec = {torch.nn.Linear} if names is None else set(names)
+    return torch.ao.quantization.quantize_dynamic(module, qconfig_spec, dtype=torch.qint8, inplace=True)
+
+
+def quantize_int4_weight_only(module, group_size=128):
+    """Weight only int4 with per group scales, needs torchao and a torch build with cpu int4 kernels."""
+    try:
+        from torchao.quantization import quantize_, int4_weight_only
+    except ImportError:
+        raise ImportError('weight only int4 needs torchao, pip install torchao, or use quantize="int8"')
+    quantize_(module, int4_weight_only(group_size=group_size))
+    return module
+
+
+def quantize_model(model, mode, exclude=()):
+    """Quantize the llm backbone, llm_decoder and flow estimator of a CosyVoice*Model in place.
+
+    int8: dynamic int8 Linear layers everywhere. int4: weight only int4 for the llm backbone, dynamic int8 for the rest.
+    exclude lists submodules to keep in float, among 'llm', 'llm_decoder' and 'estimator'.
+    """
+    assert mode in QUANTIZE_MODES, 'quantize should be one of {}, got {}'.format(QUANTIZE_MODES, mode)
+    if model.llm is None:
+        exclude = list(exclude) + ['llm', 'llm_decoder']
+    if mode == 'int4' and 'llm' not in exclude:
+        quantize_int4_weight_only(model.llm.llm)
+        exclude = list(exclude) + ['llm']
+    llm_names = [name for name in ['llm', 'llm_decoder'] if name not in exclude]
+    if len(llm_names) != 0:
+        quantize_int8(model.llm, llm_names)
+    if 'estimator' not in exclude:
+        quantize_int8(model.flow.decoder.estimator)
+    logging.info('quantized llm/flow estimator to {}, excluded {}'.format(mode, list(exclude)))
+    return model
+
+
+def quantized_checkpoint(model_dir, name, mode):
+    return '{}/{}.{}.pt'.format(model_dir, name, mode)
+
+
+def prepare_quantized(model, model_dir, mode):
+    """Convert a freshly built model to the quantized structure when serialized checkpoints of mode exist.
+
+    Returns the llm / flow checkpoints to load instead of llm.pt / flow.pt, or None when they have not been exported yet.
+    """
+    llm_model, flow_model = quantized_checkpoint(model_dir, 'llm', mode), quantized_checkpoint(model_dir, 'flow', mode)
+    if not os.path.exists(llm_model) or not os.path.exists(flow_model):
+        return None
+    exclude = []
+    if os.path.exists('{}/quantize.{}.json'.format(model_dir, mode)):
+        with open('{}/quantize.{}.json'.format(model_dir, mode), 'r') as f:
+            exclude = json.load(f)['exclude']
+    # NOTE weights are not initialized yet (skip_init_weights), zero them so the quantization observers see finite values
+    for param in itertools.chain(*[module.parameters() for module in [model.llm, model.flow] if module is not None]):
+        param.data.zero_()
+    quantize_model(model, mode, exclude)
+    return llm_model, flow_model
+
+
+def save_quantized(model, model_dir, mode, exclude=()):
+    torch.save(model.llm.state_dict(), quantized_checkpoint(model_dir, 'llm', mode))
+    torch.save(model.flow.state_dict(), quantized_checkpoint(model_dir, 'flow', mode))
+    with open('{}/quantize.{}.json'.format(model_dir, mode), 'w') as f:
+        json.dump({'exclude': list(exclude)}, f)
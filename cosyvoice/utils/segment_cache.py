@@ -0,0 +1,104 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import torch
+from cosyvoice.utils.common import fade_in_out
+
+
+class SegmentCache:
+    """LRU cache of synthesized speech for single text_normalize segments.
+
+    Entries are keyed by (voice, normalized segment text, speed, seed) and bounded by
+    the total number of bytes held, so that fixed greetings / disclaimers are only
+    synthesized once and spliced into later requests.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'saves': 0, 'evictions': 0}
+
+    @staticmethod
+    def make_key(voice, text, speed, seed):
+        return (voice, text, float(speed), seed)
+
+    def get(self, key):
+        with self.lock:
+            speech = self.entries.get(key)
+            if speech is None:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return speech
+
+    def put(self, key, speech):
+        speech = speech.detach().cpu().clone()
+        nbytes = self._nbytes(speech)
+        if nbytes > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self._nbytes(self.entries.pop(key))
+            self.entries[key] = speech
+            self.total_bytes += nbytes
+            self.stats['saves'] += 1
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= self._nbytes(evicted)
+                self.stats['evictions'] += 1
+
+    def invalidate(self, voice):
+        # voice keys may carry the prompt text as suffix, e.g. 'path/to/prompt.wav|prompt text'
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == voice or k[0].startswith('{}|'.format(voice))]:
+                self.total_bytes -= self._nbytes(self.entries.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def get_stats(self):
+        with self.lock:
+            total_requests = self.stats['hits'] + self.stats['misses']
+            hit_rate = self.stats['hits'] / total_requests * 100 if total_requests > 0 else 0
+            return {**self.stats, 'segments': len(self.entries), 'bytes': self.total_bytes,
+                    'max_bytes': self.max_bytes, 'hit_rate': round(hit_rate, 2)}
+
+    @staticmethod
+    def _nbytes(speech):
+        return speech.numel() * speech.element_size()
+
+
+class SegmentSplicer:
+    """Joins consecutive segments with a short crossfade.
+
+    The last overlap_len samples pushed are always held back, so that the head of the
+    next segment can be faded in over them with fade_in_out. Call flush() at the end.
+    """
+
+    def __init__(self, sample_rate, crossfade_ms=20):
+        self.overlap_len = int(sample_rate * crossfade_ms / 1000)
+        self.window = np.hamming(2 * self.overlap_len)
+        self.tail = None
+        self.segment_start = False
+
+    def start_segment(self):
+        self.segment_start = True
+
+    def push(self, speech):
+        if self.tail is not None:
+            if self.segment_start is True and speech.shape[1] >= self.overlap_len:
+                speech = fade_in_out(speech, self.tail, self.window)
+            else:
+                speech = torch.concat([self.tail, speech], dim=1)
+        self.segment_start = False
+        self.tail = speech[:, -self.overlap_len:]
+        return speech[:, :-self.overlap_len]
+
+    def flush(self):
+        tail, self.tail = self.tail, None
+        return tail if tail is not None else torch.zeros(1, 0)
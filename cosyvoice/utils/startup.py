@@ -0,0 +1,118 @@
+import os
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+import torch
+from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.metrics import STARTUP_SECONDS
+
+_INIT_FUNCTIONS = ['uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_', 'eye_', 'dirac_',
+                   'xavier_uniform_', 'xavier_normal_', 'kaiming_uniform_', 'kaiming_normal_', 'orthogonal_', 'sparse_']
+_skip_init = False
+
+
+def _no_init(tensor, *args, **kwargs):
+    return tensor
+
+
+@contextmanager
+def skip_init_weights():
+    """Build modules without running torch.nn.init, their weights are garbage until a checkpoint is loaded.
+
+    Only use this when a strict load_state_dict follows. Construction on the meta device is not an option,
+    modules such as DiT and the positional encodings compute tensors in __init__ that are not in the checkpoint.
+    """
+    global _skip_init
+    saved = {name: getattr(torch.nn.init, name) for name in _INIT_FUNCTIONS}
+    for name in _INIT_FUNCTIONS:
+        setattr(torch.nn.init, name, _no_init)
+    _skip_init = True
+    try:
+        yield
+    finally:
+        for name, func in saved.items():
+            setattr(torch.nn.init, name, func)
+        _skip_init = False
+
+
+def init_skipped():
+    return _skip_init
+
+
+def checkpoint_fingerprint(path):
+    """Size and digest of the last MiB of a checkpoint, the zip central directory of torch.save holds the crc32 of every
+    record there, so a changed checkpoint changes its tail without hashing the whole file"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        f.seek(max(0, size - 2 ** 20))
+        return '{}:{}'.format(size, hashlib.sha1(f.read()).hexdigest())
+
+
+def load_checkpoint(path, device):
+    """torch.load of a state dict, preferring a safetensors copy next to it (see cosyvoice/bin/export_safetensors.py).
+
+    Both are memory mapped, so the file is paged in while copying into the parameters instead of read up front.
+    The copy is only used when it was exported from the checkpoint at path as it is now.
+    """
+    safetensors_path = '{}.safetensors'.format(os.path.splitext(path)[0])
+    if os.path.exists(safetensors_path):
+        from safetensors import safe_open
+        from safetensors.torch import load_file
+        with safe_open(safetensors_path, framework='pt') as f:
+            source = (f.metadata() or {}).get('source_fingerprint')
+        if not os.path.exists(path) or source == checkpoint_fingerprint(path):
+            return load_file(safetensors_path, device=str(device))
+        logging.warning('{} was not exported from the current {}, load the checkpoint instead, '
+                        're-run cosyvoice/bin/export_safetensors.py'.format(safetensors_path, path))
+    try:
+        return torch.load(path, map_location=device, mmap=True)
+    except RuntimeError:
+        # NOTE legacy (non zipfile) checkpoints can not be memory mapped
+        return torch.load(path, map_location=device)
+
+
+class StartupTimer:
+    """Wall time of each model loading phase, phases may overlap when loaded concurrently."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.perf_counter()
+            self.phases = {}
+
+    @contextmanager
+    def phase(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            end_time = time.perf_counter()
+            with self.lock:
+                self.phases[name] = {'start': start_time - self.start_time, 'seconds': end_time - start_time}
+            STARTUP_SECONDS.labels(phase=name).set(end_time - start_time)
+
+    def wrap(self, name, func):
+        def wrapped(*args, **kwargs):
+            with self.phase(name):
+                return func(*args, **kwargs)
+        return wrapped
+
+    def report(self):
+        with self.lock:
+            phases = sorted(self.phases.items(), key=lambda x: x[1]['start'])
+            total = time.perf_counter() - self.start_time
+        return {'total': round(total, 3), 'phases': {k: {'start': round(v['start'], 3), 'seconds': round(v['seconds'], 3)} for k, v in phases}}
+
+    def log(self):
+        report = self.report()
+        for name, phase in report['phases'].items():
+            logging.info('startup {:<28} {:>7.2f}s (at +{:.2f}s)'.format(name, phase['seconds'], phase['start']))
+        logging.info('startup total {:.2f}s'.format(report['total']))
+        return report
+
+
+startup_timer = StartupTimer()
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+import torch
+from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.metrics import STAGE_THREADS, THREAD_OVERSUBSCRIPTION
+
+STAGES = ['frontend', 'llm', 'flow', 'hift']
+# NOTE CosyVoiceFrontEnd has always run its onnx sessions single threaded
+DEFAULT_INTRA = {'frontend': 1}
+
+
+def parse_cores(spec):
+    """'0-3,8,10-11' or a list of cpu ids to a sorted list of cpu ids"""
+    if isinstance(spec, (list, tuple)):
+        return sorted(set(int(i) for i in spec))
+    cores = set()
+    for part in str(spec).split(','):
+        part = part.strip()
+        if part == '':
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cores.update(range(int(start), int(end) + 1))
+        else:
+            cores.add(int(part))
+    return sorted(cores)
+
+
+def format_cores(cores):
+    ranges, start = [], None
+    for i, core in enumerate(cores):
+        if start is None:
+            start = core
+        if i + 1 == len(cores) or cores[i + 1] != core + 1:
+            ranges.append(str(start) if start == core else '{}-{}'.format(start, core))
+            start = None
+    return ','.join(ranges)
+
+
+def numa_cores(node):
+    with open('/sys/devices/system/node/node{}/cpulist'.format(node), 'r') as f:
+        return parse_cores(f.read().strip())
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+class ThreadPlan:
+    """Intra / inter op threads and cpu cores of every inference stage: frontend (onnx), llm, flow and hift.
+
+    A stage is {"intra": threads, "inter": threads, "cores": "0-3" or [0, 1, 2, 3], "numa": node}, every key optional,
+    pinned stages default to one intra op thread per core and unplanned stages keep the torch / onnxruntime defaults.
+    Torch stages are applied to the calling thread when it enters the stage, torch.set_num_threads is per thread with
+    the OpenMP backend and sched_setaffinity pins the thread, so the OpenMP team it starts afterwards inherits both.
+    Onnxruntime stages are applied to the session options when the session is created.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.generation = 0
+        self.last_warning = 0
+        self.configure(None)
+
+    def configure(self, spec=None, concurrency=1):
+        """spec is None (defaults), 'auto', a json string, a json file or a dict; concurrency is the expected number
+        of concurrent syntheses, used by the oversubscription check of report"""
+        if isinstance(spec, str) and spec != 'auto':
+            if os.path.exists(spec):
+                with open(spec, 'r') as f:
+                    spec = json.load(f)
+            else:
+                spec = json.loads(spec)
+        cores = available_cores()
+        if spec == 'auto':
+            spec = self.auto(cores)
+        spec = spec or {}
+        assert set(spec) <= set(STAGES), 'thread plan stages should be among {}, got {}'.format(STAGES, list(spec))
+        stages = {}
+        for name, stage in spec.items():
+            stage = dict(stage)
+            if 'numa' in stage:
+                stage['cores'] = [i for i in numa_cores(stage.pop('numa')) if i in cores]
+            if 'cores' in stage:
+                stage['cores'] = parse_cores(stage['cores'])
+                assert len(stage['cores']) != 0 and set(stage['cores']) <= set(cores), \
+                    'cores of stage {} should be a non empty subset of the available cores {}'.format(name, format_cores(cores))
+                stage.setdefault('intra', len(stage['cores']))
+            stages[name] = stage
+        with self.lock:
+            self.stages, self.cores, self.concurrency = stages, cores, concurrency
+            self.active = {name: 0 for name in STAGES}
+            self.generation += 1
+        inter = [stages[name]['inter'] for name in ['llm', 'flow', 'hift'] if 'inter' in stages.get(name, {})]
+        if len(inter) != 0:
+            try:
+                # NOTE torch inter op threads are process wide and can only be set before the pool starts
+                torch.set_num_interop_threads(max(inter))
+            except RuntimeError:
+                logging.warning('torch inter op threads already started, ignore inter of the thread plan')
+        return self
+
+    @staticmethod
+    def auto(cores):
+        """One core for the frontend, up to 4 for llm decoding (small, memory bound matmuls), the rest for flow and hift,
+        which run one after the other in the request thread, all disjoint"""
+        if len(cores) < 4:
+            return {}
+        num_llm = max(1, min(4, (len(cores) - 1) // 3))
+        vocoder = cores[1 + num_llm:]
+        return {'frontend': {'cores': cores[:1]}, 'llm': {'cores': cores[1:1 + num_llm]},
+                'flow': {'cores': vocoder}, 'hift': {'cores': vocoder}}
+
+    def threads(self, name):
+        # NOTE read the torch threads lazily, so --threads / torch.set_num_threads of the caller stay the default
+        return self.stages.get(name, {}).get('intra', DEFAULT_INTRA.get(name, torch.get_num_threads()))
+
+    def apply_ort(self, option, name):
+        """Apply stage name to onnxruntime SessionOptions"""
+        stage = self.stages.get(name, {})
+        if 'intra' in stage:
+            option.intra_op_num_threads = stage['intra']
+        if 'inter' in stage:
+            option.inter_op_num_threads = stage['inter']
+        if 'cores' in stage and stage['intra'] > 1:
+            # NOTE one core per intra op thread besides the calling one, onnxruntime numbers processors from 1
+            cores = stage['cores']
+            option.add_session_config_entry('session.intra_op_thread_affinities',
+                                            ';'.join(str(cores[i % len(cores)] + 1) for i in range(1, stage['intra'])))
+        return option
+
+    def enter(self, name):
+        """Apply the torch threads and cores of stage name to the calling thread, a no-op when it is already in it.
+
+        Unplanned stages leave the thread as the caller set it up, or restore it when it comes from a planned stage.
+        """
+        key = (self.generation, name)
+        if getattr(self.local, 'key', None) == key:
+            return
+        stage = self.stages.get(name, {})
+        if 'intra' not in stage and 'cores' not in stage:
+            if getattr(self.local, 'original', None) is not None:
+                self.apply(*self.local.original)
+                self.local.original = None
+            self.local.key = key
+            return
+        if getattr(self.local, 'original', None) is None:
+            self.local.original = (torch.get_num_threads(), os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else None)
+        self.apply(stage.get('intra', self.local.original[0]), stage.get('cores', self.local.original[1]))
+        self.local.key = key
+
+    @staticmethod
+    def apply(threads, cores):
+        torch.set_num_threads(threads)
+        if cores is not None and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cores)
+
+    @contextmanager
+    def stage(self, name):
+        """Run the block as a worker of stage name, accounting its threads to detect oversubscription at runtime"""
+        self.enter(name)
+        with self.lock:
+            self.active[name] += 1
+            busy = sum(self.active[k] * self.threads(k) for k in STAGES)
+            STAGE_THREADS.labels(stage=name).set(self.active[name] * self.threads(name))
+            warn = busy > len(self.cores) and time.time() - self.last_warning > 60
+            if warn:
+                self.last_warning = time.time()
+        if busy > len(self.cores):
+            THREAD_OVERSUBSCRIPTION.inc()
+            if warn:
+                logging.warning('{} intra op threads busy on {} cores, stages {}'.format(busy, len(self.cores), self.active))
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active[name] -= 1
+                STAGE_THREADS.labels(stage=name).set(self.active[name] * self.threads(name))
+
+    def report(self):
+        with self.lock:
+            stages = {name: {'intra': self.threads(name),
+                             'inter': self.stages.get(name, {}).get('inter'),
+                             'cores': format_cores(self.stages[name]['cores']) if 'cores' in self.stages.get(name, {}) else 'all',
+                             'planned': name in self.stages} for name in STAGES}
+            # NOTE per request the frontend runs first, then the llm thread decodes while the request thread runs flow then hift
+            per_request = max(self.threads('frontend'), self.threads('llm') + max(self.threads('flow'), self.threads('hift')))
+            report = {'cores': len(self.cores), 'concurrency': self.concurrency, 'peak_threads': per_request * self.concurrency,
+                      'parallel_backend': 'OpenMP' if 'OpenMP' in torch.__config__.parallel_info() else 'other', 'stages': stages}
+            pinned = {name: set(self.stages[name]['cores']) for name in ['llm', 'flow', 'hift'] if 'cores' in self.stages.get(name, {})}
+        warnings = []
+        if report['peak_threads'] > report['cores']:
+            warnings.append('{} concurrent requests peak at {} intra op threads on {} cores'.format(
+                report['concurrency'], report['peak_threads'], report['cores']))
+        for name in ['flow', 'hift']:
+            if 'llm' in pinned and name in pinned and len(pinned['llm'] & pinned[name]) != 0:
+                warnings.append('llm and {} run concurrently on shared cores {}'.format(name, format_cores(sorted(pinned['llm'] & pinned[name]))))
+        if report['parallel_backend'] != 'OpenMP' and len(set(self.threads(name) for name in ['llm', 'flow', 'hift'])) > 1:
+            warnings.append('torch threads are process wide without the OpenMP backend, per stage intra op threads do not apply')
+        report['warnings'] = warnings
+        return report
+
+    def log(self):
+        report = self.report()
+        for name, stage in report['stages'].items():
+            logging.info('thread plan {:<8} intra {:>3} inter {:>4} cores {}{}'.format(name, stage['intra'], str(stage['inter'] or '-'),
+                                                                                 stage['cores'], '' if stage['planned'] else ' (default)'))
+        logging.info('thread plan peak {} intra op threads on {} cores for {} concurrent requests'.format(
+            report['peak_threads'], report['cores'], report['concurrency']))
+        for warning in report['warnings']:
+            logging.warning('thread plan oversubscribed: {}'.format(warning))
+        return report
+
+
+thread_plan = ThreadPlan()
@@ -0,0 +1,318 @@
+"""
+Load test / traffic replay for the OpenAI-compatible API
+从 api_server 日志中提取匿名化的请求形状（request_shape 行），按闭环并发、开环到达率或原始时间间隔回放，
+统计 TTFB / 总延迟分位数、音频吞吐量以及错误率和 429 比例
+
+Usage:
+    python load_test.py record api.log --output shapes.jsonl
+    python load_test.py run shapes.jsonl --concurrency 8 --requests 200
+    python load_test.py run shapes.jsonl --rate 2 --ramp 30:1,60:4,60:8
+    python load_test.py run shapes.jsonl --recorded --speedup 2
+"""
+import argparse
+import asyncio
+import json
+import random
+import struct
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+SHAPE_MARKER = "request_shape "
+
+# 回放时按 text_len 从语料中截取文本（原始文本不会被记录）
+ZH_CORPUS = (
+    "收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐。"
+    "今天的订单已经发货，预计明天下午送达，请保持电话畅通。"
+    "天气预报说周末会有小雨，出门记得带伞。"
+    "会议改到下午三点开始，请各位提前准备好材料。"
+    "这家餐厅的招牌菜是红烧肉，味道非常地道。"
+)
+EN_CORPUS = (
+    "Your order has shipped and should arrive tomorrow afternoon. "
+    "The meeting has been moved to three o'clock, please bring the updated report. "
+    "It might rain over the weekend, so remember to take an umbrella. "
+    "Thank you for calling, all of our agents are currently busy. "
+    "The quarterly results exceeded expectations across every region. "
+)
+
+
+def record(log_paths: List[str], output: str):
+    """从访问日志中提取 request_shape 行，写成 JSONL"""
+    count = 0
+    with open(output, "w", encoding="utf-8") as out:
+        for path in log_paths:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    index = line.find(SHAPE_MARKER)
+                    if index < 0:
+                        continue
+                    try:
+                        shape = json.loads(line[index + len(SHAPE_MARKER):])
+                    except json.JSONDecodeError:
+                        continue
+                    out.write(json.dumps(shape, ensure_ascii=False) + "\n")
+                    count += 1
+    print(f"📝 Recorded {count} request shapes to {output}")
+
+
+def load_shapes(path: str) -> List[dict]:
+    with open(path, "r", encoding="utf-8") as f:
+        shapes = [json.loads(line) for line in f if line.strip()]
+    if not shapes:
+        raise SystemExit(f"No request shapes in {path}")
+    return shapes
+
+
+def make_text(text_len: int, lang: str) -> str:
+    """截取指定长度的文本，随机起点避免相同请求被合并或命中缓存"""
+    corpus = ZH_CORPUS if lang == "zh" else EN_CORPUS
+    repeated = corpus * (text_len // len(corpus) + 2)
+    start = random.randrange(len(corpus))
+    return repeated[start:start + text_len]
+
+
+def parse_ramp(ramp: Optional[str], rate: Optional[float], duration: Optional[float]) -> List[tuple]:
+    """"30:1,60:4" -> [(30.0, 1.0), (60.0, 4.0)]，即每个阶段的持续秒数和每秒到达数"""
+    if ramp:
+        return [tuple(float(v) for v in stage.split(":")) for stage in ramp.split(",")]
+    return [(duration or 60.0, rate)]
+
+
+def audio_seconds(response_format: str, headers: httpx.Headers, head: bytes, num_bytes: int) -> Optional[float]:
+    """根据响应头计算返回音频的时长；压缩格式无法直接计算，返回 None"""
+    if response_format == "pcm":
+        sample_rate = int(headers.get("x-sample-rate", 0))
+        bytes_per_sample = int(headers.get("x-bit-depth", 16)) // 8
+        return num_bytes / bytes_per_sample / sample_rate if sample_rate else None
+    if response_format == "wav" and len(head) >= 44:
+        sample_rate, = struct.unpack("<I", head[24:28])
+        bits_per_sample, = struct.unpack("<H", head[34:36])
+        return (num_bytes - 44) / (bits_per_sample // 8) / sample_rate if sample_rate else None
+    return None
+
+
+class LoadTester:
+    """按请求形状向 /v1/audio/speech 发送请求并收集结果"""
+
+    def __init__(self, url: str, shapes: List[dict], voices: List[str], timeout: float):
+        self.url = url.rstrip("/")
+        self.shapes = shapes
+        self.voices = voices
+        self.voice_map: Dict[str, str] = {}
+        self.timeout = timeout
+        self.results: List[dict] = []
+        self.next_index = 0
+
+    def next_shape(self) -> dict:
+        shape = self.shapes[self.next_index % len(self.shapes)]
+        self.next_index += 1
+        return shape
+
+    def map_voice(self, voice_hash: str) -> str:
+        # 日志中的音色是哈希值，按首次出现顺序映射到目标服务器上的音色
+        if voice_hash not in self.voice_map:
+            self.voice_map[voice_hash] = self.voices[len(self.voice_map) % len(self.voices)]
+        return self.voice_map[voice_hash]
+
+    async def send(self, client: httpx.AsyncClient, shape: dict, stage: int = 0):
+        payload = {
+            "input": make_text(shape.get("text_len", 50), shape.get("lang", "zh")),
+            "voice": self.map_voice(shape.get("voice", "")),
+            "response_format": shape.get("format", "wav"),
+            "stream": shape.get("stream", False),
+            "speed": shape.get("speed", 1.0)
+        }
+        if shape.get("seeded"):
+            payload["seed"] = 42
+        if shape.get("sample_rate"):
+            payload["sample_rate"] = shape["sample_rate"]
+        if shape.get("codec", "linear16") != "linear16":
+            payload["codec"] = shape["codec"]
+
+        result = {"stage": stage, "format": payload["response_format"], "stream": payload["stream"], "text_len": len(payload["input"])}
+        start = time.perf_counter()
+        ttfb, num_bytes, head = None, 0, b""
+        try:
+            async with client.stream("POST", f"{self.url}/v1/audio/speech", json=payload) as response:
+                async for chunk in response.aiter_bytes():
+                    if not chunk:
+                        continue
+                    if ttfb is None:
+                        ttfb = time.perf_counter() - start
+                    if len(head) < 44:
+                        head += chunk[:44 - len(head)]
+                    num_bytes += len(chunk)
+                result["status"] = response.status_code
+                if response.status_code == 200:
+                    result["audio_s"] = audio_seconds(payload["response_format"], response.headers, head, num_bytes)
+        except httpx.HTTPError as e:
+            result["status"] = type(e).__name__
+        result["latency"] = time.perf_counter() - start
+        result["ttfb"] = ttfb if result["status"] == 200 else None
+        self.results.append(result)
+
+    async def run_closed(self, concurrency: int, num_requests: Optional[int], duration: Optional[float]):
+        """闭环：固定数量的客户端，每个请求完成后立即发送下一个"""
+        deadline = time.perf_counter() + duration if duration else None
+        sent = 0
+
+        async def worker(client):
+            nonlocal sent
+            while (num_requests is None or sent < num_requests) and (deadline is None or time.perf_counter() < deadline):
+                sent += 1
+                await self.send(client, self.next_shape())
+
+        async with self.client(concurrency) as client:
+            await asyncio.gather(*[worker(client) for _ in range(concurrency)])
+
+    async def run_open(self, stages: List[tuple]):
+        """开环：按泊松过程到达，不等待前一个请求完成（服务变慢时请求会堆积）"""
+        tasks = []
+        async with self.client(None) as client:
+            for stage, (stage_duration, rate) in enumerate(stages):
+                stage_end = time.perf_counter() + stage_duration
+                print(f"🚦 Stage {stage}: {rate} req/s for {stage_duration:.0f}s")
+                while True:
+                    await asyncio.sleep(random.expovariate(rate))
+                    if time.perf_counter() >= stage_end:
+                        break
+                    tasks.append(asyncio.create_task(self.send(client, self.next_shape(), stage)))
+            await asyncio.gather(*tasks)
+
+    async def run_recorded(self, speedup: float, num_requests: Optional[int]):
+        """按日志中的原始到达间隔回放（可加速）"""
+        shapes = self.shapes[:num_requests] if num_requests else self.shapes
+        base = shapes[0].get("ts", 0)
+        start = time.perf_counter()
+        tasks = []
+        async with self.client(None) as client:
+            for shape in shapes:
+                delay = (shape.get("ts", base) - base) / speedup - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(self.send(client, shape)))
+            await asyncio.gather(*tasks)
+
+    def client(self, concurrency: Optional[int]) -> httpx.AsyncClient:
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        return httpx.AsyncClient(timeout=self.timeout, limits=limits)
+
+
+def percentiles(values: List[float]) -> Optional[dict]:
+    if not values:
+        return None
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(round(q * (len(values) - 1))))] * 1000
+    return {
+        "p50": round(pick(0.50), 1),
+        "p95": round(pick(0.95), 1),
+        "p99": round(pick(0.99), 1),
+        "mean": round(sum(values) / len(values) * 1000, 1)
+    }
+
+
+def summarize(results: List[dict], wall: float) -> dict:
+    ok = [r for r in results if r["status"] == 200]
+    status_counts: Dict[str, int] = {}
+    for r in results:
+        status_counts[str(r["status"])] = status_counts.get(str(r["status"]), 0) + 1
+    audio = [r["audio_s"] for r in ok if r.get("audio_s") is not None]
+    total = max(len(results), 1)
+    return {
+        "requests": len(results),
+        "ok": len(ok),
+        "error_rate": round((len(results) - len(ok)) / total, 4),
+        "rate_429": round(status_counts.get("429", 0) / total, 4),
+        "status_counts": status_counts,
+        "ttfb_ms": percentiles([r["ttfb"] for r in ok if r["ttfb"] is not None]),
+        "latency_ms": percentiles([r["latency"] for r in ok]),
+        "audio_s": round(sum(audio), 2),
+        # 压缩格式 (mp3/opus/flac) 的时长未知，不计入吞吐量
+        "audio_s_unknown_requests": len(ok) - len(audio),
+        "wall_s": round(wall, 2),
+        "audio_s_per_wall_s": round(sum(audio) / wall, 3) if wall > 0 else None,
+        "requests_per_s": round(len(results) / wall, 3) if wall > 0 else None
+    }
+
+
+def fetch_voices(url: str) -> List[str]:
+    response = httpx.get(f"{url.rstrip('/')}/v1/voices/custom", timeout=30)
+    response.raise_for_status()
+    return [voice["voice_id"] for voice in response.json()["voices"]]
+
+
+async def run(args):
+    shapes = load_shapes(args.shapes)
+    voices = args.voice or fetch_voices(args.url)
+    if not voices:
+        raise SystemExit("No voices available on the server, create one or pass --voice")
+    tester = LoadTester(args.url, shapes, voices, args.timeout)
+
+    start = time.perf_counter()
+    if args.recorded:
+        mode = f"recorded x{args.speedup}"
+        await tester.run_recorded(args.speedup, args.requests)
+    elif args.rate or args.ramp:
+        mode = "open"
+        stages = parse_ramp(args.ramp, args.rate, args.duration)
+        await tester.run_open(stages)
+    else:
+        mode = f"closed x{args.concurrency}"
+        await tester.run_closed(args.concurrency, args.requests if args.requests or args.duration else len(shapes), args.duration)
+    wall = time.perf_counter() - start
+
+    report = {
+        "meta": {"url": args.url, "mode": mode, "shapes": args.shapes, "voices": len(voices), "time": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "summary": summarize(tester.results, wall)
+    }
+    if args.ramp:
+        report["stages"] = []
+        for stage, (stage_duration, rate) in enumerate(parse_ramp(args.ramp, args.rate, args.duration)):
+            report["stages"].append({"rate": rate, **summarize([r for r in tester.results if r["stage"] == stage], stage_duration)})
+
+    summary = report["summary"]
+    print(f"✅ {summary['ok']}/{summary['requests']} ok, errors {summary['error_rate']:.1%}, 429 {summary['rate_429']:.1%}")
+    print(f"   TTFB ms {summary['ttfb_ms']}")
+    print(f"   Latency ms {summary['latency_ms']}")
+    print(f"   Throughput {summary['audio_s_per_wall_s']} audio-s/wall-s, {summary['requests_per_s']} req/s")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"📄 Report written to {args.output}")
+    else:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test / traffic replay for the CosyVoice API")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="Extract request shapes from api_server logs")
+    record_parser.add_argument("logs", nargs="+", help="api_server log files")
+    record_parser.add_argument("--output", default="request_shapes.jsonl", help="Output JSONL")
+
+    run_parser = subparsers.add_parser("run", help="Replay request shapes against a running server")
+    run_parser.add_argument("shapes", help="Request shapes JSONL (from record)")
+    run_parser.add_argument("--url", default="http://localhost:81889", help="API server URL")
+    run_parser.add_argument("--voice", action="append", help="Voice ID to use (repeatable, default: all custom voices)")
+    run_parser.add_argument("--concurrency", type=int, default=4, help="Closed-loop clients")
+    run_parser.add_argument("--requests", type=int, default=None, help="Number of requests (default: one pass over the shapes)")
+    run_parser.add_argument("--rate", type=float, default=None, help="Open-loop arrival rate (req/s)")
+    run_parser.add_argument("--ramp", default=None, help="Open-loop stages as seconds:rate, e.g. 30:1,60:4,60:8")
+    run_parser.add_argument("--duration", type=float, default=None, help="Test duration in seconds")
+    run_parser.add_argument("--recorded", action="store_true", help="Replay with the recorded inter-arrival times")
+    run_parser.add_argument("--speedup", type=float, default=1.0, help="Time compression for --recorded")
+    run_parser.add_argument("--timeout", type=float, default=300, help="Per-request timeout in seconds")
+    run_parser.add_argument("--output", default=None, help="Write the JSON report here")
+
+    args = parser.parse_args()
+    if args.command == "record":
+        record(args.logs, args.output)
+    else:
+        asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Single-flight Request Coalescer
+合并相同参数的并发合成请求：同一时刻只运行一次合成，其余请求订阅同一份结果
+"""
+import asyncio
+import logging
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, Iterator, List, Optional
+
+from cosyvoice.utils.metrics import QUEUE_WAIT_SECONDS, RequestTimings
+
+logger = logging.getLogger(__name__)
+
+
+class FlightCancelled(Exception):
+    """合成被取消（所有客户端断开或超过截止时间）"""
+    pass
+
+
+class Flight:
+    """一次正在进行的合成任务，由所有相同请求共享"""
+
+    def __init__(self, key: Hashable, loop: asyncio.AbstractEventLoop):
+        self.key = key
+        self.loop = loop
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.waiter = loop.create_future()
+        # 协作式取消标志，由合成线程在每个 decode step / chunk / 句子处检查
+        self.cancel_event = threading.Event()
+        self.cancel_reason: Optional[str] = None
+        self.deadline_handle: Optional[asyncio.TimerHandle] = None
+        self.created_at = time.perf_counter()
+        # 按阶段的耗时明细，由合成线程中的埋点填充，合并的请求共享同一份
+        self.timings = RequestTimings()
+
+    def notify(self):
+        """唤醒所有等待新数据的订阅者"""
+        waiter, self.waiter = self.waiter, self.loop.create_future()
+        if not waiter.done():
+            waiter.set_result(None)
+
+    def cancel(self, reason: str):
+        """请求取消合成（幂等）"""
+        if not self.cancel_event.is_set():
+            logger.info(f"Cancelling synthesis for flight {self.key}: {reason}")
+            self.cancel_reason = reason
+            self.cancel_event.set()
+
+
+class RequestCoalescer:
+    """Single-flight coalescing of identical in-flight synthesis requests"""
+
+    def __init__(self, deadline: Optional[float] = None):
+        """
+        Args:
+            deadline: 单次合成的最长时间（秒），超时后取消合成；None 表示不限制
+        """
+        self.deadline = deadline
+        self.flights: Dict[Hashable, Flight] = {}
+        self.stats = {
+            "started": 0,
+            "coalesced": 0,
+            "cancelled": 0
+        }
+
+    def _publish(self, flight: Flight, chunk: Any):
+        flight.chunks.append(chunk)
+        flight.notify()
+
+    def _cancel(self, flight: Flight, reason: str):
+        """取消合成，并立即从合并表中移除，之后相同的请求重新合成而不是加入正在拆除的 flight"""
+        flight.cancel(reason)
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+    def _finish(self, flight: Flight, error: Optional[BaseException]):
+        flight.done = True
+        flight.error = error
+        if flight.deadline_handle is not None:
+            flight.deadline_handle.cancel()
+        if flight.cancel_event.is_set():
+            self.stats["cancelled"] += 1
+        # 合成结束后不再接受新的订阅者，后续相同请求重新合成
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+        flight.notify()
+
+    def _run(self, flight: Flight, producer: Callable[[threading.Event], Iterator[Any]]):
+        """在工作线程中运行合成，把每个 chunk 投递回事件循环"""
+        queue_wait = time.perf_counter() - flight.created_at
+        QUEUE_WAIT_SECONDS.observe(queue_wait)
+        flight.timings.add("queue_wait", queue_wait)
+        error = None
+        try:
+            with flight.timings.activate():
+                for chunk in producer(flight.cancel_event):
+                    flight.loop.call_soon_threadsafe(self._publish, flight, chunk)
+            # 被取消的合成只产生了部分结果，不能当作完整结果交给订阅者
+            if flight.cancel_event.is_set():
+                error = FlightCancelled(flight.cancel_reason)
+        except BaseException as e:
+            logger.error(f"Synthesis failed for flight {flight.key}: {e}")
+            error = e
+        flight.timings.finish()
+        flight.loop.call_soon_threadsafe(self._finish, flight, error)
+
+    def _get_or_start(self, key: Hashable, producer: Callable[[threading.Event], Iterator[Any]]) -> Flight:
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.stats["coalesced"] += 1
+            logger.info(f"Coalesced request onto in-flight synthesis ({len(flight.chunks)} chunks ready)")
+            return flight
+        loop = asyncio.get_running_loop()
+        flight = Flight(key, loop)
+        self.flights[key] = flight
+        self.stats["started"] += 1
+        if self.deadline is not None:
+            flight.deadline_handle = loop.call_later(self.deadline, self._cancel, flight, "deadline exceeded")
+        loop.run_in_executor(None, self._run, flight, producer)
+        return flight
+
+    async def subscribe(self, key: Hashable, producer: Callable[[threading.Event], Iterator[Any]],
+                        on_join: Optional[Callable[[Flight], None]] = None) -> AsyncIterator[Any]:
+        """
+        订阅 key 对应的合成结果
+
+        如果已有相同 key 的合成在进行，直接加入；晚加入的订阅者会先收到已生成的 chunk。
+        最后一个订阅者离开（客户端断开）时取消合成。
+
+        Args:
+            key: 请求合并键，例如 (voice, text, speed, format, seed)
+            producer: 接收 cancel_event 的可调用对象，返回同步 chunk 迭代器，仅在没有进行中的任务时调用
+            on_join: 加入 flight 后立即回调，可用于获取 flight.timings
+
+        Yields:
+            producer 产生的每个 chunk
+        """
+        flight = self._get_or_start(key, producer)
+        flight.subscribers += 1
+        try:
+            if on_join is not None:
+                on_join(flight)
+            index = 0
+            while True:
+                if index < len(flight.chunks):
+                    yield flight.chunks[index]
+                    index += 1
+                elif flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    break
+                else:
+                    await flight.waiter
+        finally:
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done:
+                self._cancel(flight, "all clients disconnected")
+
+    async def collect(self, key: Hashable, producer: Callable[[threading.Event], Iterator[Any]],
+                      on_join: Optional[Callable[[Flight], None]] = None) -> List[Any]:
+        """订阅并等待全部 chunk（用于非流式响应）"""
+        return [chunk async for chunk in self.subscribe(key, producer, on_join)]
+
+    def get_stats(self) -> Dict[str, int]:
+        """获取合并统计信息"""
+        return {
+            **self.stats,
+            "in_flight": len(self.flights),
+            "subscribers": sum(flight.subscribers for flight in self.flights.values())
+        }
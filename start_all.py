@@ -19,11 +19,15 @@ def start_webui(port=50000, model_dir="pretrained_models/Fun-CosyVoice3-0.5B"):
     import app_local
     # The app_local will handle its own startup
     
-def start_api_server(port=81889, model_dir="pretrained_models/Fun-CosyVoice3-0.5B"):
+def start_api_server(port=81889, model_dir="pretrained_models/Fun-CosyVoice3-0.5B", token2wav_workers=0, token2wav_cores=None):
     """Start FastAPI server"""
     import uvicorn
     os.environ['API_PORT'] = str(port)
     os.environ['MODEL_DIR'] = model_dir
+    # frontend + LLM stay in the API process, flow + HiFT run in token2wav_workers processes it spawns
+    os.environ['TOKEN2WAV_WORKERS'] = str(token2wav_workers)
+    if token2wav_cores:
+        os.environ['TOKEN2WAV_CORES'] = token2wav_cores
     
     uvicorn.run(
         "api_server:app",
@@ -56,6 +60,10 @@ def main():
                       help='Start API server only')
     parser.add_argument('--webui_only', action='store_true',
                       help='Start WebUI only')
+    parser.add_argument('--token2wav_workers', type=int, default=0,
+                      help='API server: run flow + HiFT in this many processes beside the LLM (default: 0, in process)')
+    parser.add_argument('--token2wav_cores', type=str, default=None,
+                      help='API server: CPU cores split among the token2wav processes, e.g. 8-31')
     
     args = parser.parse_args()
     
@@ -71,11 +79,13 @@ def main():
             print(f"\n🚀 Starting API Server on port {args.api_port}...")
             api_process = multiprocessing.Process(
                 target=start_api_server,
-                args=(args.api_port, args.model_dir)
+                args=(args.api_port, args.model_dir, args.token2wav_workers, args.token2wav_cores)
             )
             api_process.start()
             processes.append(api_process)
             print(f"   API Docs will be available at: http://localhost:{args.api_port}/docs")
+            if args.token2wav_workers > 0:
+                print(f"   Stage pipeline: frontend + LLM in the API process, {args.token2wav_workers} token2wav process(es)")
         
         # Start WebUI
         if not args.api_only:
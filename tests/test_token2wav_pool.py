@@ -0,0 +1,67 @@
+import os
+import sys
+import queue
+import threading
+import time
+import pytest
+torch = pytest.importorskip('torch')
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from cosyvoice.cli.pipeline import Token2WavPool, Token2WavSlot, PromptStore  # noqa: E402
+
+
+class SilentWorker:
+    """A live worker that never answers, the chunk stays outstanding"""
+
+    name = 'token2wav-0'
+
+    def is_alive(self):
+        return True
+
+
+def make_pool(num_slots=1):
+    # NOTE no worker processes, only the main process side of the pool
+    pool = Token2WavPool.__new__(Token2WavPool)
+    pool.samples_per_token = 960
+    pool.max_tokens, pool.max_samples = 64, 2 * 64 * 960
+    pool.slots = [Token2WavSlot(pool.max_tokens, pool.max_samples) for _ in range(num_slots)]
+    pool.free_slots = queue.Queue()
+    for i in range(num_slots):
+        pool.free_slots.put(i)
+    pool.slot_results = [queue.Queue(maxsize=1) for _ in range(num_slots)]
+    pool.poisoned = set()
+    pool.chunk_timeout = 300
+    pool.prompts = PromptStore()
+    pool.sessions = {}
+    pool.assigned = [0]
+    pool.lock = threading.Lock()
+    pool.request_queues = [queue.Queue()]
+    pool.workers = [SilentWorker()]
+    return pool
+
+
+def close_pool(pool):
+    for slot in pool.slots:
+        slot.close(unlink=True)
+    pool.prompts.close()
+
+
+def test_caller_cancel_interrupts_outstanding_chunk():
+    pool = make_pool()
+    caller_event, session_event = threading.Event(), threading.Event()
+    try:
+        pool.acquire('session', caller_event)
+        timer = threading.Timer(0.2, caller_event.set)
+        timer.start()
+        start_time = time.perf_counter()
+        # NOTE the model passes its per session flag, which only the blocked tts thread would set
+        speech = pool.token2wav(torch.zeros(1, 10, dtype=torch.int32), torch.zeros(1, 5, dtype=torch.int32), torch.zeros(1, 10, 80),
+                                torch.zeros(1, 192), 0, 'session', cancel_event=session_event)
+        timer.join()
+        assert time.perf_counter() - start_time < 2
+        assert speech.shape[1] == 0
+        assert pool.sessions['session']['abandoned'] is True
+        pool.release('session')
+        # the worker may still write the slot, it is held back until the late result arrives
+        assert pool.poisoned == {0} and pool.free_slots.empty()
+    finally:
+        close_pool(pool)